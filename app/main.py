@@ -34,21 +34,27 @@ except Exception as e:
     print(f"⚠️ Failed to patch httpx: {e}", file=sys.stderr)
 
 # ✅ NOW safe to import everything else
-from flask import Flask, request, send_file
+from flask import Flask, request, send_file, g, has_app_context, redirect, url_for
 from twilio.twiml.messaging_response import MessagingResponse
 from supabase import create_client, Client
-import qrcode
+import multiprocessing
+from qr_render import render_qr_png
 from io import BytesIO
 from twilio.rest import Client as TwilioClient
+from twilio.base.exceptions import TwilioRestException
 import uuid
 import requests
 import secrets
 from flask import render_template_string, render_template
 import hashlib
 import hmac
+import base64
+import binascii
 from postgrest.exceptions import APIError as PostgrestAPIError
 import re
 import json
+import copy
+from urllib.parse import quote
 from datetime import datetime
 import time
 import httpx  # This is now safe — already patched
@@ -58,10 +64,21 @@ from dotenv import load_dotenv
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 import threading
+import queue
+import logging
+import logging.handlers
+import atexit
+import random
+import zlib
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import xml.etree.ElementTree as ET
 import time
 from datetime import datetime, timedelta, timezone
 import pytz
-from functools import lru_cache
+from functools import wraps
+from cachetools import TTLCache, LRUCache
 from datetime import datetime, timedelta
 import pytz
 
@@ -72,23 +89,118 @@ from supabase import create_client, Client
 from dotenv import load_dotenv
 from pathlib import Path
 
-# ====== ROBUST HTTP CLIENT FOR WINDOWS SSL ======
-def create_robust_http_client():
-    import ssl
-    from httpx import HTTPTransport, Client as HTTPXClient
+# ====== LOGGING ======
+# Request threads only put records on an in-memory queue; a QueueListener thread does the
+# stdout I/O. Messages are one line of `event key=value ...`. LOG_LEVEL sets the level, and
+# DEBUG records (raw payloads, headers, reply text) are sampled at LOG_DEBUG_SAMPLE_RATE.
+class DebugSampler(logging.Filter):
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or random.random() < self.rate
+
+def setup_logging():
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(threadName)s %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(DebugSampler(float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "0.01"))))
+    logger = logging.getLogger("ticketflow")
+    logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    logger.addHandler(queue_handler)
+    logger.propagate = False
+    listener.start()
+    atexit.register(listener.stop)
+    return logger
+
+# ====== OUTBOUND HTTP CLIENTS ======
+# Every direct HTTP call (gateways, Supabase REST lookups and fallbacks, probes) goes through
+# one registry that keeps a pooled keep-alive httpx.Client per host, so calls reuse TLS
+# connections instead of handshaking each time. Pool size, timeouts and retries are uniform:
+# failed connection attempts are retried HTTP_RETRIES times by the transport, and idempotent
+# requests (GET/HEAD) as often on read/TLS errors, with a short backoff. The Supabase SDK clients
+# keep their own pools.
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "30"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_MAX_CONNECTIONS_PER_HOST = int(os.getenv("HTTP_MAX_CONNECTIONS_PER_HOST", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))
+
+def create_ssl_context():
     ctx = ssl.create_default_context()
     ctx.check_hostname = True
     ctx.verify_mode = ssl.CERT_REQUIRED
     ctx.options |= ssl.OP_NO_TICKET      # Critical for Windows SSL session reuse bug
     ctx.options |= ssl.OP_NO_COMPRESSION
-    transport = HTTPTransport(http2=False, verify=ctx, retries=3)
-    return HTTPXClient(transport=transport, timeout=30.0)
+    return ctx
+
+class HttpClientRegistry:
+    """Per-host pooled httpx clients behind a requests-like get/post/patch/request API."""
+    IDEMPOTENT = frozenset(['GET', 'HEAD'])
+
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._ssl_context = create_ssl_context()
+
+    def client(self, url):
+        origin = httpx.URL(url)
+        key = (origin.scheme, origin.host, origin.port)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                transport = HTTPTransport(
+                    http2=False,
+                    verify=self._ssl_context,
+                    retries=HTTP_RETRIES,
+                    limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS_PER_HOST,
+                                        max_keepalive_connections=HTTP_MAX_CONNECTIONS_PER_HOST,
+                                        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY)
+                )
+                client = self._clients[key] = HTTPXClient(
+                    transport=transport,
+                    timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+                )
+            return client
+
+    def request(self, method, url, **kwargs):
+        method = method.upper()
+        client = self.client(url)
+        attempts = 1 + (HTTP_RETRIES if method in self.IDEMPOTENT else 0)
+        for attempt in range(attempts):
+            try:
+                return client.request(method, url, **kwargs)
+            except (httpx.ReadError, httpx.ReadTimeout, httpx.RemoteProtocolError) as e:
+                # connect failures were already retried by the transport
+                if attempt == attempts - 1:
+                    raise
+                log.warning("http_retry method=%s host=%s attempt=%d error=%s", method, httpx.URL(url).host, attempt + 1, e)
+                time.sleep(0.25 * (2 ** attempt))
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request('PATCH', url, **kwargs)
+
+    def close(self):
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients.clear()
 
 # Initialize Flask app
 BASE_DIR = Path(__file__).parent
 TEMPLATE_DIR = BASE_DIR / "templates"
 app = Flask(__name__, template_folder=TEMPLATE_DIR)
 load_dotenv()
+log = setup_logging()
 
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
@@ -100,38 +212,399 @@ assert SUPABASE_KEY, "Missing SUPABASE_KEY"
 assert SUPABASE_SERVICE_ROLE_KEY, "Missing SUPABASE_SERVICE_ROLE_KEY"
 
 # ✅ Create robust HTTP client once
-http_client = create_robust_http_client()
+http_client = HttpClientRegistry()
+atexit.register(http_client.close)
 
 # ✅ Initialize Supabase clients with the patched, SSL-safe client
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 supabase_service: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
 
-print("✅ Supabase clients ready (HTTP/2 disabled, SSL hardened for Windows)")
+log.info("supabase_clients_ready http2=off")
+
+# ====== REQUEST-SCOPED QUERY MEMOIZATION ======
+# The webhook helpers call each other (get_incomplete_organizer_event → get_user_organizers, the
+# payment branch re-fetches organizers, ...), so one message used to repeat the same PostgREST
+# queries. Read helpers decorated with @request_cached run each distinct query at most once per
+# request; results live on flask.g, which is dropped when the request (or worker app context) ends.
+from postgrest._sync.request_builder import SyncQueryRequestBuilder, SyncSingleRequestBuilder
+
+def _count_supabase_call(execute):
+    @wraps(execute)
+    def wrapper(self, *args, **kwargs):
+        if has_app_context():
+            g.supabase_calls = g.get('supabase_calls', 0) + 1
+        return execute(self, *args, **kwargs)
+    return wrapper
+
+# SyncMaybeSingleRequestBuilder delegates to SyncSingleRequestBuilder.execute, so it is counted once
+for _builder in (SyncQueryRequestBuilder, SyncSingleRequestBuilder):
+    _builder.execute = _count_supabase_call(_builder.execute)
+
+def request_cached(fn):
+    """Memoize a read helper for the rest of the current request (no-op outside an app context)."""
+    @wraps(fn)
+    def wrapper(*args):
+        if not has_app_context():
+            return fn(*args)
+        cache = g.setdefault('query_cache', {})
+        key = (fn.__name__, args)
+        if key not in cache:
+            cache[key] = fn(*args)
+        return cache[key]
+    return wrapper
+
+def clear_request_cache():
+    """Forget memoized reads after a write that would make them stale within this request."""
+    if has_app_context():
+        g.pop('query_cache', None)
+
+@app.after_request
+def report_supabase_calls(response):
+    calls = g.get('supabase_calls', 0)
+    response.headers['X-Supabase-Calls'] = str(calls)
+    log.debug("request method=%s path=%s status=%s supabase_calls=%d", request.method, request.path, response.status_code, calls)
+    return response
+
+# ====== IN-PROCESS TTL CACHES ======
+class LoadingCache:
+    """
+    Thread-safe TTL + LRU cache (cachetools.TTLCache underneath).
+    get(key, loader) calls loader() on a miss; concurrent misses for the same key wait for
+    that single load instead of all hitting the database. None results are not cached.
+    """
+    def __init__(self, maxsize, ttl):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._generation = 0
+
+    def get(self, key, loader):
+        with self._lock:
+            if key in self._cache:
+                return self._cache[key]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                if key in self._cache:
+                    return self._cache[key]
+                generation = self._generation
+            try:
+                value = loader()
+                with self._lock:
+                    # Skip the store if an invalidate() raced with this load
+                    if value is not None and generation == self._generation:
+                        self._cache[key] = value
+                return value
+            finally:
+                with self._lock:
+                    self._key_locks.pop(key, None)
+
+    def peek(self, key):
+        with self._lock:
+            return self._cache.get(key)
+
+    def set(self, key, value):
+        with self._lock:
+            self._cache[key] = value
+
+    def invalidate(self, key=None):
+        """Drop one key, or everything when key is None."""
+        with self._lock:
+            self._generation += 1
+            if key is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(key, None)
+
+
+
+# ====== METRICS ======
+# Every outbound HTTP call is timed at the transport layer: supabase/supabase_service/storage3 and
+# http_client go through httpx.Client.send, while twilio_client goes through
+# requests.Session.send. Calls are labelled by target (supabase, supabase_service,
+# supabase_storage, flutterwave, paystack, twilio, or the bare host). Local stages use
+# `with stage(name):`, and routes get a latency histogram labelled by their URL rule.
+# Everything is exposed in Prometheus text format at /metrics.
+class Histogram:
+    """Thread-safe latency histogram with cumulative buckets (Prometheus style), in seconds."""
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * len(self.buckets)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self._count += 1
+            self._sum += value
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self._counts[i] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'buckets': dict(zip(self.buckets, self._counts)),
+                'sum': self._sum,
+                'count': self._count
+            }
+
 
 
+class HistogramFamily:
+    """Histograms keyed by a tuple of label values, created on first use."""
+    def __init__(self, name, help_text, labelnames, buckets=Histogram.DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = buckets
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        with self._lock:
+            child = self._children.get(values)
+            if child is None:
+                child = self._children[values] = Histogram(self.buckets)
+            return child
+
+    def items(self):
+        with self._lock:
+            return list(self._children.items())
+
+class CounterFamily:
+    def __init__(self, name, help_text, labelnames):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *values, amount=1):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def items(self):
+        with self._lock:
+            return list(self._values.items())
+
+STAGE_SECONDS = HistogramFamily('ticketflow_stage_seconds', 'Time spent in outbound calls and local stages.', ['stage'])
+STAGE_ERRORS = CounterFamily('ticketflow_stage_errors_total', 'Outbound calls and stages that raised.', ['stage'])
+REQUEST_SECONDS = HistogramFamily('ticketflow_request_seconds', 'Flask request latency by route.', ['route', 'method'])
+REQUESTS_TOTAL = CounterFamily('ticketflow_requests_total', 'Flask requests by route and status.', ['route', 'method', 'status'])
+
+class stage:
+    """Context manager that times a block into ticketflow_stage_seconds{stage=name}."""
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        STAGE_SECONDS.labels(self.name).observe(time.perf_counter() - self.start)
+        if exc_type is not None:
+            STAGE_ERRORS.inc(self.name)
+        return False
+
+OUTBOUND_HOSTS = {
+    'api.flutterwave.com': 'flutterwave',
+    'api.paystack.co': 'paystack',
+    'api.twilio.com': 'twilio',
+}
+SUPABASE_HOST = httpx.URL(SUPABASE_URL).host
+
+def outbound_target(host, path, headers):
+    if host == SUPABASE_HOST:
+        if path.startswith('/storage/'):
+            return 'supabase_storage'
+        return 'supabase_service' if headers.get('apikey') == SUPABASE_SERVICE_ROLE_KEY else 'supabase'
+    return OUTBOUND_HOSTS.get(host, host)
+
+_orig_httpx_send = httpx.Client.send
+
+def _timed_httpx_send(self, request, *args, **kwargs):
+    with stage(outbound_target(request.url.host, request.url.path, request.headers)):
+        return _orig_httpx_send(self, request, *args, **kwargs)
+
+httpx.Client.send = _timed_httpx_send
+
+_orig_requests_send = requests.Session.send
+
+def _timed_requests_send(self, request, **kwargs):
+    url = httpx.URL(request.url)
+    with stage(outbound_target(url.host, url.path, request.headers)):
+        return _orig_requests_send(self, request, **kwargs)
+
+requests.Session.send = _timed_requests_send
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def observe_request_latency(response):
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_SECONDS.labels(route, request.method).observe(time.perf_counter() - started)
+        REQUESTS_TOTAL.inc(route, request.method, str(response.status_code))
+    return response
+
+def _prometheus_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+def render_prometheus_histograms(name, help_text, labelnames, children):
+    lines = [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+    for values, histogram in children:
+        snap = histogram.snapshot()
+        for bound, count in snap['buckets'].items():
+            lines.append(f"{name}_bucket{_prometheus_labels(labelnames, values, [('le', bound)])} {count}")
+        lines.append(f"{name}_bucket{_prometheus_labels(labelnames, values, [('le', '+Inf')])} {snap['count']}")
+        lines.append(f"{name}_sum{_prometheus_labels(labelnames, values)} {snap['sum']}")
+        lines.append(f"{name}_count{_prometheus_labels(labelnames, values)} {snap['count']}")
+    return lines
+
+def render_prometheus_counter(family):
+    lines = [f'# HELP {family.name} {family.help_text}', f'# TYPE {family.name} counter']
+    for values, value in family.items():
+        lines.append(f"{family.name}{_prometheus_labels(family.labelnames, values)} {value}")
+    return lines
+
 
 # Init Twilio
 twilio_client = TwilioClient(os.getenv("TWILIO_ACCOUNT_SID"), os.getenv("TWILIO_AUTH_TOKEN"))
 TWILIO_NUMBER = os.getenv("TWILIO_WHATSAPP_NUMBER")
-print(">>> TWILIO CREDENTIALS:")
-print("SID:", os.getenv("TWILIO_ACCOUNT_SID"))
-print("TOKEN:", os.getenv("TWILIO_AUTH_TOKEN"))
+# Public URL of this app (links in messages, QR media fetched by Twilio)
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "https://46e92286d210.ngrok-free.app").rstrip("/")
+log.info("twilio_client_ready sid=%s", os.getenv("TWILIO_ACCOUNT_SID"))
 
 BASE_DIR = Path(__file__).resolve().parent.parent  # project root
 TEMPLATE_DIR = BASE_DIR / "templates"
 
+# ====== SESSION STORE ======
+class SessionStore:
+    """
+    user_sessions access with a local write-through cache.
+    Reads are served from memory after the first load. Mutations made while handling one message
+    are merged on flask.g and written by flush() as a single upsert (or delete) before the reply
+    is returned; outside an app context they are written immediately.
+    The cache is per process and only this process's writes refresh it: with more than one app
+    instance (or gunicorn worker), another instance can serve a session up to SESSION_CACHE_TTL
+    seconds stale and send the user back a step. Run a single instance, or set
+    SESSION_CACHE_TTL=0 to read through to the database every time.
+    """
+    _NO_SESSION = object()
+
+    def __init__(self, ttl):
+        self._cache = TTLCache(maxsize=10000, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def _pending(self):
+        return g.setdefault('session_writes', {}) if has_app_context() else None
+
+    def get(self, whatsapp_id):
+        """Current session row (a private copy) or None."""
+        pending = self._pending()
+        if pending is not None and whatsapp_id in pending:
+            return copy.deepcopy(pending[whatsapp_id])
+        with self._lock:
+            row = self._cache.get(whatsapp_id)
+        if row is None:
+            result = supabase.table('user_sessions').select('*').eq('whatsapp_id', whatsapp_id).execute()
+            row = result.data[0] if result.data else self._NO_SESSION
+            with self._lock:
+                self._cache[whatsapp_id] = row
+        return None if row is self._NO_SESSION else copy.deepcopy(row)
+
+    def update(self, whatsapp_id, **fields):
+        """Merge fields into the session, creating it if needed."""
+        row = self.get(whatsapp_id) or {'whatsapp_id': whatsapp_id}
+        row.update(fields)
+        self._stage(whatsapp_id, row)
+
+    def delete(self, whatsapp_id):
+        self._stage(whatsapp_id, None)
+
+    def _stage(self, whatsapp_id, row):
+        pending = self._pending()
+        if pending is None:
+            self._write(whatsapp_id, row)
+        else:
+            pending[whatsapp_id] = row
+
+    def flush(self):
+        """
+        Write this request's merged session changes — one round trip per touched session.
+        Raises if a write fails, so the caller can tell the user instead of replying as if the
+        step had been saved.
+        """
+        if not has_app_context():
+            return
+        for whatsapp_id, row in g.pop('session_writes', {}).items():
+            try:
+                self._write(whatsapp_id, row)
+            except Exception as e:
+                log.error("session_save_failed whatsapp_id=%s error=%s", whatsapp_id, e)
+                self.invalidate(whatsapp_id)
+                raise
+
+    def discard(self):
+        """Drop this request's unsaved session changes."""
+        if has_app_context():
+            g.pop('session_writes', None)
+
+    def _write(self, whatsapp_id, row):
+        if row is None:
+            supabase.table('user_sessions').delete().eq('whatsapp_id', whatsapp_id).execute()
+            cached = self._NO_SESSION
+        else:
+            payload = {k: v for k, v in row.items() if k != 'id'}
+            try:
+                result = supabase.table('user_sessions').upsert(payload, on_conflict='whatsapp_id').execute()
+            except PostgrestAPIError as e:
+                if e.code != '42P10':
+                    raise
+                # ON CONFLICT needs a unique constraint on whatsapp_id; until one is added
+                # (ALTER TABLE user_sessions ADD CONSTRAINT user_sessions_whatsapp_id_key
+                # UNIQUE (whatsapp_id)), write with an update and insert when nothing matched
+                log.warning("session_upsert_unsupported whatsapp_id=%s fallback=update_insert", whatsapp_id)
+                result = supabase.table('user_sessions').update(payload).eq('whatsapp_id', whatsapp_id).execute()
+                if not result.data:
+                    result = supabase.table('user_sessions').insert(payload).execute()
+            cached = result.data[0] if result.data else row
+        with self._lock:
+            self._cache[whatsapp_id] = cached
+
+    def invalidate(self, whatsapp_id=None):
+        with self._lock:
+            if whatsapp_id is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(whatsapp_id, None)
+
+SESSION_CACHE_TTL = int(os.getenv("SESSION_CACHE_TTL", "300"))
+session_store = SessionStore(ttl=SESSION_CACHE_TTL)
+
 def log_bot_reply(phone: str, message: str):
-    print(f"\n>>> 📤 BOT REPLY TO {phone}:")
-    print("──────────────────────────────────────")
-    print(message)
-    print("──────────────────────────────────────\n")
+    log.debug("bot_reply to=%s text=%r", phone, message)
 
 def cleanup_expired_sessions():
     supabase.table('user_sessions') \
         .delete() \
         .lt('expires_at', 'now()') \
         .execute()
+    session_store.invalidate()
 
+@request_cached
 def get_user_profile(clean_phone):
     # Reconstruct raw WhatsApp ID
     raw_phone = f"whatsapp:{clean_phone}"
@@ -153,36 +626,46 @@ def normalize_phone(twilio_phone):
         return twilio_phone[len("whatsapp:"):]
     return twilio_phone
 
+@request_cached
 def get_user_organizers(sender):
     """Get all organizers the user is linked to, with active event count"""
-    print(f">>> 🔍 Fetching organizers for raw WhatsApp ID: {sender}")
     result = supabase_service.table('user_organizers') \
         .select('organizer_id, organizers(name, code, refundable, contact_for_refunds)') \
         .eq('whatsapp_id', sender) \
         .execute()
-    print(f">>> 📋 user_organizers result: {result.data}")
+    log.debug("user_organizers whatsapp_id=%s rows=%s", sender, result.data)
     if not result.data:
         return []
+    events_counts = get_active_event_counts(tuple(row['organizer_id'] for row in result.data))
     orgs = []
     for row in result.data:
-        # Count active events for this organizer
-        events_count = supabase.table('events') \
-            .select('id', count='exact') \
-            .eq('organizer_id', row['organizer_id']) \
-            .eq('status', 'active') \
-            .eq('ticket_sales_open', True) \
-            .gte('date', 'now()') \
-            .execute()
         orgs.append({
             'id': row['organizer_id'],
             'name': row['organizers']['name'],
             'code': row['organizers']['code'],          # ✅ Now available
             'refundable': row['organizers']['refundable'],
             'contact_for_refunds': row['organizers']['contact_for_refunds'],
-            'active_events_count': events_count.count
+            'active_events_count': events_counts.get(row['organizer_id'], 0)
         })
     return orgs
 
+def get_active_event_counts(org_ids):
+    """Count active, on-sale, upcoming events for many organizers in one query → {organizer_id: count}"""
+    if not org_ids:
+        return {}
+    events = supabase.table('events') \
+        .select('organizer_id') \
+        .in_('organizer_id', list(org_ids)) \
+        .eq('status', 'active') \
+        .eq('ticket_sales_open', True) \
+        .gte('date', 'now()') \
+        .execute()
+    counts = {}
+    for ev in events.data or []:
+        counts[ev['organizer_id']] = counts.get(ev['organizer_id'], 0) + 1
+    return counts
+
+@request_cached
 def get_active_events_for_organizer(org_id):
     """Get events that are: active, sales open, not cancelled, future"""
     events = supabase.table('events') \
@@ -194,6 +677,7 @@ def get_active_events_for_organizer(org_id):
         .execute()
     return events.data or []
 
+@request_cached
 def get_incomplete_organizer_event(sender: str):
     """
     Returns dict with event_name and dashboard_url if user created an event
@@ -294,36 +778,88 @@ def generate_organizer_code(event_name: str, event_date: str) -> str:
     # Final fallback: random suffix
     return f"{base_acronym}{year_suffix}{secrets.token_urlsafe(3).replace('_', '').replace('-', '').upper()[:3]}"
 
-def show_events_for_organizer(org_id, msg):
+# ====== EVENT CATALOG CACHE ======
+# Thousands of attendees ask one organizer for the same `events` list within minutes, so the
+# event/ticket-type snapshot and the rendered reply are cached per organizer. Writes that change
+# events or inventory call invalidate_event_catalog(); the short TTL covers writes made elsewhere
+# (e.g. the Streamlit dashboard) that do not reach the invalidation endpoint.
+CATALOG_CACHE_TTL = int(os.getenv("CATALOG_CACHE_TTL", "30"))
+_event_catalogs = LoadingCache(maxsize=1024, ttl=CATALOG_CACHE_TTL)
+
+def load_event_catalog(org_id):
+    """Fetch on-sale events with their in-stock ticket types (two queries) and render the reply."""
     events = get_active_events_for_organizer(org_id)
+    ticket_types = []
+    if events:
+        ticket_types = supabase.table('ticket_types') \
+            .select('id, event_id, name, price, available_quantity') \
+            .in_('event_id', [ev['id'] for ev in events]) \
+            .gt('available_quantity', 0) \
+            .execute().data or []
+    by_event = {}
+    for t in ticket_types:
+        by_event.setdefault(t['event_id'], []).append(t)
+    catalog_events = [dict(ev, ticket_types=by_event.get(ev['id'], [])) for ev in events]
+    # Purchase index: normalized ticket-type name → [(event, ticket_type), ...] in event order
+    ticket_index = {}
+    for ev in catalog_events:
+        for t in ev['ticket_types']:
+            ticket_index.setdefault(normalize_ticket_type_name(t['name']), []).append((ev, t))
+    return {
+        'events': catalog_events,
+        'ticket_index': ticket_index,
+        'text': render_event_catalog(catalog_events)
+    }
+
+def normalize_ticket_type_name(name):
+    """'  Early   bird ' → 'early bird' (purchase lookups are case/space-insensitive)"""
+    return ' '.join(name.split()).lower()
+
+def find_ticket_type(org_id, ticket_type_name, quantity):
+    """
+    Resolve a purchase like `VIP 2` with one lookup in the organizer's cached index.
+    Returns (event, ticket_type) for the first event with enough stock, or (None, None).
+    """
+    candidates = get_event_catalog(org_id)['ticket_index'].get(normalize_ticket_type_name(ticket_type_name), ())
+    for ev, t in candidates:
+        if t['available_quantity'] >= quantity:
+            return ev, t
+    return None, None
+
+def render_event_catalog(events):
     if not events:
-        msg.body("📭 This organizer has no upcoming events with open ticket sales.")
-        return
+        return "📭 This organizer has no upcoming events with open ticket sales."
 
     reply = "🎉 *UPCOMING EVENTS*\n\n"
     for ev in events:
-        tickets = supabase.table('ticket_types') \
-            .select('name, price, available_quantity') \
-            .eq('event_id', ev['id']) \
-            .gt('available_quantity', 0) \
-            .execute()
-        if not tickets.data:
+        if not ev['ticket_types']:
             continue
         reply += f"🎪 *{ev['name']}*\n📅 {ev['date']} | 📍 {ev['location']}\n"
-        for t in tickets.data:
+        for t in ev['ticket_types']:
             reply += f"🎟️ {t['name']}: ₦{t['price']:,} ({t['available_quantity']} left)\n"
         reply += "\n"
     if reply == "🎉 *UPCOMING EVENTS*\n\n":
         reply = "📭 All events are sold out!"
     reply += "\n👉 Reply with:\n*TicketType Quantity*\nExample: `VIP 2`"
-    msg.body(reply)
+    return reply
+
+def get_event_catalog(org_id):
+    # Keyed by str(id) so the invalidation endpoint can address organizers from a query string
+    return _event_catalogs.get(str(org_id), lambda: load_event_catalog(org_id))
+
+def invalidate_event_catalog(org_id=None):
+    """Drop one organizer's cached catalog, or all of them when org_id is None."""
+    _event_catalogs.invalidate(None if org_id is None else str(org_id))
+
+def show_events_for_organizer(org_id, msg):
+    msg.body(get_event_catalog(org_id)['text'])
 
 def handle_attend_command(raw_phone, org_code, msg):
     # Normalize to clean phone for user profile
     clean_phone = normalize_phone(raw_phone)
 
-    org = supabase.table('organizers').select('*').eq('code', org_code).single().execute()
-    if not org.data:
+    org = get_organizer_by_code(org_code)
+    if not org:
         msg.body("❌ Invalid organizer code. Please check and try again.")
         return
 
@@ -346,73 +882,520 @@ def handle_attend_command(raw_phone, org_code, msg):
     supabase.table('user_organizers').upsert(
         {
             'whatsapp_id': raw_phone,
-            'organizer_id': organizer_id,
-            'organizer_name': data['org_name']  # ✅ ADD THIS
+            'organizer_id': org['id'],
+            'organizer_name': org['name']  # ✅ ADD THIS
         },
         on_conflict='whatsapp_id,organizer_id'
     ).execute()
+    clear_request_cache()
+
+    welcome = org.get('welcome_message') or 'Welcome! How can I help?'
+    reply_text = f"🎉 *{org['name']}*\n{welcome}\nType 'events' to see available tickets."
+    msg.body(reply_text)
+    if org.get('logo_url'):
+        msg.media(org['logo_url'])
+
+    log_bot_reply(raw_phone, reply_text)
+
+# ====== QR RENDERING ======
+# QR matrix building and PNG encoding are CPU-bound and hold the GIL, so they run in a process
+# pool. render_qr_batch() spreads a burst of tickets across cores; render_qr() is the single-image
+# shortcut. QR_RENDER_WORKERS=0 renders inline (also the fallback if the pool cannot start).
+# Workers are started with forkserver (spawn where that is unavailable), never by forking this
+# process, which by then runs the log listener, outbox, payment and monitor threads. Under a WSGI
+# server the workers only import qr_render. When this file is run as a script, spawned workers
+# re-import it as __mp_main__, which repeats config validation, client setup, the outbox DB open
+# and metrics registration; only the background threads are skipped (see the MainProcess guard at
+# the bottom of the file).
+QR_RENDER_WORKERS = int(os.getenv("QR_RENDER_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+_qr_pool = None
+_qr_pool_lock = threading.Lock()
+
+def _get_qr_pool():
+    global _qr_pool
+    if QR_RENDER_WORKERS <= 0:
+        return None
+    with _qr_pool_lock:
+        if _qr_pool is None:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            context = multiprocessing.get_context(method)
+            if method == 'forkserver':
+                # The fork server would otherwise import this app (as __main__) before forking workers
+                context.set_forkserver_preload(['qr_render'])
+            _qr_pool = ProcessPoolExecutor(max_workers=QR_RENDER_WORKERS, mp_context=context)
+            atexit.register(_qr_pool.shutdown, wait=False)
+            log.info("qr_render_pool_started workers=%d start_method=%s", QR_RENDER_WORKERS, method)
+        return _qr_pool
+
+def _reset_qr_pool():
+    global _qr_pool
+    with _qr_pool_lock:
+        if _qr_pool is not None:
+            _qr_pool.shutdown(wait=False)
+        _qr_pool = None
+
+def render_qr_batch(payloads, box_size=5, border=2):
+    """Render one PNG per payload (same order), spread across the process pool."""
+    payloads = list(payloads)
+    if not payloads:
+        return []
+    with stage('qr_render'):
+        pool = _get_qr_pool()
+        if pool is not None:
+            try:
+                chunksize = max(1, len(payloads) // (QR_RENDER_WORKERS * 4))
+                return list(pool.map(render_qr_png, payloads, [box_size] * len(payloads),
+                                     [border] * len(payloads), chunksize=chunksize))
+            except (BrokenProcessPool, OSError) as e:
+                log.warning("qr_render_pool_failed fallback=inline error=%s", e)
+                _reset_qr_pool()
+        return [render_qr_png(data, box_size, border) for data in payloads]
+
+def render_qr(data, box_size=5, border=2):
+    return render_qr_batch([data], box_size, border)[0]
+
+
+# ====== DURABLE OUTBOUND MESSAGES ======
+# Every bot-initiated WhatsApp message (tickets, async webhook replies) is written to a local SQLite
+# outbox before it is sent, so a crash, a Twilio outage or a rate-limit burst cannot lose it. One
+# dispatcher thread drains the outbox through a token bucket per sender number, retries
+# transient failures with exponential backoff and moves messages that keep failing (or that
+# Twilio rejects outright) to the dead-letter state, visible at /admin/outbox. Several processes
+# may share OUTBOX_DB_PATH: an inflight item is only reclaimed once it has been inflight longer
+# than OUTBOX_VISIBILITY_TIMEOUT, i.e. after the process that claimed it died. The dispatcher
+# starts at import (end of file), so messages left over from before a restart are sent at once.
+OUTBOX_DB_PATH = os.getenv("OUTBOX_DB_PATH", str(Path(__file__).parent / "outbox.db"))
+OUTBOX_RATE_PER_SECOND = float(os.getenv("OUTBOX_RATE_PER_SECOND", "10"))
+OUTBOX_BURST = int(os.getenv("OUTBOX_BURST", "10"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "6"))
+OUTBOX_BACKOFF_SECONDS = float(os.getenv("OUTBOX_BACKOFF_SECONDS", "2"))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "5"))
+OUTBOX_VISIBILITY_TIMEOUT = float(os.getenv("OUTBOX_VISIBILITY_TIMEOUT", "300"))
+
+class DurableQueue:
+    """
+    Small persistent work queue on SQLite. Items move pending → inflight → done, or back to
+    pending with a later next_attempt_at on retry(), or to dead. Items left inflight longer than
+    `visibility_timeout` seconds (their process crashed) can be claimed again.
+    """
+    def __init__(self, path, table, visibility_timeout=OUTBOX_VISIBILITY_TIMEOUT):
+        self.table = table
+        self.visibility_timeout = visibility_timeout
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )""")
+        self._db.execute(f"CREATE INDEX IF NOT EXISTS {table}_due ON {table} (status, next_attempt_at)")
+
+    def put(self, payload):
+        now = time.time()
+        with self._lock:
+            cur = self._db.execute(
+                f"INSERT INTO {self.table} (payload, next_attempt_at, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                (json.dumps(payload), now, now, now))
+            return cur.lastrowid
+
+    def claim(self, limit=50):
+        """Mark up to `limit` due (or abandoned inflight) items inflight and return them as dicts, oldest first."""
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._db.execute(
+                    f"SELECT * FROM {self.table} WHERE (status = 'pending' AND next_attempt_at <= ?) "
+                    f"OR (status = 'inflight' AND updated_at <= ?) ORDER BY id LIMIT ?",
+                    (now, now - self.visibility_timeout, limit)).fetchall()
+                self._db.executemany(f"UPDATE {self.table} SET status = 'inflight', updated_at = ? WHERE id = ?",
+                                     [(now, row['id']) for row in rows])
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return [dict(row, payload=json.loads(row['payload'])) for row in rows]
+
+    def _set(self, item_id, sql, args=()):
+        with self._lock:
+            self._db.execute(f"UPDATE {self.table} SET {sql}, updated_at = ? WHERE id = ?", (*args, time.time(), item_id))
+
+    def ack(self, item_id):
+        self._set(item_id, "status = 'done'")
+
+    def retry(self, item_id, error, delay):
+        self._set(item_id, "status = 'pending', attempts = attempts + 1, last_error = ?, next_attempt_at = ?",
+                  (str(error), time.time() + delay))
+
+    def dead(self, item_id, error):
+        self._set(item_id, "status = 'dead', attempts = attempts + 1, last_error = ?", (str(error),))
+
+    def requeue(self, item_id):
+        """Send a dead item back for another round of attempts."""
+        with self._lock:
+            cur = self._db.execute(
+                f"UPDATE {self.table} SET status = 'pending', attempts = 0, next_attempt_at = ?, updated_at = ? "
+                f"WHERE id = ? AND status = 'dead'", (time.time(), time.time(), item_id))
+            return cur.rowcount > 0
+
+    def next_due_in(self):
+        """Seconds until the next pending (or abandoned inflight) item is due (None if there is none)."""
+        with self._lock:
+            row = self._db.execute(
+                f"SELECT MIN(CASE status WHEN 'pending' THEN next_attempt_at ELSE updated_at + ? END) "
+                f"FROM {self.table} WHERE status IN ('pending', 'inflight')", (self.visibility_timeout,)).fetchone()
+        return None if row[0] is None else max(0.0, row[0] - time.time())
+
+    def counts(self):
+        with self._lock:
+            rows = self._db.execute(f"SELECT status, COUNT(*) FROM {self.table} GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+    def dead_letters(self, limit=100):
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT * FROM {self.table} WHERE status = 'dead' ORDER BY updated_at DESC LIMIT ?", (limit,)).fetchall()
+        return [dict(row, payload=json.loads(row['payload'])) for row in rows]
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def wait_time(self):
+        """Take a token if one is available (returns 0), otherwise return seconds until one is."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+outbox = DurableQueue(OUTBOX_DB_PATH, 'outbox')
+_sender_buckets = {}
+_outbox_wakeup = threading.Event()
+_outbox_started = False
+_outbox_start_lock = threading.Lock()
+
+def send_whatsapp(to, body, media_url=None, from_=None):
+    """Queue a bot-initiated WhatsApp message for durable, rate-limited delivery."""
+    message = {'from_': from_ or TWILIO_NUMBER, 'to': to, 'body': body}
+    if media_url:
+        message['media_url'] = list(media_url)
+    message_id = outbox.put(message)
+    start_outbox_dispatcher()
+    _outbox_wakeup.set()
+    return message_id
+
+def start_outbox_dispatcher():
+    global _outbox_started
+    with _outbox_start_lock:
+        if _outbox_started:
+            return
+        threading.Thread(target=_outbox_dispatcher, name="outbox-dispatcher", daemon=True).start()
+        _outbox_started = True
+    log.info("outbox_dispatcher_started path=%s rate=%s burst=%d", OUTBOX_DB_PATH, OUTBOX_RATE_PER_SECOND, OUTBOX_BURST)
+
+def _is_permanent_twilio_error(e):
+    # 4xx other than 429 (bad number, unapproved template, ...) will not succeed on retry
+    return isinstance(e, TwilioRestException) and e.status is not None and 400 <= e.status < 500 and e.status != 429
+
+def deliver_outbox_item(item):
+    message = item['payload']
+    bucket = _sender_buckets.setdefault(message['from_'], TokenBucket(OUTBOX_RATE_PER_SECOND, OUTBOX_BURST))
+    delay = bucket.wait_time()
+    while delay:
+        time.sleep(delay)
+        delay = bucket.wait_time()
+    try:
+        twilio_client.messages.create(**message)
+        outbox.ack(item['id'])
+    except Exception as e:
+        attempts = item['attempts'] + 1
+        if _is_permanent_twilio_error(e) or attempts >= OUTBOX_MAX_ATTEMPTS:
+            outbox.dead(item['id'], e)
+            log.error("outbox_dead id=%s to=%s attempts=%d error=%s", item['id'], message['to'], attempts, e)
+        else:
+            backoff = OUTBOX_BACKOFF_SECONDS * (2 ** item['attempts']) * random.uniform(0.8, 1.2)
+            outbox.retry(item['id'], e, backoff)
+            log.warning("outbox_retry id=%s to=%s attempts=%d backoff=%.1fs error=%s",
+                        item['id'], message['to'], attempts, backoff, e)
 
-    welcome = org.data.get('welcome_message', 'Welcome! How can I help?')
-    msg.body(f"🎉 *{org.data['name']}*\n{welcome}\nType 'events' to see available tickets.")
-    if org.data.get('logo_url'):
-        msg.media(org.data['logo_url'])
+def _outbox_dispatcher():
+    while True:
+        try:
+            items = outbox.claim()
+            for item in items:
+                deliver_outbox_item(item)
+            if items:
+                continue
+            due_in = outbox.next_due_in()
+            _outbox_wakeup.wait(OUTBOX_POLL_SECONDS if due_in is None else min(due_in, OUTBOX_POLL_SECONDS))
+            _outbox_wakeup.clear()
+        except Exception:
+            log.exception("outbox_dispatcher_failed")
+            time.sleep(OUTBOX_POLL_SECONDS)
+
+
+# ====== TICKET ISSUANCE ======
+# A paid transaction for quantity N issues N tickets at once: one bulk insert and one batch QR
+# render that warms the /qr cache, then the QR URLs are packed into as few WhatsApp messages as
+# TWILIO_MAX_MEDIA_PER_MESSAGE allows (WhatsApp itself accepts one media item per message).
+# Ticket QRs are served by /qr/<ticket_code>.png rather than uploaded to storage; codes that are
+# neither validly signed nor in the tickets table get a 404 and are never rendered.
+TWILIO_MAX_MEDIA_PER_MESSAGE = int(os.getenv("TWILIO_MAX_MEDIA_PER_MESSAGE", "1"))
+QR_CACHE_SIZE = int(os.getenv("QR_CACHE_SIZE", "2048"))
+# Bump when the rendering parameters change so clients drop old ETags
+TICKET_QR_VERSION = "1"
+TICKET_CODE_PATTERN = re.compile(r'^[A-Za-z0-9_.-]{4,200}$')
+
+_ticket_qr_cache = LRUCache(maxsize=QR_CACHE_SIZE)
+_ticket_qr_cache_lock = threading.Lock()
+
+def ticket_verify_url(ticket_code):
+    return f"{PUBLIC_BASE_URL}/verify/{ticket_code}"
+
+def ticket_qr_url(ticket_code):
+    return f"{PUBLIC_BASE_URL}/qr/{ticket_code}.png"
+
+def ticket_qr_etag(ticket_code):
+    return hashlib.sha256(f"{TICKET_QR_VERSION}:{ticket_verify_url(ticket_code)}".encode()).hexdigest()[:32]
+
+def warm_ticket_qr_cache(ticket_codes):
+    pngs = render_qr_batch([ticket_verify_url(code) for code in ticket_codes], box_size=5, border=2)
+    with _ticket_qr_cache_lock:
+        for code, png in zip(ticket_codes, pngs):
+            _ticket_qr_cache[code] = png
+
+def ticket_code_exists(ticket_code):
+    """Signed codes are checked by their HMAC; plain codes (or any code without a signing key) by a tickets lookup."""
+    if TICKET_SIGNING_KEY and is_signed_ticket_code(ticket_code):
+        return decode_signed_ticket_code(ticket_code) is not None
+    result = supabase.table('tickets').select('ticket_code').eq('ticket_code', ticket_code).limit(1).execute()
+    return bool(result.data)
+
+def get_ticket_qr_png(ticket_code):
+    """PNG for a ticket's QR, or None if there is no such ticket (unknown codes are never rendered or cached)."""
+    with _ticket_qr_cache_lock:
+        png = _ticket_qr_cache.get(ticket_code)
+    if png is None:
+        if not ticket_code_exists(ticket_code):
+            return None
+        png = render_qr(ticket_verify_url(ticket_code), box_size=5, border=2)
+        with _ticket_qr_cache_lock:
+            _ticket_qr_cache[ticket_code] = png
+    return png
+
+@app.route('/qr/<ticket_code>.png')
+def ticket_qr_image(ticket_code):
+    """Ticket QR, rendered from the code alone, so responses are immutable and cacheable."""
+    if not TICKET_CODE_PATTERN.match(ticket_code):
+        return "Invalid ticket code", 404
+    etag = ticket_qr_etag(ticket_code)
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': 'public, max-age=31536000, immutable'}
+    if etag in request.if_none_match:
+        return '', 304, headers
+    png = get_ticket_qr_png(ticket_code)
+    if png is None:
+        return "Invalid ticket code", 404
+    return png, 200, {**headers, 'Content-Type': 'image/png'}
+
+# ====== SIGNED TICKET CODES ======
+# With TICKET_SIGNING_KEY set, new tickets get self-verifying codes:
+#   S1.<base64url "event_id:ticket_type_id:serial">.<base64url truncated HMAC-SHA256>
+# The gate can reject forged codes and show the event/ticket type with no per-scan database call
+# (names come from a long-lived cache); the database is only written when a scan is recorded.
+# Plain TKT-xxxxxxxx codes keep working through the database path.
+TICKET_SIGNING_KEY = os.getenv("TICKET_SIGNING_KEY")
+SIGNED_CODE_PREFIX = "S1"
+SIGNATURE_BYTES = 12
+GATE_CACHE_TTL = int(os.getenv("GATE_CACHE_TTL", "600"))
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+def _ticket_signature(payload):
+    return hmac.new(TICKET_SIGNING_KEY.encode(), f"{SIGNED_CODE_PREFIX}.{payload}".encode(), hashlib.sha256).digest()[:SIGNATURE_BYTES]
+
+def mint_ticket_code(event_id, ticket_type_id):
+    if not TICKET_SIGNING_KEY:
+        return f"TKT-{uuid.uuid4().hex[:8].upper()}"
+    payload = _b64encode(f"{event_id}:{ticket_type_id}:{secrets.token_hex(5)}".encode())
+    return f"{SIGNED_CODE_PREFIX}.{payload}.{_b64encode(_ticket_signature(payload))}"
+
+def is_signed_ticket_code(ticket_code):
+    return ticket_code.startswith(SIGNED_CODE_PREFIX + ".")
+
+def decode_signed_ticket_code(ticket_code):
+    """Return {'event_id', 'ticket_type_id', 'serial'} for an authentic signed code, else None."""
+    if not TICKET_SIGNING_KEY:
+        return None
+    try:
+        prefix, payload, signature = ticket_code.split('.')
+        if prefix != SIGNED_CODE_PREFIX or not hmac.compare_digest(_b64decode(signature), _ticket_signature(payload)):
+            return None
+        event_id, ticket_type_id, serial = _b64decode(payload).decode('ascii').split(':')
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        return None
+    return {'event_id': event_id, 'ticket_type_id': ticket_type_id, 'serial': serial}
+
+_gate_ticket_types = LoadingCache(maxsize=4096, ttl=GATE_CACHE_TTL)
+
+def get_gate_ticket_type(event_id, ticket_type_id):
+    """Ticket type name plus its event's name/date/location, cached for the gate."""
+    def load():
+        result = supabase.table('ticket_types') \
+            .select('name, event_id, event:events(name, date, location)') \
+            .eq('id', ticket_type_id) \
+            .limit(1) \
+            .execute()
+        row = result.data[0] if result.data else None
+        if row is None or str(row['event_id']) != str(event_id):
+            return None
+        return row
+    return _gate_ticket_types.get((str(event_id), str(ticket_type_id)), load)
+
+def signed_ticket_view(ticket_code, claims):
+    """
+    The verify-page ticket dict for a signed code, without a tickets lookup (None if unknown type).
+    Unless this process recorded the scan, the code is only known to be authentic ('authentic'),
+    not unscanned: /scan/<ticket_code> settles that on admit.
+    """
+    ticket_type = get_gate_ticket_type(claims['event_id'], claims['ticket_type_id'])
+    if ticket_type is None:
+        return None
+    scan = recent_scan(ticket_code)
+    if scan:
+        return {'ticket_code': ticket_code, 'status': 'scanned', **scan}
+    return {
+        'ticket_code': ticket_code,
+        'status': 'authentic',
+        'event': ticket_type['event'],
+        'ticket_type': {'name': ticket_type['name']},
+        'buyer': {'name': None}
+    }
 
-    print(f"\n>>> 📤 BOT REPLY TO {raw_phone}:")
-    print("──────────────────────────────────────")
-    print(reply_text)
-    print("──────────────────────────────────────\n")
 
-def send_ticket(whatsapp_id):
+def send_ticket(whatsapp_id, payment_ref):
+    """
+    Issue the tickets for a paid transaction and deliver them. Tickets already issued for
+    `payment_ref` (by an issuer that died before confirming) are re-delivered, not minted again.
+    """
     tx = supabase.table('transactions') \
-        .select('event_id, ticket_type_id') \
+        .select('organizer_id, event_id, ticket_type_id, quantity') \
         .eq('whatsapp_id', whatsapp_id) \
         .eq('status', 'paid') \
-        .order('created_at', desc=True) \
+        .eq('payment_ref', payment_ref) \
         .limit(1) \
         .execute()
 
     if not tx.data:
-        print("❌ No paid transaction found for", whatsapp_id)
+        log.warning("send_ticket_no_paid_transaction whatsapp_id=%s ref=%s", whatsapp_id, payment_ref)
+        return
+
+    existing = supabase.table('tickets').select('ticket_code').eq('payment_ref', payment_ref).execute()
+    if existing.data:
+        log.info("tickets_already_issued ref=%s count=%d", payment_ref, len(existing.data))
+        deliver_tickets(whatsapp_id, [t['ticket_code'] for t in existing.data])
         return
 
     event_id = tx.data[0]['event_id']
     ticket_type_id = tx.data[0]['ticket_type_id']
-    ticket_code = f"TKT-{uuid.uuid4().hex[:8].upper()}"
-    
-    supabase.table('tickets').insert({
+    quantity = max(1, int(tx.data[0].get('quantity') or 1))
+    ticket_codes = [mint_ticket_code(event_id, ticket_type_id) for _ in range(quantity)]
+
+    supabase.table('tickets').insert([{
         'whatsapp_id': whatsapp_id,
         'ticket_code': ticket_code,
         'event_id': event_id,
         'ticket_type_id': ticket_type_id,
+        'payment_ref': payment_ref,
         'quantity': 1,
         'status': 'issued'
-    }).execute()
+    } for ticket_code in ticket_codes]).execute()
+    # Issuing a ticket changes inventory shown in the `events` catalog
+    if tx.data[0].get('organizer_id'):
+        invalidate_event_catalog(tx.data[0]['organizer_id'])
+    invalidate_gate_manifest(event_id)
 
     supabase_service.table('user_carts').delete().eq('whatsapp_id', whatsapp_id).execute()
-    print(f">>> 🧹 Cart deleted for {whatsapp_id}")
-
-    qr_link = f"https://your-ngrok-url/verify/{ticket_code}"
-    qr = qrcode.QRCode(box_size=5, border=2)
-    qr.add_data(qr_link)
-    qr.make(fit=True)
-    img = qr.make_image(fill='black', back_color='white')
-    buf = BytesIO()
-    img.save(buf, format="PNG")
-    buf.seek(0)
-    file_name = f"tickets/{ticket_code}.png"
-    
+    log.debug("cart_deleted whatsapp_id=%s", whatsapp_id)
+
+    deliver_tickets(whatsapp_id, ticket_codes)
+
+def resend_tickets(whatsapp_id):
+    """
+    Re-deliver the tickets of the buyer's latest paid transaction; never issues new ones.
+    Returns the number of tickets re-sent, or None if the buyer has no paid transaction.
+    """
+    tx = supabase.table('transactions') \
+        .select('payment_ref, event_id, ticket_type_id, quantity') \
+        .eq('whatsapp_id', whatsapp_id) \
+        .eq('status', 'paid') \
+        .order('created_at', desc=True) \
+        .limit(1) \
+        .execute()
+    if not tx.data:
+        return None
+    tx = tx.data[0]
+    tickets = supabase.table('tickets').select('ticket_code').eq('payment_ref', tx['payment_ref']).execute()
+    if not tickets.data:
+        # Tickets issued before they carried their payment_ref
+        tickets = supabase.table('tickets') \
+            .select('ticket_code') \
+            .eq('whatsapp_id', whatsapp_id) \
+            .eq('event_id', tx['event_id']) \
+            .eq('ticket_type_id', tx['ticket_type_id']) \
+            .order('id', desc=True) \
+            .limit(max(1, int(tx.get('quantity') or 1))) \
+            .execute()
+    ticket_codes = [t['ticket_code'] for t in tickets.data or []]
+    if ticket_codes:
+        deliver_tickets(whatsapp_id, ticket_codes, resend=True)
+    return len(ticket_codes)
+
+def deliver_tickets(whatsapp_id, ticket_codes, resend=False):
+    """Queue the QR codes for `ticket_codes` on the outbox, TWILIO_MAX_MEDIA_PER_MESSAGE per message."""
+    quantity = len(ticket_codes)
     try:
-        supabase_service.storage.from_("ticket-qr").upload(file_name, buf.getvalue())
-        qr_url = supabase_service.storage.from_("ticket-qr").get_public_url(file_name)
-        twilio_client.messages.create(
-            from_=TWILIO_NUMBER,
-            body="🎉 PAYMENT CONFIRMED!\nHere's your e-ticket. Show this QR at the event gate:",
-            media_url=[qr_url],
-            to=whatsapp_id
-        )
-        print(f"✅ Real ticket {ticket_code} sent to {whatsapp_id}")
+        # Twilio fetches the media right away; pre-rendering makes those fetches cache hits
+        warm_ticket_qr_cache(ticket_codes)
+    except Exception as e:
+        log.warning("ticket_qr_warm_failed ticket_codes=%s error=%s", ",".join(ticket_codes), e)
+
+    try:
+        qr_urls = [ticket_qr_url(code) for code in ticket_codes]
+        per_message = max(1, TWILIO_MAX_MEDIA_PER_MESSAGE)
+        batches = [qr_urls[i:i + per_message] for i in range(0, len(qr_urls), per_message)]
+        heading = "🎟️ Here you go again!" if resend else "🎉 PAYMENT CONFIRMED!"
+        bodies = [f"{heading}\nHere's your e-ticket. Show this QR at the event gate:"
+                  if quantity == 1 else
+                  f"{heading}\nHere are your {quantity} e-tickets. Show one QR per guest at the event gate:"]
+        first = 1 + per_message
+        for media in batches[1:]:
+            last = first + len(media) - 1
+            bodies.append(f"🎟️ Ticket {first} of {quantity}" if first == last else f"🎟️ Tickets {first}-{last} of {quantity}")
+            first = last + 1
+        for body, media in zip(bodies, batches):
+            send_whatsapp(whatsapp_id, body, media_url=media)
+        log.info("tickets_queued count=%d ticket_codes=%s whatsapp_id=%s resend=%s", quantity, ",".join(ticket_codes), whatsapp_id, resend)
     except Exception as e:
-        print(f"❌ Failed to send real ticket: {str(e)}")
+        log.error("ticket_send_failed ticket_codes=%s whatsapp_id=%s error=%s", ",".join(ticket_codes), whatsapp_id, e)
 
 def cleanup_expired_carts():
     """Delete carts that have expired (including locked ones)"""
@@ -422,9 +1405,86 @@ def cleanup_expired_carts():
         .execute()
 
 
-# Cache health for 60 seconds to avoid hammering APIs
-@lru_cache(maxsize=2)
-def is_flutterwave_healthy():
+# ====== GATEWAY HEALTH ======
+# One circuit breaker per gateway. GATEWAY_FAILURE_THRESHOLD consecutive failed payment-link calls
+# open it; after GATEWAY_RESET_TIMEOUT seconds it lets one trial call through (half-open) and
+# closes when that call succeeds. A monitor thread also probes each gateway every
+# GATEWAY_HEALTH_INTERVAL seconds: as many consecutive failed probes open the breaker too, but
+# probe results are counted apart from call results, so a passing probe never clears call
+# failures or closes a breaker. The webhook only reads breaker state, so checking gateway health
+# costs nothing on the request path.
+GATEWAY_HEALTH_INTERVAL = int(os.getenv("GATEWAY_HEALTH_INTERVAL", "30"))
+GATEWAY_FAILURE_THRESHOLD = int(os.getenv("GATEWAY_FAILURE_THRESHOLD", "3"))
+GATEWAY_RESET_TIMEOUT = int(os.getenv("GATEWAY_RESET_TIMEOUT", "60"))
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, name, failure_threshold=GATEWAY_FAILURE_THRESHOLD, reset_timeout=GATEWAY_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.probe_failures = 0
+        self.opened_at = 0.0
+        self.trial_started_at = None
+        self._lock = threading.Lock()
+
+    def available(self):
+        """Whether calls could go through now (read-only; callers take a slot with allow())."""
+        return self.state == self.CLOSED or time.monotonic() - self.opened_at >= self.reset_timeout
+
+    def allow(self):
+        """Take permission for one call. While half-open only one trial call is let through at a time."""
+        if self.state == self.CLOSED:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.OPEN and now - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.trial_started_at = None
+            if self.state != self.HALF_OPEN:
+                return False
+            # A trial that never reported back is replaced after reset_timeout
+            if self.trial_started_at is not None and now - self.trial_started_at < self.reset_timeout:
+                return False
+            self.trial_started_at = now
+            return True
+
+    def _open(self):
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.trial_started_at = None
+        log.warning("gateway_breaker_opened gateway=%s failures=%d probe_failures=%d", self.name, self.failures, self.probe_failures)
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                log.info("gateway_breaker_closed gateway=%s", self.name)
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trial_started_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                self._open()
+
+    def record(self, ok):
+        self.record_success() if ok else self.record_failure()
+
+    def record_probe(self, ok):
+        """Monitor probe outcome, counted apart from call outcomes."""
+        with self._lock:
+            self.probe_failures = 0 if ok else self.probe_failures + 1
+            if self.state == self.CLOSED and self.probe_failures >= self.failure_threshold:
+                self._open()
+
+GATEWAY_BREAKERS = {name: CircuitBreaker(name) for name in ('flutterwave', 'paystack')}
+
+def probe_flutterwave():
     try:
         resp = http_client.get(
             "https://api.flutterwave.com/v3/ping",
@@ -433,11 +1493,10 @@ def is_flutterwave_healthy():
         )
         return resp.status_code == 200 and resp.json().get("status") == "success"
     except Exception as e:
-        print(f"⚠️ Flutterwave health check failed: {e}")
+        log.warning("gateway_health_check_failed gateway=flutterwave error=%s", e)
         return False
 
-@lru_cache(maxsize=2)
-def is_paystack_healthy():
+def probe_paystack():
     try:
         resp = http_client.get(
             "https://api.paystack.co/dedicated_account",
@@ -447,12 +1506,38 @@ def is_paystack_healthy():
         # Paystack returns 401 on auth failure, but 200+ on healthy
         return resp.status_code < 500
     except Exception as e:
-        print(f"⚠️ Paystack health check failed: {e}")
+        log.warning("gateway_health_check_failed gateway=paystack error=%s", e)
         return False
 
-def clear_health_cache():
-    is_flutterwave_healthy.cache_clear()
-    is_paystack_healthy.cache_clear()
+GATEWAY_PROBES = {'flutterwave': probe_flutterwave, 'paystack': probe_paystack}
+
+_gateway_monitor_started = False
+_gateway_monitor_lock = threading.Lock()
+
+def start_gateway_monitor():
+    global _gateway_monitor_started
+    if _gateway_monitor_started:
+        return
+    with _gateway_monitor_lock:
+        if _gateway_monitor_started:
+            return
+        threading.Thread(target=_gateway_monitor, name="gateway-monitor", daemon=True).start()
+        _gateway_monitor_started = True
+    log.info("gateway_monitor_started interval=%ds", GATEWAY_HEALTH_INTERVAL)
+
+def _gateway_monitor():
+    while True:
+        for name, probe in GATEWAY_PROBES.items():
+            GATEWAY_BREAKERS[name].record_probe(probe())
+        time.sleep(GATEWAY_HEALTH_INTERVAL)
+
+def is_flutterwave_healthy():
+    start_gateway_monitor()
+    return GATEWAY_BREAKERS['flutterwave'].available()
+
+def is_paystack_healthy():
+    start_gateway_monitor()
+    return GATEWAY_BREAKERS['paystack'].available()
 
 
 @app.route('/organizer/<org_code>/setup', methods=['GET', 'POST'])
@@ -483,6 +1568,8 @@ def organizer_setup(org_code):
             'ticket_sales_open': True  # Enable sales after setup
         }
         supabase.table('events').update(update_data).eq('id', event_data['id']).execute()
+        invalidate_organizer(org['id'], org['code'])
+        invalidate_event_catalog(org['id'])
 
         # Handle poster upload (if provided)
         if 'event_poster' in request.files:
@@ -498,7 +1585,7 @@ def organizer_setup(org_code):
                     poster_url = supabase_service.storage.from_("event-posters").get_public_url(filename)
                     supabase.table('events').update({'event_image_url': poster_url}).eq('id', event_data['id']).execute()
                 except Exception as e:
-                    print(f"⚠️ Poster upload failed: {e}")
+                    log.warning("poster_upload_failed org_code=%s error=%s", org_code, e)
                     # Don't fail the whole setup — just skip the image
 
         return redirect(url_for('organizer_dashboard', org_code=org_code))
@@ -511,876 +1598,863 @@ def organizer_setup(org_code):
     )
 
 
+# ====== ASYNC WEBHOOK PROCESSING ======
+# With ASYNC_WEBHOOK=true the /webhook route only enqueues the message and acks Twilio with an
+# empty TwiML response; a bounded pool of worker threads builds the reply and sends it through
+# the Twilio REST API. Each sender is pinned to one worker queue, so their messages stay in order.
+# The queues are unbounded by default (WEBHOOK_QUEUE_SIZE=0), so every inbound message is kept.
+# With a bound set, a message that finds its queue full for WEBHOOK_ENQUEUE_TIMEOUT seconds gets a
+# 503 rather than being handled inline ahead of the sender's queued ones. Twilio does not retry
+# inbound messages on 5xx by default: only set a bound together with connection-override retries
+# on the webhook URL (e.g. `https://.../webhook#rc=3&rp=5xx`), or those messages are lost.
+ASYNC_WEBHOOK = os.getenv("ASYNC_WEBHOOK", "false").lower() == "true"
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "0"))
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.getenv("WEBHOOK_ENQUEUE_TIMEOUT", "2"))
+
+_webhook_queues = []
+_webhook_queues_lock = threading.Lock()
+
+def start_webhook_workers():
+    """Start the webhook worker pool once (safe to call from any request thread)."""
+    with _webhook_queues_lock:
+        if _webhook_queues:
+            return
+        for i in range(WEBHOOK_WORKERS):
+            q = queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+            threading.Thread(target=_webhook_worker, args=(q,), name=f"webhook-worker-{i}", daemon=True).start()
+            _webhook_queues.append(q)
+    log.info("webhook_workers_started workers=%d queue_size=%d", WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+
+def enqueue_incoming_message(sender, incoming_msg):
+    """
+    Hand a message to the sender's worker. Returns False only if WEBHOOK_QUEUE_SIZE bounds the
+    queues and this one stays full for WEBHOOK_ENQUEUE_TIMEOUT seconds; the message must then be
+    redelivered, not handled inline.
+    """
+    start_webhook_workers()
+    q = _webhook_queues[zlib.crc32(sender.encode('utf-8')) % len(_webhook_queues)]
+    try:
+        q.put((sender, incoming_msg), timeout=WEBHOOK_ENQUEUE_TIMEOUT)
+        return True
+    except queue.Full:
+        log.warning("webhook_queue_full whatsapp_id=%s", sender)
+        return False
+
+def _webhook_worker(q):
+    while True:
+        sender, incoming_msg = q.get()
+        try:
+            # A fresh app context per message gives request_cached/g the same per-message scope as a request
+            with app.app_context():
+                twiml = handle_incoming_message(incoming_msg, sender)
+            send_twiml_reply(sender, twiml)
+        except Exception:
+            log.exception("async_webhook_failed whatsapp_id=%s", sender)
+        finally:
+            q.task_done()
+
+def send_twiml_reply(to, twiml):
+    """Queue the <Message> elements of a TwiML reply on the outbox."""
+    root = ET.fromstring(twiml)
+    for message in root.iter('Message'):
+        body = ''.join(b.text or '' for b in message.iter('Body'))
+        media = [m.text for m in message.iter('Media') if m.text]
+        if not body and not media:
+            continue
+        send_whatsapp(to, body, media_url=media)
+
+
 @app.route("/webhook", methods=['POST'])
 def whatsapp_webhook():
-    try: 
-        incoming_msg = request.values.get('Body', '').strip()
-        sender = request.values.get('From', '')
-        print(f"\n>>> 📥 INCOMING MESSAGE: '{incoming_msg}' FROM: {sender}")
-        resp = MessagingResponse()
-        msg = resp.message()
-
-        # Normalize phone
-        whatsapp_id = sender
-
-        raw_phone = request.values.get('From', '')
-        clean_phone = normalize_phone(raw_phone)
-        print(f">>> 📱 raw_phone: {raw_phone} | clean_phone: {clean_phone}")
-
-        # Get user profile
-        user = get_user_profile(clean_phone)
-        user_orgs = get_user_organizers(raw_phone)
-        print(f">>> 👤 User: {user.get('name', 'Unknown')} | Orgs count: {len(user_orgs)}")
-        print(f">>> 🏢 Organizers: {[org['name'] for org in user_orgs]}")
-
-        # ================================
-        # CHECK FOR INCOMPLETE SETUP (once per session)
-        # ================================
-        incomplete_event = get_incomplete_organizer_event(raw_phone)
-        if incomplete_event:
-            # Check active session
-            session = supabase.table('user_sessions').select('*').eq('whatsapp_id', raw_phone).execute()
-            session_data = {}
-            session_id = None
-
-            if session.data:
-                sess = session.data[0]
-                session_data = sess.get('data') or {}
-                session_id = sess['id']
-                if not session_data.get('incomplete_setup_reminder_shown'):
-                    session_data['incomplete_setup_reminder_shown'] = True
-                    supabase.table('user_sessions').update({
-                        'data': session_data
-                    }).eq('id', session_id).execute()
-                else:
-                    incomplete_event = None  # skip reminder
-            else:
-                # Create session and mark reminder shown
-                supabase.table('user_sessions').upsert({
-                    'whatsapp_id': raw_phone,
-                    'step': 'active',
-                    'data': {'incomplete_setup_reminder_shown': True},
-                    'expires_at': (datetime.now(pytz.utc) + timedelta(minutes=30)).isoformat()
-                }).execute()
+    incoming_msg = request.values.get('Body', '').strip()
+    sender = request.values.get('From', '')
+    if ASYNC_WEBHOOK:
+        if not enqueue_incoming_message(sender, incoming_msg):
+            # Handling it here could overtake the sender's queued messages
+            return "Busy, retry later", 503, {'Retry-After': '5'}
+        return str(MessagingResponse())
+    return handle_incoming_message(incoming_msg, sender)
+
+class MessageContext:
+    """Everything an intent handler needs about one inbound WhatsApp message."""
+    def __init__(self, incoming_msg, sender):
+        self.incoming_msg = incoming_msg
+        self.incoming_lower = incoming_msg.lower().strip()
+        self.whatsapp_id = sender
+        self.raw_phone = sender
+        self.clean_phone = normalize_phone(sender)
+        self.resp = MessagingResponse()
+        self.msg = self.resp.message()
+        self.user = get_user_profile(self.clean_phone)
+        self.user_orgs = get_user_organizers(self.raw_phone)
+        self.incomplete_event = None
+        self.intent = None
+
+    @property
+    def selected_org(self):
+        """The organizer this message acts on: the only one, or (for `events`) the first with events."""
+        if len(self.user_orgs) == 1:
+            return self.user_orgs[0]
+        if self.user_orgs and self.incoming_lower == "events":
+            return next((org for org in self.user_orgs if org['active_events_count'] > 0), self.user_orgs[0])
+        return None
 
-        # ================================
-        # HIGH-PRIORITY COMMANDS (bypass reminder)
-        # ================================
-        if incoming_msg.lower().startswith("attend "):
-            org_code = incoming_msg.split(" ", 1)[1].strip().upper()
-            handle_attend_command(whatsapp_id, org_code, msg)
-            return str(resp)
-
-        refund_keywords = ['refund', 'return ticket', 'cancel my ticket', 'get money back', 'reimburse']
-        if any(kw in incoming_msg.lower() for kw in refund_keywords):
-            # ... (existing refund logic)
-            return str(resp)
-
-        if any(kw in incoming_msg.lower() for kw in ['my ticket', 'resend', 'send ticket', 'qr code']):
-            send_ticket(whatsapp_id)
-            return str(resp)
-
-        # ================================
-        # SHOW REMINDER IF NEEDED
-        # ================================
-        if incomplete_event:
-            reminder = (
-                f"👋 Welcome back!\n"
-                f"Your event *{incomplete_event['event_name']}* is ready, but **ticket sales are not open**.\n"
-                f"🛠️ Complete setup: {incomplete_event['dashboard_url']}\n\n"
-                "❓ You can also:\n"
-                "🎟️ *Buy tickets* → Type: `attend ORG-CODE`\n"
-                "🎫 *Manage your tickets* → Type: `my ticket`\n"
-                "ℹ️ *Ask for help* → Type: `events`"
-            )
-            msg.body(reminder)
-            return str(resp)
-
-        # ================================
-        # REFUND REQUEST DETECTION
-        # ================================
-        refund_keywords = ['refund', 'return ticket', 'cancel my ticket', 'get money back', 'reimburse']
-        if any(kw in incoming_msg.lower() for kw in refund_keywords):
-            tx = supabase.table('transactions') \
-                .select('organizer_id') \
-                .eq('whatsapp_id', whatsapp_id) \
-                .eq('status', 'paid') \
-                .order('created_at', desc=True) \
-                .limit(1) \
-                .execute()
-            if not tx.data:
-                msg.body("❌ You haven’t purchased any tickets yet.")
-            else:
-                org = supabase.table('organizers') \
-                    .select('name, refundable, contact_for_refunds') \
-                    .eq('id', tx.data[0]['organizer_id']) \
-                    .single() \
-                    .execute()
-                if org.data['refundable']:
-                    contact = org.data.get('contact_for_refunds') or "the organizer directly"
-                    msg.body(f"🎟️ Refunds for *{org.data['name']}* are handled manually.\n\nPlease contact them at: {contact}")
-                else:
-                    msg.body("🚫 Sorry, this event does not offer refunds.")
-            return str(resp)
-
-        # ================================
-        # TICKET RESEND REQUEST
-        # ================================
-        if any(kw in incoming_msg.lower() for kw in ['my ticket', 'resend', 'send ticket', 'qr code']):
-            send_ticket(whatsapp_id)
-            return str(resp)
-
-        # ================================
-        # HANDLE "attend ORG-CODE"
-        # ================================
-        if incoming_msg.lower().startswith("attend "):
-            org_code = incoming_msg.split(" ", 1)[1].strip().upper()
-            handle_attend_command(whatsapp_id, org_code, msg)
-            return str(resp)
-
-        # ================================
-        # NEW ORGANIC USER — SMART WELCOME + ONBOARDING
-        # ================================
-        onboard_triggers = ["i'm an organizer", "create event", "new event", "host event", "sell tickets"]
-
-        if not user_orgs:
-            # Check if user is in the middle of organizer onboarding
-            session = supabase.table('user_sessions').select('*').eq('whatsapp_id', raw_phone).execute()
-            
-            if session.data:
-                # Handle onboarding steps
-                sess = session.data[0]
-                step = sess['step']
-                data = sess['data'] or {}
-
-                incoming_lower = incoming_msg.lower().strip()
-
-                # === HANDLE NAVIGATION COMMANDS FIRST (EARLY EXIT) ===
-                if incoming_lower in ["back", "edit", "go back", "previous"]:
-                    print(f">>> 🔄 USER ACTION: '{incoming_msg}' from {raw_phone} (current step: {step})")
-                    if sess.get('previous_step'):
-                        # Restore previous step
-                        supabase.table('user_sessions').update({
-                            'step': sess['previous_step'],
-                            'previous_step': None  # optional: don't allow infinite back
-                        }).eq('whatsapp_id', raw_phone).execute()
-                        # Send prompt for previous step
-                        if sess['previous_step'] == 'org_name':
-                            reply_text = "What’s your *organizer name*?\n(e.g., Lagos Jazz Fest)"
-                            msg.body(reply_text)
-                            print(f"\n>>> 📤 BOT REPLY TO {raw_phone}:")
-                            print("──────────────────────────────────────")
-                            print(reply_text)
-                            print("──────────────────────────────────────\n")
-                            return str(resp)
-                        elif sess['previous_step'] == 'event_name':
-                            reply_text = "What’s your *event name*?\n(e.g., Summer Night Jazz)"
-                            msg.body(reply_text)
-                            print(f"\n>>> 📤 BOT REPLY TO {raw_phone}:")
-                            print("──────────────────────────────────────")
-                            print(reply_text)
-                            print("──────────────────────────────────────\n")
-                            return str(resp)
-                        elif sess['previous_step'] == 'date':
-                            reply_text = "When is the event? Please send the date in *YYYY-MM-DD* format."
-                            msg.body(reply_text)
-                            print(f"\n>>> 📤 BOT REPLY TO {raw_phone}:")
-                            print("──────────────────────────────────────")
-                            print(reply_text)
-                            print("──────────────────────────────────────\n")
-                            return str(resp)
-                        elif sess['previous_step'] == 'location':
-                            reply_text = "Where is the event happening?\n(e.g., Eko Hotel, Lagos)"
-                            msg.body(reply_text)
-                            print(f"\n>>> 📤 BOT REPLY TO {raw_phone}:")
-                            print("──────────────────────────────────────")
-                            print(reply_text)
-                            print("──────────────────────────────────────\n")
-                            return str(resp)
-                        elif sess['previous_step'] == 'refundable':
-                            reply_text = "Do you allow *refunds*? Reply:\n1. Yes\n2. No"
-                            msg.body(reply_text)
-                            print(f"\n>>> 📤 BOT REPLY TO {raw_phone}:")
-                            print("──────────────────────────────────────")
-                            print(reply_text)
-                            print("──────────────────────────────────────\n")
-                            return str(resp)
-                        elif sess['previous_step'] == 'welcome_message':
-                            reply_text = "Optional: Send a *welcome message* for your attendees (max 200 chars), or type `skip`."
-                            msg.body(reply_text)
-                            print(f"\n>>> 📤 BOT REPLY TO {raw_phone}:")
-                            print("──────────────────────────────────────")
-                            print(reply_text)
-                            print("──────────────────────────────────────\n")
-                            return str(resp)
-                        else:
-                            reply_text = "Let’s start over. What’s your *organizer name*?"
-                            msg.body(reply_text)
-                            print(f"\n>>> 📤 BOT REPLY TO {raw_phone}:")
-                            print("──────────────────────────────────────")
-                            print(reply_text)
-                            print("──────────────────────────────────────\n")
-                            supabase.table('user_sessions').update({'step': 'org_name'}).eq('whatsapp_id', raw_phone).execute()
-                            return str(resp)
-                    else:
-                        # No previous step — restart from org_name
-                        reply_text = "Let’s start over. What’s your *organizer name*?"
-                        msg.body(reply_text)
-                        print(f"\n>>> 📤 BOT REPLY TO {raw_phone}:")
-                        print("──────────────────────────────────────")
-                        print(reply_text)
-                        print("──────────────────────────────────────\n")
-                        supabase.table('user_sessions').update({
-                            'step': 'org_name',
-                            'previous_step': None,
-                            'data': {}
-                        }).eq('whatsapp_id', raw_phone).execute()
-                        return str(resp)
-
-                elif incoming_lower == "cancel":
-                    print(f">>> 🚫 CANCEL REQUEST from {raw_phone} (current step: {step})")
-                    supabase.table('user_sessions').delete().eq('whatsapp_id', raw_phone).execute()
-                    reply_text = "✅ Onboarding cancelled. Reply `I'm an organizer` anytime to restart."
+
+# ====== INTENT DISPATCH ======
+# Intents are registered once at import, in priority order, each with a precompiled matcher:
+# `pattern` (regex searched on the raw message), `keywords` (one alternation regex searched on
+# the lowercased message), `exact` (lowercased message equality) and/or `when` (a predicate on
+# the context). The first intent whose matchers all pass handles the message. Every intent
+# keeps its own count and latency histogram.
+class Intent:
+    def __init__(self, name, handler, pattern=None, keywords=None, exact=None, when=None):
+        self.name = name
+        self.handler = handler
+        self.pattern = re.compile(pattern, re.IGNORECASE) if pattern else None
+        self.keywords = re.compile('|'.join(re.escape(kw) for kw in keywords)) if keywords else None
+        self.exact = frozenset(exact) if exact else None
+        self.when = when
+        self.latency = Histogram()
+
+    def match(self, ctx):
+        """Return a truthy match (the regex match when there is a pattern) or None."""
+        matched = True
+        if self.exact is not None and ctx.incoming_lower not in self.exact:
+            return None
+        if self.keywords is not None and not self.keywords.search(ctx.incoming_lower):
+            return None
+        if self.pattern is not None:
+            matched = self.pattern.search(ctx.incoming_msg)
+            if not matched:
+                return None
+        if self.when is not None and not self.when(ctx):
+            return None
+        return matched
+
+
+INTENTS = []
+
+def intent(name, pattern=None, keywords=None, exact=None, when=None):
+    """Register the decorated handler(ctx, match) as the next intent in priority order."""
+    def register(handler):
+        INTENTS.append(Intent(name, handler, pattern=pattern, keywords=keywords, exact=exact, when=when))
+        return handler
+    return register
+
+def dispatch_intent(ctx):
+    for it in INTENTS:
+        match = it.match(ctx)
+        if not match:
+            continue
+        ctx.intent = it.name
+        start = time.perf_counter()
+        try:
+            it.handler(ctx, match)
+        finally:
+            it.latency.observe(time.perf_counter() - start)
+        break
+    return str(ctx.resp)
+
+def intent_stats():
+    return {it.name: it.latency.snapshot() for it in INTENTS}
+
+ONBOARD_TRIGGERS = re.compile('|'.join(re.escape(t) for t in [
+    "i'm an organizer", "create event", "new event", "host event", "sell tickets"
+]))
+
+
+# ================================
+# HIGH-PRIORITY COMMANDS (bypass reminder)
+# ================================
+@intent('attend', pattern=r'^attend\s+(?P<code>.+)$')
+def handle_attend_intent(ctx, match):
+    handle_attend_command(ctx.whatsapp_id, match.group('code').strip().upper(), ctx.msg)
+
+@intent('refund', keywords=['refund', 'return ticket', 'cancel my ticket', 'get money back', 'reimburse'])
+def handle_refund_intent(ctx, match):
+    msg, whatsapp_id = ctx.msg, ctx.whatsapp_id
+    tx = supabase.table('transactions') \
+        .select('organizer_id') \
+        .eq('whatsapp_id', whatsapp_id) \
+        .eq('status', 'paid') \
+        .order('created_at', desc=True) \
+        .limit(1) \
+        .execute()
+    if not tx.data:
+        msg.body("❌ You haven’t purchased any tickets yet.")
+    else:
+        org = get_organizer_by_id(tx.data[0]['organizer_id'])
+        if org and org['refundable']:
+            contact = org.get('contact_for_refunds') or "the organizer directly"
+            msg.body(f"🎟️ Refunds for *{org['name']}* are handled manually.\n\nPlease contact them at: {contact}")
+        else:
+            msg.body("🚫 Sorry, this event does not offer refunds.")
+
+@intent('resend_ticket', keywords=['my ticket', 'resend', 'send ticket', 'qr code'])
+def handle_resend_intent(ctx, match):
+    sent = resend_tickets(ctx.whatsapp_id)
+    if sent is None:
+        ctx.msg.body("❌ You haven’t purchased any tickets yet.")
+    elif not sent:
+        ctx.msg.body("⏳ Your tickets are still being issued and will arrive shortly.")
+
+# ================================
+# SHOW REMINDER IF NEEDED
+# ================================
+def needs_setup_reminder(ctx):
+    """
+    True once per session for organizers whose event has no ticket types yet.
+    Marks the reminder as shown in the session, so it only fires when it will actually be sent.
+    """
+    incomplete_event = get_incomplete_organizer_event(ctx.raw_phone)
+    if not incomplete_event:
+        return False
+    sess = session_store.get(ctx.raw_phone)
+    if sess:
+        session_data = sess.get('data') or {}
+        if session_data.get('incomplete_setup_reminder_shown'):
+            return False
+        session_data['incomplete_setup_reminder_shown'] = True
+        session_store.update(ctx.raw_phone, data=session_data)
+    else:
+        # Create session and mark reminder shown
+        session_store.update(
+            ctx.raw_phone,
+            step='active',
+            data={'incomplete_setup_reminder_shown': True},
+            expires_at=(datetime.now(pytz.utc) + timedelta(minutes=30)).isoformat()
+        )
+    ctx.incomplete_event = incomplete_event
+    return True
+
+@intent('setup_reminder', when=needs_setup_reminder)
+def handle_setup_reminder_intent(ctx, match):
+    msg = ctx.msg
+    reminder = (
+        f"👋 Welcome back!\n"
+        f"Your event *{ctx.incomplete_event['event_name']}* is ready, but **ticket sales are not open**.\n"
+        f"🛠️ Complete setup: {ctx.incomplete_event['dashboard_url']}\n\n"
+        "❓ You can also:\n"
+        "🎟️ *Buy tickets* → Type: `attend ORG-CODE`\n"
+        "🎫 *Manage your tickets* → Type: `my ticket`\n"
+        "ℹ️ *Ask for help* → Type: `events`"
+    )
+    msg.body(reminder)
+
+# ================================
+# NEW ORGANIC USER — SMART WELCOME + ONBOARDING
+# ================================
+@intent('onboarding', when=lambda ctx: not ctx.user_orgs)
+def handle_onboarding_intent(ctx, match):
+    msg, raw_phone, incoming_msg = ctx.msg, ctx.raw_phone, ctx.incoming_msg
+    clean_phone, incoming_lower = ctx.clean_phone, ctx.incoming_lower
+    # Check if user is in the middle of organizer onboarding
+    sess = session_store.get(raw_phone)
+
+    if sess:
+        # Handle onboarding steps
+        step = sess['step']
+        data = sess['data'] or {}
+
+        # === HANDLE NAVIGATION COMMANDS FIRST (EARLY EXIT) ===
+        if incoming_lower in ["back", "edit", "go back", "previous"]:
+            log.debug("onboarding_back whatsapp_id=%s step=%s", raw_phone, step)
+            if sess.get('previous_step'):
+                # Restore previous step
+                session_store.update(
+                    raw_phone,
+                    step=sess['previous_step'],
+                    previous_step=None  # optional: don't allow infinite back
+                )
+                # Send prompt for previous step
+                if sess['previous_step'] == 'org_name':
+                    reply_text = "What’s your *organizer name*?\n(e.g., Lagos Jazz Fest)"
                     msg.body(reply_text)
-                    print(f"\n>>> 📤 BOT REPLY TO {raw_phone}:")
-                    print("──────────────────────────────────────")
-                    print(reply_text)
-                    print("──────────────────────────────────────\n")
-                    return str(resp)
-
-                # === ONLY NOW HANDLE STEP-SPECIFIC LOGIC ===
-                if step == 'org_name':
-                    data['org_name'] = incoming_msg.strip()
-                    supabase.table('user_sessions').update({
-                        'step': 'event_name',
-                        'previous_step': 'org_name',
-                        'data': data
-                    }).eq('whatsapp_id', raw_phone).execute()
+                    log_bot_reply(raw_phone, reply_text)
+                    return
+                elif sess['previous_step'] == 'event_name':
                     reply_text = "What’s your *event name*?\n(e.g., Summer Night Jazz)"
                     msg.body(reply_text)
-                    print(f"\n>>> 📤 BOT REPLY TO {raw_phone}:")
-                    print("──────────────────────────────────────")
-                    print(reply_text)
-                    print("──────────────────────────────────────\n")
-                    return str(resp)
-
-                elif step == 'event_name':
-                    data['event_name'] = incoming_msg.strip()
-                    supabase.table('user_sessions').update({
-                        'step': 'date',
-                        'previous_step': 'event_name',
-                        'data': data
-                    }).eq('whatsapp_id', raw_phone).execute()
+                    log_bot_reply(raw_phone, reply_text)
+                    return
+                elif sess['previous_step'] == 'date':
                     reply_text = "When is the event? Please send the date in *YYYY-MM-DD* format."
                     msg.body(reply_text)
-                    print(f"\n>>> 📤 BOT REPLY TO {raw_phone}:")
-                    print("──────────────────────────────────────")
-                    print(reply_text)
-                    print("──────────────────────────────────────\n")
-                    return str(resp)
-
-                elif step == 'date':
-                    if not re.match(r'^\d{4}-\d{2}-\d{2}$', incoming_msg.strip()):
-                        reply_text = "❌ Invalid date format. Please use YYYY-MM-DD (e.g., 2025-08-15)"
-                        msg.body(reply_text)
-                        print(f"\n>>> 📤 BOT REPLY TO {raw_phone}:")
-                        print("──────────────────────────────────────")
-                        print(reply_text)
-                        print("──────────────────────────────────────\n")
-                        return str(resp)
-                    try:
-                        event_date = datetime.strptime(incoming_msg.strip(), "%Y-%m-%d").replace(tzinfo=pytz.utc)
-                        if event_date < datetime.now(pytz.utc):
-                            reply_text = "❌ Event date must be in the future. Try again."
-                            msg.body(reply_text)
-                            print(f"\n>>> 📤 BOT REPLY TO {raw_phone}:")
-                            print("──────────────────────────────────────")
-                            print(reply_text)
-                            print("──────────────────────────────────────\n")
-                            return str(resp)
-                    except Exception:
-                        reply_text = "❌ Invalid date. Please use YYYY-MM-DD."
-                        msg.body(reply_text)
-                        print(f"\n>>> 📤 BOT REPLY TO {raw_phone}:")
-                        print("──────────────────────────────────────")
-                        print(reply_text)
-                        print("──────────────────────────────────────\n")
-                        return str(resp)
-                    data['date'] = incoming_msg.strip()
-                    supabase.table('user_sessions').update({
-                        'step': 'location',
-                        'previous_step': 'date',
-                        'data': data
-                    }).eq('whatsapp_id', raw_phone).execute()
+                    log_bot_reply(raw_phone, reply_text)
+                    return
+                elif sess['previous_step'] == 'location':
                     reply_text = "Where is the event happening?\n(e.g., Eko Hotel, Lagos)"
                     msg.body(reply_text)
-                    print(f"\n>>> 📤 BOT REPLY TO {raw_phone}:")
-                    print("──────────────────────────────────────")
-                    print(reply_text)
-                    print("──────────────────────────────────────\n")
-                    return str(resp)
-
-                elif step == 'location':
-                    data['location'] = incoming_msg.strip()
-                    supabase.table('user_sessions').update({
-                        'step': 'refundable',
-                        'previous_step': 'location',
-                        'data': data
-                    }).eq('whatsapp_id', raw_phone).execute()
+                    log_bot_reply(raw_phone, reply_text)
+                    return
+                elif sess['previous_step'] == 'refundable':
                     reply_text = "Do you allow *refunds*? Reply:\n1. Yes\n2. No"
                     msg.body(reply_text)
-                    print(f"\n>>> 📤 BOT REPLY TO {raw_phone}:")
-                    print("──────────────────────────────────────")
-                    print(reply_text)
-                    print("──────────────────────────────────────\n")
-                    return str(resp)
-
-                elif step == 'refundable':
-                    if incoming_msg.strip() in ["1", "Yes", "yes"]:
-                        data['refundable'] = True
-                    elif incoming_msg.strip() in ["2", "No", "no"]:
-                        data['refundable'] = False
-                    else:
-                        reply_text = "Please reply 1 for Yes or 2 for No."
-                        msg.body(reply_text)
-                        print(f"\n>>> 📤 BOT REPLY TO {raw_phone}:")
-                        print("──────────────────────────────────────")
-                        print(reply_text)
-                        print("──────────────────────────────────────\n")
-                        return str(resp)
-                    supabase.table('user_sessions').update({
-                        'step': 'welcome_message',
-                        'previous_step': 'refundable',
-                        'data': data
-                    }).eq('whatsapp_id', raw_phone).execute()
+                    log_bot_reply(raw_phone, reply_text)
+                    return
+                elif sess['previous_step'] == 'welcome_message':
                     reply_text = "Optional: Send a *welcome message* for your attendees (max 200 chars), or type `skip`."
                     msg.body(reply_text)
-                    print(f"\n>>> 📤 BOT REPLY TO {raw_phone}:")
-                    print("──────────────────────────────────────")
-                    print(reply_text)
-                    print("──────────────────────────────────────\n")
-                    return str(resp)
-
-                elif step == 'welcome_message':
-                    if incoming_msg.lower().strip() != "skip":
-                        data['welcome_message'] = incoming_msg.strip()[:200]
-                    else:
-                        data['welcome_message'] = ""
-
-                    # ✅ FINALIZE ORGANIZER CREATION
-                    try:
-                        code = generate_organizer_code(data['event_name'], data['date'])
-                        org_res = supabase_service.table('organizers').insert({
-                            'name': data['org_name'],
-                            'code': code,
-                            'welcome_message': data['welcome_message'],
-                            'refundable': data['refundable'],
-                            'contact_for_refunds': raw_phone,      # for refund messages (raw format)
-                            'phone': clean_phone                   # ✅ NEW: clean phone for dashboard, SMS, etc.
-                        }).execute()
-                        organizer_id = org_res.data[0]['id']
-                        supabase_service.table('events').insert({
-                            'organizer_id': organizer_id,
-                            'name': data['event_name'],
-                            'date': data['date'],
-                            'location': data['location'],
-                            'status': 'active',
-                            'ticket_sales_open': False
-                        }).execute()
-                        supabase.table('user_organizers').upsert(
-                            {
-                                'whatsapp_id': raw_phone,
-                                'organizer_id': org.data['id'],
-                                'organizer_name': org.data['name']  # ✅ ADD THIS
-                            },
-                            on_conflict='whatsapp_id,organizer_id'
-                        ).execute()
-                        supabase.table('user_sessions').delete().eq('whatsapp_id', raw_phone).execute()
-
-                        # === GENERATE QR CODE ===
-                        twilio_wa_number = TWILIO_NUMBER.replace('whatsapp:', '').replace('+', '')
-                        invite_link = f"https://wa.me/{twilio_wa_number}?text=attend%20{code}"
-                        qr = qrcode.QRCode(box_size=8, border=2)
-                        qr.add_data(invite_link)
-                        qr.make(fit=True)
-                        img = qr.make_image(fill='black', back_color='white')
-                        buf = BytesIO()
-                        img.save(buf, format="PNG")
-                        buf.seek(0)
-
-                        # Upload to Supabase Storage
-                        qr_file_name = f"invite_qr/{code}.png"
-                        try:
-                            supabase_service.storage.from_("ticket-qr").upload(
-                                qr_file_name,
-                                buf.getvalue(),
-                                file_options={"content-type": "image/png"}
-                            )
-                            qr_url = supabase_service.storage.from_("ticket-qr").get_public_url(qr_file_name)
-                        except Exception as e:
-                            print(f"⚠️ QR upload failed: {e}")
-                            qr_url = None
-
-                        # === SEND MESSAGE + QR ===
-                        dashboard_url = f"https://46e92286d210.ngrok-free.app/organizer/{code}/setup"
-                        reply_text = (
-                            f"🎉 *Your event is ready!* ✅\n"
-                            f"Organizer code: *{code}*\n\n"
-                            f"📲 Share invite link:\n{invite_link}\n\n"
-                            f"🛠️ **Complete setup** (add tickets, poster, description):\n{dashboard_url}\n\n"
-                            f"✅ Ticket sales will open once you add ticket types!"
-                        )
-                        msg.body(reply_text)
-                        if qr_url:
-                            msg.media(qr_url)  # Attach QR image
-
-                        # Log to console
-                        print(f"\n>>> 📤 BOT REPLY TO {raw_phone}:")
-                        print("──────────────────────────────────────")
-                        print(reply_text)
-                        if qr_url:
-                            print(f"🖼️ QR URL: {qr_url}")
-                        print("──────────────────────────────────────\n")
-
-                        return str(resp)
-
-                    except Exception as e:
-                        print(f"❌ Onboarding save error: {e}")
-                        supabase.table('user_sessions').delete().eq('whatsapp_id', raw_phone).execute()
-                        reply_text = "❌ Sorry, we couldn’t create your event. Please try again."
-                        msg.body(reply_text)
-                        print(f"\n>>> 📤 BOT REPLY TO {raw_phone}:")
-                        print("──────────────────────────────────────")
-                        print(reply_text)
-                        print("──────────────────────────────────────\n")
-                        return str(resp)
-
-            # Not in onboarding → show initial choice
-            if any(trigger in incoming_msg.lower() for trigger in onboard_triggers):
-                supabase.table('user_sessions').upsert({
-                    'whatsapp_id': raw_phone,
-                    'step': 'org_name',
-                    'data': {},
-                    'expires_at': (datetime.now(pytz.utc) + timedelta(minutes=30)).isoformat()
-                }).execute()
-                reply_text = "Great! Let’s set up your event 🎪\n\nWhat’s your *organizer name*?\n(e.g., Lagos Jazz Fest)"
-                msg.body(reply_text)
-                print(f"\n>>> 📤 BOT REPLY TO {raw_phone}:")
-                print("──────────────────────────────────────")
-                print(reply_text)
-                print("──────────────────────────────────────\n")
-                return str(resp)
-
-            # Define the new welcome message
-            welcome_text = (
-                "👋 Welcome to *TicketBot*!\n\n"
-                "Are you here to:\n"
-                "🎟️ *Buy tickets*? → Type: `attend ORG-CODE`\n"
-                "🎪 *Create & sell tickets*? → Reply: `I'm an organizer`"
-            )
-            msg.body(welcome_text)
-            # ✅ LOG OUTGOING MESSAGE TO CONSOLE
-            print(f"\n>>> 📤 OUTGOING MESSAGE to {raw_phone}:\n{welcome_text}\n")
-            return str(resp)
-
-        # ================================
-        # MULTIPLE ORGANIZERS → ASK TO CHOOSE
-        # ================================
-        if len(user_orgs) > 1 and not any(ev['active_events_count'] > 0 for ev in user_orgs):
-            msg.body("📭 None of your organizers have upcoming events right now.")
-            return str(resp)
-
-        if len(user_orgs) > 1:
-            # Check if message is a ticket selection (e.g., "VIP 2")
-            ticket_selection_pattern = r'^[A-Za-z]+\s+\d+$'
-            if re.match(ticket_selection_pattern, incoming_msg):
-                # Try to process with last session? Or ask for organizer first.
-                # For safety: require organizer context.
-                reply = "You’re linked to multiple organizers. Please specify which event you’re buying for:\n"
-                for i, org in enumerate(user_orgs, 1):
-                    status = f" ({org['active_events_count']} active)" if org['active_events_count'] > 0 else " (no active events)"
-                    reply += f"{i}. {org['name']}{status}\n"
-                reply += "\nOr type an event code: attend ORG-CODE"
-                msg.body(reply)
-                return str(resp)
-
-        # ================================
-        # SINGLE ORGANIZER CONTEXT
-        # ================================
-        # If only one org, or user typed "events", proceed
-        selected_org = None
-        if len(user_orgs) == 1:
-            selected_org = user_orgs[0]
-        elif incoming_msg.lower().strip() == "events":
-            # If multiple, this shouldn't happen—but fallback to first with events
-            for org in user_orgs:
-                if org['active_events_count'] > 0:
-                    selected_org = org
-                    break
-            if not selected_org:
-                selected_org = user_orgs[0]
-
-        if not selected_org:
-            # Should not happen, but safe guard
-            msg.body("❓ Please specify which organizer you’d like to interact with.")
-            return str(resp)
-
-        # ================================
-        # CANCEL PAYMENT COMMAND
-        # ================================
-        if incoming_msg.lower().strip() == "cancel":
-            deleted = supabase_service.table('user_carts') \
-                .delete() \
-                .eq('whatsapp_id', whatsapp_id) \
-                .eq('locked', 'true') \
-                .execute()
-            if deleted.data:
-                msg.body("✅ Your payment attempt was cancelled. You can now start a new purchase.")
+                    log_bot_reply(raw_phone, reply_text)
+                    return
+                else:
+                    reply_text = "Let’s start over. What’s your *organizer name*?"
+                    msg.body(reply_text)
+                    log_bot_reply(raw_phone, reply_text)
+                    session_store.update(raw_phone, step='org_name')
+                    return
             else:
-                msg.body("ℹ️ No active payment to cancel.")
-            return str(resp)
-
-         # ================================
-        # TICKET PURCHASE FLOW (UNCHANGED CORE)
-        # ================================
-        if " " in incoming_msg and not incoming_msg.lower().startswith("attend "):
-            print(f">>> 🧪 ENTERED TICKET PURCHASE FLOW with: '{incoming_msg}'")
-            parts = incoming_msg.split(" ", 1)
-            ticket_type_name = parts[0].strip()
-            try:
-                quantity = int(parts[1].strip())
-                if quantity < 1:
-                    raise ValueError
-            except (ValueError, IndexError):
-                msg.body("❌ Invalid format. Example: VIP 2")
-                return str(resp)
-
-            # === Generate UTC timestamps with Supabase-compatible format ===
-            now_utc = datetime.now(pytz.utc)
-            expires_at_utc = now_utc + timedelta(minutes=20)
-            current_time_iso = now_utc.isoformat()
-            expires_at_iso = expires_at_utc.isoformat()
-
-            # 🔒 Check for existing locked cart — with context and abort hint
-            existing_locked_cart = supabase_service.table('user_carts') \
-                .select('event_id, ticket_type_id, quantity') \
-                .eq('whatsapp_id', whatsapp_id) \
-                .eq('locked', 'true') \
-                .execute()
-
-            if existing_locked_cart.data and len(existing_locked_cart.data) > 0:
-                cart = existing_locked_cart.data[0]
-                
-                # Fetch event name
-                event = supabase.table('events').select('name').eq('id', cart['event_id']).single().execute()
-                event_name = event.data['name'] if event.data else "Unknown Event"
-                
-                # Fetch ticket type name
-                ticket_type = supabase.table('ticket_types').select('name').eq('id', cart['ticket_type_id']).single().execute()
-                ticket_name = ticket_type.data['name'] if ticket_type.data else "Unknown Ticket"
-                
-                quantity = cart['quantity']
-                
-                msg.body(
-                    f"⏳ You’re already buying {quantity}x {ticket_name} for *{event_name}*.\n"
-                    "Please complete your previous payment or reply *CANCEL* to abort and start over."
+                # No previous step — restart from org_name
+                reply_text = "Let’s start over. What’s your *organizer name*?"
+                msg.body(reply_text)
+                log_bot_reply(raw_phone, reply_text)
+                session_store.update(
+                    raw_phone,
+                    step='org_name',
+                    previous_step=None,
+                    data={}
                 )
-                return str(resp)
-
-            # Check if event is still open
-            events = get_active_events_for_organizer(selected_org['id'])
-            if not events:
-                msg.body("❌ Ticket sales are closed for all events by this organizer.")
-                return str(resp)
-
-            # Find ticket type across active events
-            ticket = None
-            event_found = None
-            for ev in events:
-                tkt = supabase.table('ticket_types') \
-                    .select('id, name, price, event_id, available_quantity') \
-                    .eq('name', ticket_type_name) \
-                    .eq('event_id', ev['id']) \
-                    .gte('available_quantity', quantity) \
-                    .single() \
-                    .execute()
-                if tkt.data:
-                    ticket = tkt.data
-                    event_found = ev
-                    break
-
-            if not ticket:
-                msg.body(f"❌ '{ticket_type_name}' not found or sold out. Type 'events' to see options.")
-                return str(resp)
-
-
-            # 💾 Create new LOCKED cart with expiry
-            cart_data = {
-                'whatsapp_id': whatsapp_id,
-                'event_id': ticket['event_id'],
-                'ticket_type_id': ticket['id'],
-                'quantity': quantity,
-                'locked': 'true',
-                'expires_at': expires_at_iso
-            }
-
+                return
+
+        elif incoming_lower == "cancel":
+            log.debug("onboarding_cancel whatsapp_id=%s step=%s", raw_phone, step)
+            session_store.delete(raw_phone)
+            reply_text = "✅ Onboarding cancelled. Reply `I'm an organizer` anytime to restart."
+            msg.body(reply_text)
+            log_bot_reply(raw_phone, reply_text)
+            return
+
+        # === ONLY NOW HANDLE STEP-SPECIFIC LOGIC ===
+        if step == 'org_name':
+            data['org_name'] = incoming_msg.strip()
+            session_store.update(
+                raw_phone,
+                step='event_name',
+                previous_step='org_name',
+                data=data
+            )
+            reply_text = "What’s your *event name*?\n(e.g., Summer Night Jazz)"
+            msg.body(reply_text)
+            log_bot_reply(raw_phone, reply_text)
+            return
+
+        elif step == 'event_name':
+            data['event_name'] = incoming_msg.strip()
+            session_store.update(
+                raw_phone,
+                step='date',
+                previous_step='event_name',
+                data=data
+            )
+            reply_text = "When is the event? Please send the date in *YYYY-MM-DD* format."
+            msg.body(reply_text)
+            log_bot_reply(raw_phone, reply_text)
+            return
+
+        elif step == 'date':
+            if not re.match(r'^\d{4}-\d{2}-\d{2}$', incoming_msg.strip()):
+                reply_text = "❌ Invalid date format. Please use YYYY-MM-DD (e.g., 2025-08-15)"
+                msg.body(reply_text)
+                log_bot_reply(raw_phone, reply_text)
+                return
             try:
-                cart_insert = supabase_service.table('user_carts').insert(cart_data).execute()
-                print(f"✅ Locked cart created for {whatsapp_id} (expires at {expires_at_iso})")
-            except Exception as e:
-                print(f"❌ FAILED to save locked cart for {whatsapp_id}: {str(e)}")
-                msg.body("❌ Sorry, we couldn't reserve your ticket. Please try again.")
-                return str(resp)
-                
-            
+                event_date = datetime.strptime(incoming_msg.strip(), "%Y-%m-%d").replace(tzinfo=pytz.utc)
+                if event_date < datetime.now(pytz.utc):
+                    reply_text = "❌ Event date must be in the future. Try again."
+                    msg.body(reply_text)
+                    log_bot_reply(raw_phone, reply_text)
+                    return
+            except Exception:
+                reply_text = "❌ Invalid date. Please use YYYY-MM-DD."
+                msg.body(reply_text)
+                log_bot_reply(raw_phone, reply_text)
+                return
+            data['date'] = incoming_msg.strip()
+            session_store.update(
+                raw_phone,
+                step='location',
+                previous_step='date',
+                data=data
+            )
+            reply_text = "Where is the event happening?\n(e.g., Eko Hotel, Lagos)"
+            msg.body(reply_text)
+            log_bot_reply(raw_phone, reply_text)
+            return
+
+        elif step == 'location':
+            data['location'] = incoming_msg.strip()
+            session_store.update(
+                raw_phone,
+                step='refundable',
+                previous_step='location',
+                data=data
+            )
+            reply_text = "Do you allow *refunds*? Reply:\n1. Yes\n2. No"
+            msg.body(reply_text)
+            log_bot_reply(raw_phone, reply_text)
+            return
+
+        elif step == 'refundable':
+            if incoming_msg.strip() in ["1", "Yes", "yes"]:
+                data['refundable'] = True
+            elif incoming_msg.strip() in ["2", "No", "no"]:
+                data['refundable'] = False
+            else:
+                reply_text = "Please reply 1 for Yes or 2 for No."
+                msg.body(reply_text)
+                log_bot_reply(raw_phone, reply_text)
+                return
+            session_store.update(
+                raw_phone,
+                step='welcome_message',
+                previous_step='refundable',
+                data=data
+            )
+            reply_text = "Optional: Send a *welcome message* for your attendees (max 200 chars), or type `skip`."
+            msg.body(reply_text)
+            log_bot_reply(raw_phone, reply_text)
+            return
+
+        elif step == 'welcome_message':
+            if incoming_msg.lower().strip() != "skip":
+                data['welcome_message'] = incoming_msg.strip()[:200]
+            else:
+                data['welcome_message'] = ""
 
-            total = ticket['price'] * quantity
-                        # 🔍 Check gateway health (clear cache to get fresh status)
-            clear_health_cache()
-            flw_ok = is_flutterwave_healthy()
-            psk_ok = is_paystack_healthy()
-
-            options = []
-            if flw_ok:
-                options.append("1. Flutterwave")
-            if psk_ok:
-                options.append("2. Paystack")
-
-            if not options:
-                msg.body("🚫 All payment services are temporarily unavailable. Please try again later.")
-                # Unlock cart by deleting it
-                supabase_service.table('user_carts').delete().eq('whatsapp_id', whatsapp_id).execute()
-                return str(resp)
-
-            option_text = "\n".join(options)
-            reply = f"✅ {quantity}x {ticket['name']} for '{event_found['name']}'"
-            reply += f"💰 Total: ₦{total:,}"
-            reply += f"💳 Pay with:\n{option_text}\nReply with the number."
-            msg.body(reply)
-            print(f">>> 💬 PAYMENT MESSAGE: {reply}")
-            return str(resp)
-
-        # ================================
-        # PAYMENT METHOD SELECTION (1 or 2)
-        # ================================
-        elif incoming_msg.strip() in ["1", "2"]:
-            print(f">>> 💳 PAYMENT SELECTION: '{incoming_msg}' by {whatsapp_id}")
-
-            # DEBUG: List ALL carts for this user
-            print(f">>> 🧪 PAYMENT DEBUG")
-            print(f">>> 📞 whatsapp_id (repr): {repr(whatsapp_id)}")
+            # ✅ FINALIZE ORGANIZER CREATION
             try:
-                probe = httpx.get(
-                    f"{SUPABASE_URL}/rest/v1/user_carts",
-                    headers={
-                        "apikey": SUPABASE_SERVICE_ROLE_KEY,
-                        "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE_KEY}",
+                code = generate_organizer_code(data['event_name'], data['date'])
+                org_res = supabase_service.table('organizers').insert({
+                    'name': data['org_name'],
+                    'code': code,
+                    'welcome_message': data['welcome_message'],
+                    'refundable': data['refundable'],
+                    'contact_for_refunds': raw_phone,      # for refund messages (raw format)
+                    'phone': clean_phone                   # ✅ NEW: clean phone for dashboard, SMS, etc.
+                }).execute()
+                organizer_id = org_res.data[0]['id']
+                invalidate_organizer(organizer_id, code)
+                supabase_service.table('events').insert({
+                    'organizer_id': organizer_id,
+                    'name': data['event_name'],
+                    'date': data['date'],
+                    'location': data['location'],
+                    'status': 'active',
+                    'ticket_sales_open': False
+                }).execute()
+                supabase.table('user_organizers').upsert(
+                    {
+                        'whatsapp_id': raw_phone,
+                        'organizer_id': organizer_id,
+                        'organizer_name': data['org_name']  # ✅ ADD THIS
                     },
-                    timeout=10
+                    on_conflict='whatsapp_id,organizer_id'
+                ).execute()
+                session_store.delete(raw_phone)
+                clear_request_cache()
+
+                # === GENERATE QR CODE ===
+                twilio_wa_number = TWILIO_NUMBER.replace('whatsapp:', '').replace('+', '')
+                invite_link = f"https://wa.me/{twilio_wa_number}?text=attend%20{code}"
+                png = render_qr(invite_link, box_size=8, border=2)
+
+                # Upload to Supabase Storage
+                qr_file_name = f"invite_qr/{code}.png"
+                try:
+                    supabase_service.storage.from_("ticket-qr").upload(
+                        qr_file_name,
+                        png,
+                        file_options={"content-type": "image/png"}
+                    )
+                    qr_url = supabase_service.storage.from_("ticket-qr").get_public_url(qr_file_name)
+                except Exception as e:
+                    log.warning("invite_qr_upload_failed code=%s error=%s", code, e)
+                    qr_url = None
+
+                # === SEND MESSAGE + QR ===
+                dashboard_url = f"{PUBLIC_BASE_URL}/organizer/{code}/setup"
+                reply_text = (
+                    f"🎉 *Your event is ready!* ✅\n"
+                    f"Organizer code: *{code}*\n\n"
+                    f"📲 Share invite link:\n{invite_link}\n\n"
+                    f"🛠️ **Complete setup** (add tickets, poster, description):\n{dashboard_url}\n\n"
+                    f"✅ Ticket sales will open once you add ticket types!"
                 )
-                print("🔍 Probe to Supabase:", probe.status_code, probe.text[:200])
-            except Exception as e:
-                print("❌ Probe error:", e)
+                msg.body(reply_text)
+                if qr_url:
+                    msg.media(qr_url)  # Attach QR image
 
-            all_carts = supabase_service.table('user_carts').select('*').eq('whatsapp_id', whatsapp_id).execute()
-            print(f">>> 🔍 ALL carts for {whatsapp_id}: {all_carts.data}")
+                log.info("organizer_created code=%s whatsapp_id=%s qr_url=%s", code, raw_phone, qr_url)
+                log_bot_reply(raw_phone, reply_text)
 
-            try:
-                cart_resp = supabase_service.table('user_carts') \
-                    .select('event_id, ticket_type_id, quantity') \
-                    .eq('whatsapp_id', whatsapp_id) \
-                    .order('created_at', desc=True) \
-                    .limit(1) \
-                    .execute()
-                print(f">>> 🛒 Cart query result: {cart_resp.data if cart_resp else 'None'}")
-            except PostgrestAPIError as e:
-                print(f">>> ❌ Cart query failed: {e}")
-                cart_resp = type("EmptyResp", (), {"data": None})
-
-            if not cart_resp.data:
-                # 🔓 Unlock cart
-                supabase_service.table('user_carts').update({'locked': 'false'}).eq('whatsapp_id', whatsapp_id).execute()
-                msg.body("❌ No ticket selected. Please select a ticket first.")
-                return str(resp)
-
-            cart_data = cart_resp.data[0]
-            event_id = cart_data['event_id']
-            ticket_type_id = cart_data['ticket_type_id']
-            quantity = cart_data['quantity']
-            print(f">>> 🎟️ Cart loaded: event={event_id}, ticket_type={ticket_type_id}, qty={quantity}")
-
-            # 🔐 FETCH TICKET PRICE VIA DIRECT REST (using hardened http_client to avoid SSL bug)
-            ticket_type_url = f"{SUPABASE_URL}/rest/v1/ticket_types?id=eq.{ticket_type_id}"
-            headers = {
-                "apikey": SUPABASE_KEY,
-                "Authorization": f"Bearer {SUPABASE_KEY}",
-                "Accept": "application/json"
-            }
-            try:
-                resp_price = http_client.get(ticket_type_url, headers=headers, timeout=10)
-                if resp_price.status_code == 200:
-                    data = resp_price.json()
-                    if data and len(data) == 1:
-                        price = data[0]['price']
-                        amount = price * quantity
-                        print(f">>> 💰 Price: ₦{price}, Total: ₦{amount}")
-                    else:
-                        raise Exception("Ticket type not found or multiple matches")
-                else:
-                    raise Exception(f"REST error {resp_price.status_code}: {resp_price.text[:100]}")
-            except Exception as e:
-                print(f">>> ❌ Failed to fetch ticket price via REST: {e}")
-                # 🔓 Unlock cart
-                supabase_service.table('user_carts').update({'locked': False}).eq('whatsapp_id', whatsapp_id).execute()
-                msg.body("❌ Error fetching ticket details.")
-                return str(resp)
-
-            phone = whatsapp_id.replace("whatsapp:", "")
-            email = f"user_{phone.lstrip('+')}@example.com"
-
-            # Determine initial method
-            initial_method = "flutterwave" if incoming_msg.strip() == "1" else "paystack"
-            method = initial_method
-            print(f">>> 🏦 Initial payment method: {method}")
-
-            # === PAYMENT LINK GENERATION WITH FALLBACK ===
-            payment_url = None
-            gateway = None
-            tx_ref = None
-            reference = None
-
-            # Try primary method
-            if method == "flutterwave":
-                tx_ref = f"FLW-{secrets.token_hex(8)}"
-                result = generate_payment_link_flw(amount, phone, email, tx_ref)
-                print(f">>> 🔄 Flutterwave API response: {result}")
-                if isinstance(result, dict) and result.get("status") == "success":
-                    payment_url = result["data"]["link"]
-                    gateway = "flutterwave"
-                else:
-                    print(">>> ⚠️ Flutterwave failed — attempting Paystack fallback")
-                    method = "paystack"
-
-            if method == "paystack" and not payment_url:
-                reference = f"PSK-{secrets.token_hex(8)}"
-                result = generate_payment_link_paystack(amount, email, reference)
-                print(f">>> 🔄 Paystack API response: {result}")
-                if isinstance(result, dict) and result.get("status") is True:
-                    payment_url = result["data"]["authorization_url"]
-                    gateway = "paystack"
-                    tx_ref = reference
-                else:
-                    print(">>> ❌ Both gateways failed")
-
-            # Handle total failure
-            if not payment_url:
-                # 🔓 Unlock cart
-                supabase_service.table('user_carts').update({'locked': False}).eq('whatsapp_id', whatsapp_id).execute()
-                msg.body("❌ Payment services are currently unavailable. Please try again later.")
-                return str(resp)
-
-            print(f">>> 🔗 PAYMENT LINK GENERATED: {payment_url}")
-
-            # Re-fetch user organizers
-            user_orgs_for_payment = get_user_organizers(raw_phone)
-            if not user_orgs_for_payment:
-                # 🔓 Unlock cart
-                supabase_service.table('user_carts').update({'locked': False}).eq('whatsapp_id', whatsapp_id).execute()
-                msg.body("❌ Organizer not found. Please start over with 'events'.")
-                return str(resp)
-
-            if len(user_orgs_for_payment) == 1:
-                payment_org = user_orgs_for_payment[0]
-            else:
-                payment_org = next((org for org in user_orgs_for_payment if org['active_events_count'] > 0), user_orgs_for_payment[0])
+                return
 
-            organizer_id = payment_org['id']
+            except Exception:
+                log.exception("onboarding_save_failed whatsapp_id=%s", raw_phone)
+                session_store.delete(raw_phone)
+                reply_text = "❌ Sorry, we couldn’t create your event. Please try again."
+                msg.body(reply_text)
+                log_bot_reply(raw_phone, reply_text)
+                return
+
+    # Not in onboarding → show initial choice
+    if ONBOARD_TRIGGERS.search(incoming_msg.lower()):
+        session_store.update(
+            raw_phone,
+            step='org_name',
+            data={},
+            expires_at=(datetime.now(pytz.utc) + timedelta(minutes=30)).isoformat()
+        )
+        reply_text = "Great! Let’s set up your event 🎪\n\nWhat’s your *organizer name*?\n(e.g., Lagos Jazz Fest)"
+        msg.body(reply_text)
+        log_bot_reply(raw_phone, reply_text)
+        return
 
-            # Save transaction
-            try:
-                supabase_service.table('transactions').insert({
-                    'whatsapp_id': whatsapp_id,
-                    'organizer_id': organizer_id,
-                    'event_id': event_id,
-                    'ticket_type_id': ticket_type_id,
-                    'amount': amount,
-                    'payment_gateway': gateway,
-                    'payment_ref': tx_ref,
-                    'status': 'pending'
-                }).execute()
-                print(">>> 📥 Transaction saved")
-            except Exception as e:
-                print(f">>> ❌ Failed to save transaction: {e}")
-                # Note: We leave cart locked — user can retry or it will be cleaned up later
+    # Define the new welcome message
+    welcome_text = (
+        "👋 Welcome to *TicketBot*!\n\n"
+        "Are you here to:\n"
+        "🎟️ *Buy tickets*? → Type: `attend ORG-CODE`\n"
+        "🎪 *Create & sell tickets*? → Reply: `I'm an organizer`"
+    )
+    msg.body(welcome_text)
+    log_bot_reply(raw_phone, welcome_text)
+
+# ================================
+# MULTIPLE ORGANIZERS → ASK TO CHOOSE
+# ================================
+@intent('no_active_events', when=lambda ctx: len(ctx.user_orgs) > 1 and not any(org['active_events_count'] > 0 for org in ctx.user_orgs))
+def handle_no_active_events_intent(ctx, match):
+    ctx.msg.body("📭 None of your organizers have upcoming events right now.")
+
+# A ticket selection (e.g., "VIP 2") needs organizer context first
+@intent('choose_organizer', pattern=r'^[A-Za-z]+\s+\d+$', when=lambda ctx: len(ctx.user_orgs) > 1)
+def handle_choose_organizer_intent(ctx, match):
+    msg, user_orgs = ctx.msg, ctx.user_orgs
+    reply = "You’re linked to multiple organizers. Please specify which event you’re buying for:\n"
+    for i, org in enumerate(user_orgs, 1):
+        status = f" ({org['active_events_count']} active)" if org['active_events_count'] > 0 else " (no active events)"
+        reply += f"{i}. {org['name']}{status}\n"
+    reply += "\nOr type an event code: attend ORG-CODE"
+    msg.body(reply)
 
-            # Send message
-            if method != initial_method:
-                msg.body(f"💳 We switched to {gateway.upper()} for reliability.\nPay ₦{amount:,}:\n{payment_url}\nAfter payment, wait for your ticket!")
+# ================================
+# SINGLE ORGANIZER CONTEXT
+# ================================
+@intent('no_organizer_selected', when=lambda ctx: ctx.selected_org is None)
+def handle_no_organizer_selected_intent(ctx, match):
+    # Should not happen, but safe guard
+    ctx.msg.body("❓ Please specify which organizer you’d like to interact with.")
+
+# ================================
+# CANCEL PAYMENT COMMAND
+# ================================
+@intent('cancel_payment', exact=['cancel'])
+def handle_cancel_payment_intent(ctx, match):
+    msg, whatsapp_id = ctx.msg, ctx.whatsapp_id
+    deleted = supabase_service.table('user_carts') \
+        .delete() \
+        .eq('whatsapp_id', whatsapp_id) \
+        .eq('locked', 'true') \
+        .execute()
+    discard_speculative_links(whatsapp_id)
+    if deleted.data:
+        msg.body("✅ Your payment attempt was cancelled. You can now start a new purchase.")
+    else:
+        msg.body("ℹ️ No active payment to cancel.")
+
+# ================================
+# TICKET PURCHASE FLOW
+# ================================
+@intent('purchase', pattern=r'^(?P<name>.+)\s+(?P<quantity>\S+)$')
+def handle_purchase_intent(ctx, match):
+    msg, whatsapp_id = ctx.msg, ctx.whatsapp_id
+    selected_org = ctx.selected_org
+    # The matcher splits on the last whitespace, so multi-word types ("Early Bird 2") work
+    ticket_type_name = match.group('name').strip()
+    try:
+        quantity = int(match.group('quantity'))
+        if quantity < 1:
+            raise ValueError
+    except ValueError:
+        msg.body("❌ Invalid format. Example: VIP 2")
+        return
+
+    # === Generate UTC timestamps with Supabase-compatible format ===
+    now_utc = datetime.now(pytz.utc)
+    expires_at_utc = now_utc + timedelta(minutes=CART_TTL_MINUTES)
+    current_time_iso = now_utc.isoformat()
+    expires_at_iso = expires_at_utc.isoformat()
+
+    # 🔒 Check for existing locked cart — with context and abort hint
+    existing_locked_cart = supabase_service.table('user_carts') \
+        .select('event_id, ticket_type_id, quantity') \
+        .eq('whatsapp_id', whatsapp_id) \
+        .eq('locked', 'true') \
+        .execute()
+
+    if existing_locked_cart.data and len(existing_locked_cart.data) > 0:
+        cart = existing_locked_cart.data[0]
+
+        # Fetch event name
+        event = supabase.table('events').select('name').eq('id', cart['event_id']).single().execute()
+        event_name = event.data['name'] if event.data else "Unknown Event"
+
+        # Fetch ticket type name
+        ticket_type = supabase.table('ticket_types').select('name').eq('id', cart['ticket_type_id']).single().execute()
+        ticket_name = ticket_type.data['name'] if ticket_type.data else "Unknown Ticket"
+
+        quantity = cart['quantity']
+
+        msg.body(
+            f"⏳ You’re already buying {quantity}x {ticket_name} for *{event_name}*.\n"
+            "Please complete your previous payment or reply *CANCEL* to abort and start over."
+        )
+        return
+
+    # Check if event is still open
+    if not get_event_catalog(selected_org['id'])['events']:
+        msg.body("❌ Ticket sales are closed for all events by this organizer.")
+        return
+
+    # Find ticket type across active events
+    event_found, ticket = find_ticket_type(selected_org['id'], ticket_type_name, quantity)
+
+    if not ticket:
+        msg.body(f"❌ '{ticket_type_name}' not found or sold out. Type 'events' to see options.")
+        return
+
+
+    # 💾 Create new LOCKED cart with expiry
+    cart_data = {
+        'whatsapp_id': whatsapp_id,
+        'event_id': ticket['event_id'],
+        'ticket_type_id': ticket['id'],
+        'quantity': quantity,
+        'locked': 'true',
+        'expires_at': expires_at_iso
+    }
+
+    try:
+        cart_insert = supabase_service.table('user_carts').insert(cart_data).execute()
+        log.info("cart_locked whatsapp_id=%s ticket_type_id=%s quantity=%d expires_at=%s", whatsapp_id, ticket['id'], quantity, expires_at_iso)
+    except Exception as e:
+        log.error("cart_lock_failed whatsapp_id=%s error=%s", whatsapp_id, e)
+        msg.body("❌ Sorry, we couldn't reserve your ticket. Please try again.")
+        return
+
+
+
+    total = ticket['price'] * quantity
+    # 🔍 Gateway health comes from the background monitor's circuit breakers
+    flw_ok = is_flutterwave_healthy()
+    psk_ok = is_paystack_healthy()
+
+    options = []
+    if flw_ok:
+        options.append("1. Flutterwave")
+    if psk_ok:
+        options.append("2. Paystack")
+
+    if not options:
+        msg.body("🚫 All payment services are temporarily unavailable. Please try again later.")
+        # Unlock cart by deleting it
+        supabase_service.table('user_carts').delete().eq('whatsapp_id', whatsapp_id).execute()
+        return
+
+    gateways = [name for name, ok in (('flutterwave', flw_ok), ('paystack', psk_ok)) if ok]
+    start_speculative_links(whatsapp_id, (ticket['event_id'], ticket['id'], quantity), total, gateways)
+
+    option_text = "\n".join(options)
+    reply = f"✅ {quantity}x {ticket['name']} for '{event_found['name']}'"
+    reply += f"💰 Total: ₦{total:,}"
+    reply += f"💳 Pay with:\n{option_text}\nReply with the number."
+    msg.body(reply)
+    log_bot_reply(whatsapp_id, reply)
+
+# ================================
+# PAYMENT METHOD SELECTION (1 or 2)
+# ================================
+@intent('payment_selection', exact=['1', '2'])
+def handle_payment_selection_intent(ctx, match):
+    msg, raw_phone, whatsapp_id, incoming_msg = ctx.msg, ctx.raw_phone, ctx.whatsapp_id, ctx.incoming_msg
+    if log.isEnabledFor(logging.DEBUG):
+        # DEBUG: List ALL carts for this user
+        all_carts = supabase_service.table('user_carts').select('*').eq('whatsapp_id', whatsapp_id).execute()
+        log.debug("carts whatsapp_id=%s rows=%s", whatsapp_id, all_carts.data)
+
+    try:
+        cart_resp = supabase_service.table('user_carts') \
+            .select('event_id, ticket_type_id, quantity') \
+            .eq('whatsapp_id', whatsapp_id) \
+            .order('created_at', desc=True) \
+            .limit(1) \
+            .execute()
+        log.debug("cart_query whatsapp_id=%s rows=%s", whatsapp_id, cart_resp.data)
+    except PostgrestAPIError as e:
+        log.error("cart_query_failed whatsapp_id=%s error=%s", whatsapp_id, e)
+        cart_resp = type("EmptyResp", (), {"data": None})
+
+    if not cart_resp.data:
+        # 🔓 Unlock cart
+        supabase_service.table('user_carts').update({'locked': 'false'}).eq('whatsapp_id', whatsapp_id).execute()
+        msg.body("❌ No ticket selected. Please select a ticket first.")
+        return
+
+    cart_data = cart_resp.data[0]
+    event_id = cart_data['event_id']
+    ticket_type_id = cart_data['ticket_type_id']
+    quantity = cart_data['quantity']
+    log.debug("cart_loaded event_id=%s ticket_type_id=%s quantity=%s", event_id, ticket_type_id, quantity)
+
+    # 🔐 FETCH TICKET PRICE VIA DIRECT REST (using hardened http_client to avoid SSL bug)
+    ticket_type_url = f"{SUPABASE_URL}/rest/v1/ticket_types?id=eq.{ticket_type_id}"
+    headers = {
+        "apikey": SUPABASE_KEY,
+        "Authorization": f"Bearer {SUPABASE_KEY}",
+        "Accept": "application/json"
+    }
+    try:
+        resp_price = http_client.get(ticket_type_url, headers=headers, timeout=10)
+        if resp_price.status_code == 200:
+            data = resp_price.json()
+            if data and len(data) == 1:
+                price = data[0]['price']
+                amount = price * quantity
             else:
-                msg.body(f"💳 Pay ₦{amount:,} via {gateway.upper()}:\n{payment_url}\nAfter payment, wait for your ticket!")
+                raise Exception("Ticket type not found or multiple matches")
+        else:
+            raise Exception(f"REST error {resp_price.status_code}: {resp_price.text[:100]}")
+    except Exception as e:
+        log.error("ticket_price_fetch_failed ticket_type_id=%s error=%s", ticket_type_id, e)
+        # 🔓 Unlock cart
+        supabase_service.table('user_carts').update({'locked': False}).eq('whatsapp_id', whatsapp_id).execute()
+        msg.body("❌ Error fetching ticket details.")
+        return
+
+    phone, email = payment_contact(whatsapp_id)
+
+    # Determine initial method
+    initial_method = "flutterwave" if incoming_msg.strip() == "1" else "paystack"
+    method = initial_method
 
-            return str(resp)
+    # === PAYMENT LINK GENERATION WITH FALLBACK ===
+    # Links started when the cart was locked are used if the cart and amount still match
+    speculative = take_speculative_links(whatsapp_id, (event_id, ticket_type_id, quantity), amount)
+    payment_url = None
+    gateway = None
+    tx_ref = None
 
-        # ================================
-        # DEFAULT: SHOW EVENTS OR HELP
-        # ================================
-        if incoming_msg.lower().strip() == "events":
-            show_events_for_organizer(selected_org['id'], msg)
+    # Try primary method (skipped while its circuit breaker is open)
+    if method == "flutterwave":
+        payment_url, tx_ref = get_payment_link("flutterwave", amount, phone, email, speculative)
+        if payment_url:
+            gateway = "flutterwave"
         else:
-            msg.body(f"✅ You're connected to *{selected_org['name']}*.\nType 'events' to see tickets, or 'my ticket' to resend.")
+            log.warning("payment_link_failed gateway=flutterwave fallback=paystack")
+    if not payment_url:
+        method = "paystack"
 
-        # DEBUG: Log outgoing message to console
-        # DEBUG: Log outgoing message to console — ENHANCED
-        # ✅ ALWAYS LOG THE BOT'S REPLY TEXT TO CONSOLE (even if Twilio fails)
-                # ✅ ALWAYS LOG THE BOT'S REPLY TEXT TO CONSOLE
-        twiml_output = str(resp)
-        try:
-            start = twiml_output.find("<Body>") + 6
-            end = twiml_output.find("</Body>")
-            if start >= 6 and end > start:
-                body_text = twiml_output[start:end]
-                # Unescape common entities
-                body_text = (
-                    body_text
-                    .replace("&#xA;", "\n")
-                    .replace("&amp;", "&")
-                    .replace("<", "<")
-                    .replace(">", ">")
-                )
-            else:
-                body_text = "(no Body found in TwiML)"
-        except Exception:
-            body_text = "(failed to extract body)"
+    if method == "paystack" and not payment_url:
+        payment_url, tx_ref = get_payment_link("paystack", amount, phone, email, speculative)
+        if payment_url:
+            gateway = "paystack"
+    if not payment_url:
+        log.error("payment_link_failed gateway=all whatsapp_id=%s", whatsapp_id)
+
+    # Handle total failure
+    if not payment_url:
+        # 🔓 Unlock cart
+        supabase_service.table('user_carts').update({'locked': False}).eq('whatsapp_id', whatsapp_id).execute()
+        msg.body("❌ Payment services are currently unavailable. Please try again later.")
+        return
 
-        print(f"\n>>> 📤 BOT REPLY TO {raw_phone}:")
-        print("──────────────────────────────────────")
-        print(body_text)
-        print("──────────────────────────────────────\n")
+    log.info("payment_link_created gateway=%s ref=%s amount=%s", gateway, tx_ref, amount)
 
-        return str(resp)
+    # Re-fetch user organizers
+    user_orgs_for_payment = get_user_organizers(raw_phone)
+    if not user_orgs_for_payment:
+        # 🔓 Unlock cart
+        supabase_service.table('user_carts').update({'locked': False}).eq('whatsapp_id', whatsapp_id).execute()
+        msg.body("❌ Organizer not found. Please start over with 'events'.")
+        return
+
+    if len(user_orgs_for_payment) == 1:
+        payment_org = user_orgs_for_payment[0]
+    else:
+        payment_org = next((org for org in user_orgs_for_payment if org['active_events_count'] > 0), user_orgs_for_payment[0])
 
+    organizer_id = payment_org['id']
+
+    # Save transaction
+    try:
+        supabase_service.table('transactions').insert({
+            'whatsapp_id': whatsapp_id,
+            'organizer_id': organizer_id,
+            'event_id': event_id,
+            'ticket_type_id': ticket_type_id,
+            'quantity': quantity,
+            'amount': amount,
+            'payment_gateway': gateway,
+            'payment_ref': tx_ref,
+            'status': 'pending'
+        }).execute()
     except Exception as e:
+        log.error("transaction_save_failed ref=%s error=%s", tx_ref, e)
+        # Note: We leave cart locked — user can retry or it will be cleaned up later
+
+    # Send message
+    if method != initial_method:
+        msg.body(f"💳 We switched to {gateway.upper()} for reliability.\nPay ₦{amount:,}:\n{payment_url}\nAfter payment, wait for your ticket!")
+    else:
+        msg.body(f"💳 Pay ₦{amount:,} via {gateway.upper()}:\n{payment_url}\nAfter payment, wait for your ticket!")
+
+# ================================
+# DEFAULT: SHOW EVENTS OR HELP
+# ================================
+@intent('events', exact=['events'])
+def handle_events_intent(ctx, match):
+    show_events_for_organizer(ctx.selected_org['id'], ctx.msg)
+    log_bot_reply(ctx.raw_phone, get_event_catalog(ctx.selected_org['id'])['text'])
+
+@intent('help', when=lambda ctx: True)
+def handle_help_intent(ctx, match):
+    reply_text = f"✅ You're connected to *{ctx.selected_org['name']}*.\nType 'events' to see tickets, or 'my ticket' to resend."
+    ctx.msg.body(reply_text)
+    log_bot_reply(ctx.raw_phone, reply_text)
+
+
+def handle_incoming_message(incoming_msg, sender):
+    """Build the TwiML reply for one inbound WhatsApp message."""
+    started = time.perf_counter()
+    ctx = None
+    try:
+        ctx = MessageContext(incoming_msg, sender)
+        reply = dispatch_intent(ctx)
+        # One coalesced user_sessions write per message, saved before the reply is sent so the
+        # reply never claims a step that was not persisted
+        session_store.flush()
+        return reply
+
+    except Exception:
         # 🔥 CRITICAL ERROR HANDLER (outer try/except)
-        print("🔥 CRITICAL ERROR IN WEBHOOK:")
-        import traceback
-        traceback.print_exc()
-        try:
-            fallback_msg = "❌ Sorry, something went wrong. We're fixing it! Try again shortly"
-            print(f"\n>>> 📤 FALLBACK BOT REPLY (due to error):")
-            print("──────────────────────────────────────")
-            print(fallback_msg)
-            print("──────────────────────────────────────\n")
-        except:
-            pass
+        session_store.discard()
+        log.exception("webhook_failed whatsapp_id=%s", sender)
         resp = MessagingResponse()
         resp.message("❌ Sorry, something went wrong. We're fixing it! Try again shortly!")
         return str(resp)
+    finally:
+        log.info("message from=%s intent=%s ms=%.1f supabase_calls=%d",
+                 sender, ctx.intent if ctx else None, (time.perf_counter() - started) * 1000,
+                 g.get('supabase_calls', 0) if has_app_context() else 0)
 
-def update_transaction_with_retry(payment_ref, update_data, max_retries=3, backoff=0.5):
+def update_transaction_with_retry(payment_ref, update_data, max_retries=3, backoff=0.5, unless_status=None):
     """
     Attempt to update via supabase client first (normal path).
+    With unless_status, rows already in that status are left alone (and not returned).
     On httpx.ReadError (TLS/httpcore read errors) retry a few times.
-    If still failing, fallback to direct REST PATCH using requests.
+    If still failing, fallback to direct REST PATCH through http_client.
     Returns the result-like object (mimics supabase .execute() where possible),
     or raises the last exception.
     """
@@ -1389,31 +2463,34 @@ def update_transaction_with_retry(payment_ref, update_data, max_retries=3, backo
     # 1) Try the normal supabase path with retries
     for attempt in range(1, max_retries + 1):
         try:
-            result = supabase.table('transactions') \
+            query = supabase.table('transactions') \
                 .update(update_data) \
-                .eq('payment_ref', payment_ref) \
-                .execute()
-            return result
+                .eq('payment_ref', payment_ref)
+            if unless_status:
+                query = query.neq('status', unless_status)
+            return query.execute()
         except Exception as e:
             last_exc = e
             # specifically retry on httpx ReadError / network/TLS anomalies
             if isinstance(e, httpx.ReadError) or 'SSLV3_ALERT_BAD_RECORD_MAC' in str(e) or 'httpcore.ReadError' in str(type(e)):
                 wait = backoff * (2 ** (attempt - 1))
-                print(f"⚠️ transient network/TLS error on attempt {attempt}, retrying in {wait}s: {e}")
+                log.warning("transaction_update_retry ref=%s attempt=%d wait=%s error=%s", payment_ref, attempt, wait, e)
                 time.sleep(wait)
                 continue
             # non-transient: re-raise immediately
-            print("❌ non-transient error updating via supabase client:", e)
+            log.error("transaction_update_failed ref=%s error=%s", payment_ref, e)
             raise
 
-    # 2) Fallback: use direct REST (requests) call to Supabase REST endpoint
+    # 2) Fallback: use direct REST call to Supabase REST endpoint
     try:
-        print("➡️ Fallback: using direct REST PATCH to Supabase")
+        log.warning("transaction_update_fallback ref=%s via=rest", payment_ref)
         supabase_url = os.getenv("SUPABASE_URL").rstrip("/")
         rest_table = "transactions"
         # Build filter for payment_ref eq.<value>
         # Note: use URL-encoded filter
-        filter_q = f"payment_ref=eq.{requests.utils.quote(payment_ref, safe='')}"
+        filter_q = f"payment_ref=eq.{quote(payment_ref, safe='')}"
+        if unless_status:
+            filter_q += f"&status=neq.{quote(unless_status, safe='')}"
         patch_url = f"{supabase_url}/rest/v1/{rest_table}?{filter_q}"
 
         # Use the Service Role key for update privileges
@@ -1429,7 +2506,7 @@ def update_transaction_with_retry(payment_ref, update_data, max_retries=3, backo
             "Prefer": "return=representation"
         }
 
-        resp = requests.patch(patch_url, json=update_data, headers=headers, timeout=10)
+        resp = http_client.patch(patch_url, json=update_data, headers=headers, timeout=10)
         if resp.status_code in (200, 201, 204):
             try:
                 data = resp.json()
@@ -1440,142 +2517,286 @@ def update_transaction_with_retry(payment_ref, update_data, max_retries=3, backo
         else:
             raise RuntimeError(f"Fallback REST update failed: {resp.status_code} {resp.text}")
     except Exception as e:
-        print("❌ Fallback update also failed:", str(e))
+        log.error("transaction_update_fallback_failed ref=%s error=%s", payment_ref, e)
         # raise the last meaningful exception
         raise last_exc or e
 
+# ====== PAYMENT CALLBACK PROCESSING ======
+# /payment-callback only identifies the event, checks its signature, writes it to a durable
+# SQLite queue (next to the outbox) and returns 200, so the gateways never time out and retry.
+# PAYMENT_WORKERS threads then verify each payment with the gateway API, update the transaction
+# and issue tickets, retrying transient failures with backoff. ASYNC_PAYMENT_CALLBACK=false
+# restores inline processing. The workers start when this module is imported (see the end of the
+# file), so events queued before a restart are picked up without waiting for a new callback.
+ASYNC_PAYMENT_CALLBACK = os.getenv("ASYNC_PAYMENT_CALLBACK", "true").lower() == "true"
+PAYMENT_WORKERS = int(os.getenv("PAYMENT_WORKERS", "4"))
+PAYMENT_MAX_ATTEMPTS = int(os.getenv("PAYMENT_MAX_ATTEMPTS", "8"))
+PAYMENT_RETRY_SECONDS = float(os.getenv("PAYMENT_RETRY_SECONDS", "5"))
+# Optional: Flutterwave sends this value back in the `verif-hash` header
+FLW_SECRET_HASH = os.getenv("FLW_SECRET_HASH")
+
+payment_events = DurableQueue(OUTBOX_DB_PATH, 'payment_events')
+_payment_wakeup = threading.Event()
+_payment_workers_started = False
+_payment_workers_lock = threading.Lock()
+
+class PaymentVerificationError(Exception):
+    """The gateway could not be asked about a payment (network error, bad response)."""
+
+def parse_payment_event(data):
+    """Identify a gateway callback: {'gateway', 'payment_ref', 'transaction_id'}, or None if unknown."""
+    if not isinstance(data, dict):
+        return None
+    payment_data = data.get("data") or {}
+    # 🔹 PAYSTACK: detect by event == "charge.success" AND data.reference
+    if data.get("event") == "charge.success" and payment_data.get("reference"):
+        return {'gateway': 'paystack', 'payment_ref': payment_data['reference'], 'transaction_id': None}
+    # 🔹 FLUTTERWAVE: detect by known event types AND data.id
+    event = data.get("event") or data.get("event.type")
+    if event in ["charge.completed", "BANK_TRANSFER_TRANSACTION"] and payment_data.get("id"):
+        return {'gateway': 'flutterwave', 'payment_ref': payment_data.get("tx_ref"), 'transaction_id': payment_data["id"]}
+    return None
+
+def verify_gateway_payment(event):
+    """Ask the gateway whether the payment succeeded ('successful' or 'failed')."""
+    if event['gateway'] == 'paystack':
+        verify_url = f"https://api.paystack.co/transaction/verify/{event['payment_ref']}"
+        headers = {"Authorization": f"Bearer {os.getenv('PAYSTACK_SECRET_KEY')}"}
+    else:
+        verify_url = f"https://api.flutterwave.com/v3/transactions/{event['transaction_id']}/verify"
+        headers = {"Authorization": f"Bearer {os.getenv('FLW_SECRET_KEY')}"}
+    try:
+        verify_resp = http_client.get(verify_url, headers=headers).json()
+    except Exception as e:
+        raise PaymentVerificationError(e) from e
+    log.debug("payment_verify_response gateway=%s body=%s", event['gateway'], verify_resp)
+    if event['gateway'] == 'paystack':
+        ok = verify_resp.get('status') is True and verify_resp['data']['status'] == 'success'
+    else:
+        ok = verify_resp.get("status") == "success" and verify_resp["data"]["status"] == "successful"
+    return 'successful' if ok else 'failed'
+
+class ProcessedPayments:
+    """
+    payment_refs whose tickets are confirmed issued, in a SQLite table with an in-memory TTL set in
+    front, so redelivered callbacks and reconciler hits cost one lookup. Only a cache: the
+    transaction row (tickets_claimed_at / tickets_issued_at) is the source of truth.
+    """
+    def __init__(self, path, ttl=86400, maxsize=50000):
+        self._recent = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS processed_payments (
+                payment_ref TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )""")
+
+    def state(self, payment_ref):
+        with self._lock:
+            if payment_ref in self._recent:
+                return 'issued'
+            row = self._db.execute("SELECT state FROM processed_payments WHERE payment_ref = ?", (payment_ref,)).fetchone()
+            if row and row[0] == 'issued':
+                self._recent[payment_ref] = True
+            return row[0] if row else None
+
+    def mark(self, payment_ref, state):
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO processed_payments (payment_ref, state, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(payment_ref) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+                (payment_ref, state, time.time()))
+            if state == 'issued':
+                self._recent[payment_ref] = True
+
+processed_payments = ProcessedPayments(OUTBOX_DB_PATH)
+
+# Issuing is claimed in the same write that marks a transaction paid (tickets_claimed_at) and
+# confirmed with tickets_issued_at once the tickets are out. A paid row with a claim older than
+# ISSUE_CLAIM_TIMEOUT and no confirmation belongs to an issuer that died; anyone may take it over.
+ISSUE_CLAIM_TIMEOUT = int(os.getenv("ISSUE_CLAIM_TIMEOUT", "300"))
+
+class TicketIssuanceInProgress(Exception):
+    """Another worker holds a fresh claim on issuing this payment's tickets; try again later."""
+
+def claim_stale_issuance(payment_ref):
+    """Take over issuing a paid transaction whose claim is missing or stale. Returns the row, or None."""
+    now = datetime.now(timezone.utc)
+    cutoff = (now - timedelta(seconds=ISSUE_CLAIM_TIMEOUT)).isoformat()
+    result = supabase_service.table('transactions') \
+        .update({'tickets_claimed_at': now.isoformat()}) \
+        .eq('payment_ref', payment_ref) \
+        .eq('status', 'paid') \
+        .is_('tickets_issued_at', 'null') \
+        .or_(f"tickets_claimed_at.is.null,tickets_claimed_at.lt.{cutoff}") \
+        .execute()
+    return result.data[0] if result.data else None
+
+def settle_payment(payment_ref, status):
+    """
+    Apply a verified gateway outcome exactly once. Only the caller whose conditional update moves
+    the transaction to paid issues tickets; callbacks, redeliveries and the reconciler can race
+    freely. Returns (message, http_status); raises TicketIssuanceInProgress while another
+    worker is still issuing.
+    """
+    paid = status in ['successful', 'success']
+    update_data = {
+        'status': 'paid' if paid else 'failed',
+        'updated_at': 'now()'
+    }
+    if paid:
+        update_data['tickets_claimed_at'] = datetime.now(timezone.utc).isoformat()
+    # Use the resilient updater; a paid transaction is never touched again
+    result = update_transaction_with_retry(payment_ref, update_data, unless_status='paid')
+    if result.data and paid:
+        return issue_paid_tickets(payment_ref, result.data[0]['whatsapp_id'])
+    if result.data:
+        log.info("payment_not_successful ref=%s", payment_ref)
+        return "Payment not successful", 400
+
+    tx = supabase.table('transactions') \
+        .select('status, tickets_issued_at') \
+        .eq('payment_ref', payment_ref) \
+        .limit(1) \
+        .execute()
+    if not tx.data:
+        log.warning("payment_callback_unknown_transaction ref=%s", payment_ref)
+        return "Transaction not found", 404
+    row = tx.data[0]
+    if row['status'] == 'paid' and not row.get('tickets_issued_at'):
+        # Paid but never confirmed: another worker is issuing, or died while doing so
+        claimed = claim_stale_issuance(payment_ref)
+        if not claimed:
+            raise TicketIssuanceInProgress(payment_ref)
+        log.warning("ticket_issuance_reclaimed ref=%s", payment_ref)
+        return issue_paid_tickets(payment_ref, claimed['whatsapp_id'])
+    log.info("payment_already_settled ref=%s", payment_ref)
+    if row['status'] == 'paid':
+        processed_payments.mark(payment_ref, 'issued')
+    return "Already processed", 200
+
+def issue_paid_tickets(payment_ref, whatsapp_id):
+    log.info("issuing_ticket ref=%s whatsapp_id=%s", payment_ref, whatsapp_id)
+    send_ticket(whatsapp_id, payment_ref)
+    supabase_service.table('transactions') \
+        .update({'tickets_issued_at': datetime.now(timezone.utc).isoformat()}) \
+        .eq('payment_ref', payment_ref) \
+        .execute()
+    processed_payments.mark(payment_ref, 'issued')
+    return "Ticket issued", 200
+
+def process_payment_event(event):
+    """Verify, update the transaction and issue tickets. Returns (message, http_status)."""
+    payment_ref = event['payment_ref']
+    if processed_payments.state(payment_ref) == 'issued':
+        log.info("payment_duplicate ref=%s", payment_ref)
+        return "Already processed", 200
+    status = verify_gateway_payment(event)
+    log.info("payment_callback gateway=%s ref=%s status=%s", event['gateway'], payment_ref, status)
+    return settle_payment(payment_ref, status)
+
+def start_payment_workers():
+    global _payment_workers_started
+    with _payment_workers_lock:
+        if _payment_workers_started:
+            return
+        for i in range(PAYMENT_WORKERS):
+            threading.Thread(target=_payment_worker, name=f"payment-worker-{i}", daemon=True).start()
+        _payment_workers_started = True
+    log.info("payment_workers_started workers=%d", PAYMENT_WORKERS)
+
+def _payment_worker():
+    while True:
+        try:
+            items = payment_events.claim(limit=1)
+        except Exception:
+            log.exception("payment_worker_claim_failed")
+            time.sleep(OUTBOX_POLL_SECONDS)
+            continue
+        if not items:
+            due_in = payment_events.next_due_in()
+            _payment_wakeup.wait(OUTBOX_POLL_SECONDS if due_in is None else min(due_in, OUTBOX_POLL_SECONDS))
+            _payment_wakeup.clear()
+            continue
+        item = items[0]
+        event = item['payload']
+        try:
+            with app.app_context():
+                message, _ = process_payment_event(event)
+            payment_events.ack(item['id'])
+            log.debug("payment_event_done id=%s ref=%s result=%s", item['id'], event['payment_ref'], message)
+        except Exception as e:
+            attempts = item['attempts'] + 1
+            if attempts >= PAYMENT_MAX_ATTEMPTS:
+                payment_events.dead(item['id'], e)
+                log.error("payment_event_dead id=%s ref=%s attempts=%d error=%s", item['id'], event['payment_ref'], attempts, e)
+            else:
+                backoff = min(600, PAYMENT_RETRY_SECONDS * (2 ** item['attempts']))
+                payment_events.retry(item['id'], e, backoff)
+                log.warning("payment_event_retry id=%s ref=%s attempts=%d backoff=%ss error=%s",
+                            item['id'], event['payment_ref'], attempts, backoff, e)
+
 @app.route('/payment-callback', methods=['POST'])
 def payment_callback():
     try:
-        print("\n>>> 🚨 WEBHOOK RECEIVED — START DEBUG")
-        print(">>> RAW PAYLOAD (bytes):", request.data)
-        print(">>> RAW PAYLOAD (text):", request.get_data(as_text=True))
-        print(">>> CONTENT TYPE:", request.content_type)
-        print(">>> HEADERS:", dict(request.headers))
+        log.debug("payment_callback_raw content_type=%s headers=%s body=%s",
+                  request.content_type, dict(request.headers), request.get_data(as_text=True))
         # Parse payload
         data = request.get_json(silent=True) or request.form.to_dict()
-        print(">>> PARSED DATA:", data)
-        print(">>> DATA TYPE:", type(data))
-        print(">>> KEYS IN DATA:", list(data.keys()) if isinstance(data, dict) else "NOT DICT")
         if not data:
-            print("❌ Empty payload")
+            log.warning("payment_callback_rejected reason=empty_payload")
             return "Empty payload", 400
-        payment_ref = None
-        status = None
-        gateway = None
-
-        # 🔹 PAYSTACK: detect by event == "charge.success" AND data.reference
-        if isinstance(data, dict) and data.get("event") == "charge.success" and data.get("data", {}).get("reference"):
-            print(">>> 🟢 Processing Paystack webhook")
-            payment_ref = data["data"]["reference"]
-            gateway = "paystack"
+
+        event = parse_payment_event(data)
+        if event is None:
+            log.warning("payment_callback_rejected reason=unknown_payload")
+            return "Unknown payload", 400
+        if event['gateway'] == 'paystack':
             # Verify signature FIRST
-            signature = request.headers.get('X-Paystack-Signature')
-            print(">>> PAYSTACK SIGNATURE HEADER:", signature)
-            if not verify_paystack_signature(request.data, signature):
-                print("❌ Invalid Paystack signature")
+            if not verify_paystack_signature(request.data, request.headers.get('X-Paystack-Signature')):
+                log.warning("payment_callback_rejected gateway=paystack ref=%s reason=bad_signature", event['payment_ref'])
                 return "Invalid signature", 400
-            # Verify with Paystack API using http_client (to avoid timeout/SSL issues)
-            verify_url = f"https://api.paystack.co/transaction/verify/{payment_ref}"
-            headers = {"Authorization": f"Bearer {os.getenv('PAYSTACK_SECRET_KEY')}"}
-            try:
-                verify_resp = http_client.get(verify_url, headers=headers).json()
-            except Exception as e:
-                print(f"❌ Paystack verification failed: {e}")
-                verify_resp = {"status": False}
-            print(">>> PAYSTACK VERIFY RESPONSE:", verify_resp)
-            if verify_resp.get('status') is True and verify_resp['data']['status'] == 'success':
-                status = 'successful'
-            else:
-                status = 'failed'
-
-        # 🔹 FLUTTERWAVE: detect by known event types AND data.id
-        elif isinstance(data, dict):
-            event = data.get("event") or data.get("event.type")
-            payment_data = data.get("data")
-            if event in ["charge.completed", "BANK_TRANSFER_TRANSACTION"] and payment_data and payment_data.get("id"):
-                print(">>> 🟢 Processing Flutterwave webhook")
-                tx_ref = payment_data.get("tx_ref")
-                transaction_id = payment_data.get("id")
-                flw_ref = payment_data.get("flw_ref")
-                amount = payment_data.get("amount")
-                print(f">>> FLW WEBHOOK tx_ref={tx_ref}, flw_ref={flw_ref}, amount={amount}, id={transaction_id}")
-                if not transaction_id:
-                    print("❌ Missing transaction_id in Flutterwave webhook")
-                    return "Missing transaction_id", 400
-                # Verify with Flutterwave API using http_client
-                verify_url = f"https://api.flutterwave.com/v3/transactions/{transaction_id}/verify"
-                headers = {"Authorization": f"Bearer {os.getenv('FLW_SECRET_KEY')}"}
-                try:
-                    verify_resp = http_client.get(verify_url, headers=headers).json()
-                except Exception as e:
-                    print(f"❌ Flutterwave verification failed: {e}")
-                    verify_resp = {"status": "error"}
-                print(">>> FLUTTERWAVE VERIFY RESPONSE:", verify_resp)
-                if (
-                    verify_resp.get("status") == "success"
-                    and verify_resp["data"]["status"] == "successful"
-                ):
-                    status = "successful"
-                else:
-                    status = "failed"
-                payment_ref = tx_ref  # ✅ CRITICAL: set payment_ref for update
-                gateway = "flutterwave"
+        elif FLW_SECRET_HASH and not hmac.compare_digest(request.headers.get('verif-hash', ''), FLW_SECRET_HASH):
+            log.warning("payment_callback_rejected gateway=flutterwave ref=%s reason=bad_verif_hash", event['payment_ref'])
+            return "Invalid signature", 400
+        if event['payment_ref'] is None:
+            log.warning("payment_callback_rejected reason=missing_payment_ref")
+            return "Missing payment reference", 400
 
-        else:
-            print("❌ Unknown payload format")
-            return "Unknown payload", 400
+        if processed_payments.state(event['payment_ref']) == 'issued':
+            log.info("payment_duplicate ref=%s", event['payment_ref'])
+            return "Already processed", 200
 
-        # Update transaction
-        print(">>> UPDATING TRANSACTION:", payment_ref, "with status:", status)
-        if payment_ref is None:
-            print("❌ payment_ref is None — cannot update")
-            return "Missing payment reference", 400
+        if ASYNC_PAYMENT_CALLBACK:
+            event_id = payment_events.put(event)
+            _payment_wakeup.set()
+            log.info("payment_callback_queued id=%s gateway=%s ref=%s", event_id, event['gateway'], event['payment_ref'])
+            return "Accepted", 200
 
-        update_data = {
-            'status': 'paid' if status in ['successful', 'success'] else 'failed',
-            'updated_at': 'now()'
-        }
-        # Use the resilient updater
         try:
-            result = update_transaction_with_retry(payment_ref, update_data)
-        except Exception as e:
-            print("❌ Final failure updating transaction:", str(e))
-            import traceback; traceback.print_exc()
-            return "Internal error", 500
-        print(">>> UPDATE RESULT:", result)
-        if result.data and update_data['status'] == 'paid':
-            # Fetch transaction + whatsapp_id
-            tx = supabase.table('transactions') \
-                .select('whatsapp_id') \
-                .eq('payment_ref', payment_ref) \
-                .single() \
-                .execute()
-            if tx.data:
-                print(">>> ISSUING TICKET TO:", tx.data['whatsapp_id'])
-                send_ticket(tx.data['whatsapp_id'])
-                return "Ticket issued", 200
-            else:
-                print("❌ No transaction found for payment_ref:", payment_ref)
-                return "Transaction not found", 404
-        else:
-            print("❌ Payment not successful or update failed")
-            return "Payment not successful", 400
-    except Exception as e:
-        print("❌ WEBHOOK ERROR:", str(e))
-        import traceback
-        traceback.print_exc()
+            return process_payment_event(event)
+        except PaymentVerificationError as e:
+            # Non-2xx makes the gateway retry the callback later
+            log.error("payment_verify_failed gateway=%s ref=%s error=%s", event['gateway'], event['payment_ref'], e)
+            return "Verification unavailable", 503
+        except TicketIssuanceInProgress:
+            log.info("payment_issuance_in_progress ref=%s", event['payment_ref'])
+            return "Issuance in progress", 503
+    except Exception:
+        log.exception("payment_callback_failed")
         return "Internal error", 500
 
 
 def verify_paystack_signature(payload_body, signature_header):
     if not signature_header:
-        print("❌ No signature header received")
+        log.warning("paystack_signature_missing")
         return False
 
     secret = os.getenv('PAYSTACK_SECRET_KEY')
     if not secret:
-        print("❌ PAYSTACK_SECRET_KEY not set in .env")
+        log.error("paystack_secret_missing")
         return False
 
     # Compute expected signature
@@ -1585,13 +2806,6 @@ def verify_paystack_signature(payload_body, signature_header):
         hashlib.sha512
     ).hexdigest()
 
-    # ✅ LOG BOTH SIGNATURES
-    print("\n>>> 🔑 PAYSTACK SIGNATURE DEBUG:")
-    print(">>> SECRET KEY USED:", secret[:5] + "..." if secret else "NONE")
-    print(">>> COMPUTED SIGNATURE:", expected_signature)
-    print(">>> RECEIVED SIGNATURE:", signature_header)
-    print(">>> MATCHES:", hmac.compare_digest(expected_signature, signature_header), "\n")
-
     # Compare securely
     return hmac.compare_digest(expected_signature, signature_header)
 
@@ -1610,7 +2824,7 @@ def generate_payment_link_flw(amount, phone, email="customer@example.com", tx_re
         "tx_ref": tx_ref,
         "amount": int(amount),
         "currency": "NGN",
-        "redirect_url": "https://46e92286d210.ngrok-free.app/payment-redirect",
+        "redirect_url": f"{PUBLIC_BASE_URL}/payment-redirect",
         "payment_options": "card,ussd,mobilemoney,qr",
         "customer": {
             "email": email,
@@ -1641,16 +2855,119 @@ def generate_payment_link_paystack(amount, email="customer@example.com", referen
         "email": email,
         "amount": int(amount * 100),  # Paystack uses kobo
         "reference": reference,
-        "redirect_url": "https://46e92286d210.ngrok-free.app/payment-redirect"
+        "redirect_url": f"{PUBLIC_BASE_URL}/payment-redirect"
     }
-    response = requests.post(url, json=data, headers=headers)
+    response = http_client.post(url, json=data, headers=headers)
     return response.json()
 
+def payment_contact(whatsapp_id):
+    """(phone, email) sent to the gateways for a WhatsApp buyer."""
+    phone = whatsapp_id.replace("whatsapp:", "")
+    return phone, f"user_{phone.lstrip('+')}@example.com"
+
+def create_payment_link(gateway, amount, phone, email):
+    """Initialize a payment with one gateway and record the outcome on its circuit breaker.
+
+    Returns (payment_url, reference), or (None, None) if the gateway failed or its breaker
+    would not let the call through.
+    """
+    if not GATEWAY_BREAKERS[gateway].allow():
+        return None, None
+    if gateway == "flutterwave":
+        reference = f"FLW-{secrets.token_hex(8)}"
+        try:
+            result = generate_payment_link_flw(amount, phone, email, reference)
+        except Exception as e:
+            result = {"status": "error", "message": str(e)}
+        ok = isinstance(result, dict) and result.get("status") == "success"
+        payment_url = result["data"]["link"] if ok else None
+    else:
+        reference = f"PSK-{secrets.token_hex(8)}"
+        try:
+            result = generate_payment_link_paystack(amount, email, reference)
+        except Exception as e:
+            result = {"status": False, "message": str(e)}
+        ok = isinstance(result, dict) and result.get("status") is True
+        payment_url = result["data"]["authorization_url"] if ok else None
+    log.debug("payment_link_response gateway=%s body=%s", gateway, result)
+    GATEWAY_BREAKERS[gateway].record(ok)
+    return (payment_url, reference) if ok else (None, None)
+
+
+# ====== SPECULATIVE PAYMENT LINKS ======
+# With SPECULATIVE_PAYMENT_LINKS on, locking a cart also starts link creation for every healthy
+# gateway in the background, so the "1"/"2" reply can answer with a link that is already made
+# instead of waiting 1-3 s on the gateway. Links live in memory for the life of the cart
+# (CART_TTL_MINUTES) and are only used if the cart and amount at selection time still match;
+# otherwise, or if the reply lands on another worker process, the link is created as before.
+# Links that are never used are simply dropped; no transaction exists until one is handed out.
+CART_TTL_MINUTES = int(os.getenv("CART_TTL_MINUTES", "20"))
+SPECULATIVE_PAYMENT_LINKS = os.getenv("SPECULATIVE_PAYMENT_LINKS", "false").lower() == "true"
+SPECULATIVE_LINK_WORKERS = int(os.getenv("SPECULATIVE_LINK_WORKERS", "8"))
+
+_speculative_links = TTLCache(maxsize=int(os.getenv("SPECULATIVE_LINK_CACHE_SIZE", "10000")), ttl=CART_TTL_MINUTES * 60)
+_speculative_links_lock = threading.Lock()
+_speculative_pool = None
+
+def _get_speculative_pool():
+    global _speculative_pool
+    with _speculative_links_lock:
+        if _speculative_pool is None:
+            _speculative_pool = ThreadPoolExecutor(max_workers=SPECULATIVE_LINK_WORKERS, thread_name_prefix="paylink")
+        return _speculative_pool
+
+def start_speculative_links(whatsapp_id, cart, amount, gateways):
+    """Begin creating links for `gateways` for a just-locked cart (event_id, ticket_type_id, quantity)."""
+    if not SPECULATIVE_PAYMENT_LINKS or not gateways:
+        return
+    phone, email = payment_contact(whatsapp_id)
+    pool = _get_speculative_pool()
+    futures = {gateway: pool.submit(create_payment_link, gateway, amount, phone, email) for gateway in gateways}
+    with _speculative_links_lock:
+        _speculative_links[whatsapp_id] = {'cart': tuple(cart), 'amount': amount, 'links': futures}
+    log.debug("payment_link_speculative_started whatsapp_id=%s gateways=%s", whatsapp_id, ",".join(gateways))
+
+def discard_speculative_links(whatsapp_id):
+    with _speculative_links_lock:
+        _speculative_links.pop(whatsapp_id, None)
+
+def take_speculative_links(whatsapp_id, cart, amount):
+    """Pending link futures by gateway for this cart, or {} if none were started or the cart changed."""
+    with _speculative_links_lock:
+        entry = _speculative_links.pop(whatsapp_id, None)
+    if not entry:
+        return {}
+    if entry['cart'] != tuple(cart) or entry['amount'] != amount:
+        log.info("payment_link_speculative_stale whatsapp_id=%s", whatsapp_id)
+        return {}
+    return entry['links']
+
+def get_payment_link(gateway, amount, phone, email, speculative):
+    """Link for `gateway`: the speculative one if it succeeded, else a fresh one if its breaker allows."""
+    future = speculative.get(gateway)
+    if future is not None:
+        try:
+            payment_url, reference = future.result(timeout=HTTP_TIMEOUT)
+        except Exception as e:
+            log.warning("payment_link_speculative_failed gateway=%s error=%s", gateway, e)
+            payment_url, reference = None, None
+        if payment_url:
+            log.info("payment_link_speculative_hit gateway=%s ref=%s", gateway, reference)
+            return payment_url, reference
+    return create_payment_link(gateway, amount, phone, email)
+
 # -------------------------------
 # Gate Validation: Show Ticket
 # -------------------------------
 @app.route('/verify/<ticket_code>')
 def verify_ticket(ticket_code):
+    if is_signed_ticket_code(ticket_code):
+        claims = decode_signed_ticket_code(ticket_code)
+        ticket = signed_ticket_view(ticket_code, claims) if claims else None
+        if not ticket:
+            return render_template('gate/invalid.html', code=ticket_code)
+        return render_template('gate/verify.html', ticket=ticket)
+
     # Fetch ticket + event + ticket type + BUYER NAME
     ticket = supabase.table('tickets') \
         .select('*, event:events(name, date, location), ticket_type:ticket_types(name), buyer:users(name)') \
@@ -1666,27 +2983,289 @@ def verify_ticket(ticket_code):
 # -------------------------------
 # Gate Validation: Scan Ticket
 # -------------------------------
+# Scans recorded by this process, by ticket code, so a rapid re-scan of the same QR is
+# rejected without a database call. Codes are globally unique, so one map covers every event.
+RECENT_SCAN_TTL = int(os.getenv("RECENT_SCAN_TTL", "21600"))
+GATE_TIMEZONE = pytz.timezone(os.getenv("GATE_TIMEZONE", "Africa/Lagos"))
+
+_recent_scans = TTLCache(maxsize=int(os.getenv("RECENT_SCAN_CACHE_SIZE", "100000")), ttl=RECENT_SCAN_TTL)
+_recent_scans_lock = threading.Lock()
+
+def remember_scan(ticket_code, event_id, scanned_at, scanned_by):
+    with _recent_scans_lock:
+        _recent_scans[ticket_code] = {'event_id': event_id, 'scanned_at': scanned_at, 'scanned_by': scanned_by}
+
+def recent_scan(ticket_code):
+    with _recent_scans_lock:
+        return _recent_scans.get(ticket_code)
+
+@app.template_filter('hhmm')
+def format_scan_time(value):
+    """ISO timestamp → HH:MM in the gate's timezone (unparseable values are shown as-is)."""
+    try:
+        moment = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return value or "unknown time"
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(GATE_TIMEZONE).strftime('%H:%M')
+
+def already_admitted(ticket_code, scan):
+    return render_template('gate/already_admitted.html', code=ticket_code,
+                           scanned_at=scan['scanned_at'], scanned_by=scan['scanned_by']), 409
+
 @app.route('/scan/<ticket_code>', methods=['POST'])
 def scan_ticket(ticket_code):
     staff_name = request.form.get('staff_name', 'unknown').strip()
     if not staff_name:
         staff_name = 'unknown'
 
-    # Update ticket
+    # Forged signed codes are rejected without touching the database
+    if is_signed_ticket_code(ticket_code) and not decode_signed_ticket_code(ticket_code):
+        return render_template('gate/invalid.html', code=ticket_code), 400
+
+    prior = recent_scan(ticket_code)
+    if prior:
+        return already_admitted(ticket_code, prior)
+
+    # Conditional transition: only an issued ticket becomes scanned, so concurrent scans of the
+    # same code at two gates cannot both succeed
+    scanned_at = datetime.now(timezone.utc).isoformat()
     result = supabase.table('tickets') \
         .update({
             'status': 'scanned',
-            'scanned_at': 'now()',
+            'scanned_at': scanned_at,
             'scanned_by': staff_name
         }) \
         .eq('ticket_code', ticket_code) \
+        .eq('status', 'issued') \
         .execute()
 
     if result.data:
+        event_id = result.data[0]['event_id']
+        remember_scan(ticket_code, event_id, scanned_at, staff_name)
+        invalidate_gate_manifest(event_id)
         return render_template('gate/success.html')
-    else:
-        return "<h2 style='color:red;text-align:center'>❌ Failed to update. Try again.</h2>", 400
 
+    # Nothing was updated: find out whether the ticket was already admitted or does not exist
+    current = supabase.table('tickets') \
+        .select('event_id, status, scanned_at, scanned_by') \
+        .eq('ticket_code', ticket_code) \
+        .limit(1) \
+        .execute()
+    if not current.data:
+        return render_template('gate/invalid.html', code=ticket_code), 404
+    row = current.data[0]
+    if row['status'] == 'scanned':
+        remember_scan(ticket_code, row['event_id'], row['scanned_at'], row['scanned_by'])
+        return already_admitted(ticket_code, row)
+    return "<h2 style='color:red;text-align:center'>❌ Failed to update. Try again.</h2>", 400
+
+# -------------------------------
+# Offline Gate: Manifest + Batched Scan Sync
+# -------------------------------
+# Scanning devices download /gate/<event_id>/manifest (revalidated with If-None-Match), check
+# codes locally against the hashed entries and queue scans while offline. /scan/batch applies a
+# queue with one conditional update per ticket, so it never overwrites a scan recorded online in
+# the meantime; the earliest scan of each ticket wins, within the batch and against scans
+# already recorded. Both endpoints need the gate key (X-Gate-Key header or ?key=GATE_API_KEY).
+# Manifest entries are HMAC-SHA256(per-event key, ticket_code)[:16]; the per-event key is derived
+# from GATE_MANIFEST_SECRET and handed only to authenticated devices, inside the manifest.
+GATE_API_KEY = os.getenv("GATE_API_KEY")
+GATE_MANIFEST_SECRET = os.getenv("GATE_MANIFEST_SECRET")
+MANIFEST_CACHE_TTL = int(os.getenv("MANIFEST_CACHE_TTL", "15"))
+MANIFEST_PAGE_SIZE = int(os.getenv("MANIFEST_PAGE_SIZE", "1000"))
+SCAN_BATCH_LIMIT = int(os.getenv("SCAN_BATCH_LIMIT", "500"))
+SCAN_BATCH_WORKERS = int(os.getenv("SCAN_BATCH_WORKERS", "8"))
+
+_gate_manifests = LoadingCache(maxsize=256, ttl=MANIFEST_CACHE_TTL)
+
+def is_gate_request():
+    """Gate device auth via the X-Gate-Key header (or ?key=); closed when GATE_API_KEY is unset."""
+    key = request.headers.get('X-Gate-Key') or request.args.get('key') or ''
+    return bool(GATE_API_KEY) and hmac.compare_digest(key.encode(), GATE_API_KEY.encode())
+
+def manifest_hash_key(event_id):
+    return hmac.new(GATE_MANIFEST_SECRET.encode(), f"manifest:{event_id}".encode(), hashlib.sha256).hexdigest()
+
+def manifest_code_hash(event_id, ticket_code):
+    """Hex prefix of HMAC-SHA256(manifest_hash_key(event_id), ticket_code), the form codes take in the manifest."""
+    return hmac.new(manifest_hash_key(event_id).encode(), ticket_code.encode(), hashlib.sha256).hexdigest()[:16]
+
+def fetch_event_tickets(event_id):
+    """Every ticket of the event, paged past PostgREST's max-rows limit."""
+    rows = []
+    while True:
+        page = supabase.table('tickets') \
+            .select('ticket_code, ticket_type_id, status') \
+            .eq('event_id', event_id) \
+            .order('ticket_code') \
+            .range(len(rows), len(rows) + MANIFEST_PAGE_SIZE - 1) \
+            .execute().data or []
+        rows.extend(page)
+        if len(page) < MANIFEST_PAGE_SIZE:
+            return rows
+
+def build_gate_manifest(event_id):
+    tickets = fetch_event_tickets(event_id)
+    types = supabase.table('ticket_types') \
+        .select('id, name') \
+        .eq('event_id', event_id) \
+        .execute()
+    entries = sorted([manifest_code_hash(event_id, t['ticket_code']), t['ticket_type_id'], t['status']]
+                     for t in tickets)
+    ticket_types = {str(t['id']): t['name'] for t in types.data or []}
+    body = json.dumps({'ticket_types': ticket_types, 'tickets': entries}, separators=(',', ':'), sort_keys=True, default=str)
+    version = hashlib.sha256(body.encode()).hexdigest()[:16]
+    return {
+        'event_id': event_id,
+        'version': version,
+        'generated_at': datetime.now(timezone.utc).isoformat(),
+        'hash': 'hmac_sha256(hash_key, ticket_code)[:16]',
+        'hash_key': manifest_hash_key(event_id),
+        'ticket_types': ticket_types,
+        'tickets': entries
+    }
+
+def get_gate_manifest(event_id):
+    return _gate_manifests.get(str(event_id), lambda: build_gate_manifest(event_id))
+
+def invalidate_gate_manifest(event_id):
+    _gate_manifests.invalidate(str(event_id))
+
+@app.route('/gate/<event_id>/manifest')
+def gate_manifest(event_id):
+    if not is_gate_request():
+        return {"error": "Gate key required"}, 403
+    if not GATE_MANIFEST_SECRET:
+        return {"error": "Offline manifests are disabled (GATE_MANIFEST_SECRET is not set)"}, 503
+    manifest = get_gate_manifest(event_id)
+    headers = {'ETag': f'"{manifest["version"]}"', 'Cache-Control': 'private, no-cache'}
+    if manifest['version'] in request.if_none_match:
+        return '', 304, headers
+    return json.dumps(manifest, separators=(',', ':')), 200, {**headers, 'Content-Type': 'application/json'}
+
+def _scan_time(scan):
+    """scanned_at as an aware datetime (no offset means UTC), or None if missing or unparseable."""
+    try:
+        at = datetime.fromisoformat(scan['scanned_at'].replace('Z', '+00:00'))
+    except (KeyError, AttributeError, TypeError, ValueError):
+        return None
+    return at if at.tzinfo else at.replace(tzinfo=timezone.utc)
+
+def _normalize_batch_scan(scan, now):
+    """(ticket_code, {'at', 'staff_name'}) for one submitted scan; code is None if it cannot be applied."""
+    raw_code = scan.get('ticket_code')
+    code = raw_code.strip() if isinstance(raw_code, str) else str(raw_code or '')[:200]
+    staff_name = scan.get('staff_name')
+    if isinstance(staff_name, (int, float)) and not isinstance(staff_name, bool):
+        staff_name = str(staff_name)
+    valid = (isinstance(raw_code, str) and TICKET_CODE_PATTERN.match(code)
+             and (staff_name is None or isinstance(staff_name, str)))
+    if not valid or (is_signed_ticket_code(code) and not decode_signed_ticket_code(code)):
+        return code, None
+    # Device clocks run ahead sometimes; a scan cannot have happened after it reached us
+    at = min(_scan_time(scan) or now, now)
+    return code, {'at': at, 'staff_name': (staff_name or '').strip()[:100] or 'unknown'}
+
+def apply_batch_scan(event_id, code, scan, row):
+    """
+    Record one offline scan with conditional updates. Returns 'accepted' if the ticket was
+    admitted by this scan, or if this scan predates the one on record (which it then replaces);
+    otherwise 'duplicate'.
+    """
+    at = scan['at'].isoformat()
+    staff_name = scan['staff_name']
+    if row['status'] == 'issued':
+        admitted = supabase_service.table('tickets') \
+            .update({'status': 'scanned', 'scanned_at': at, 'scanned_by': staff_name}) \
+            .eq('ticket_code', code) \
+            .eq('event_id', event_id) \
+            .eq('status', 'issued') \
+            .execute()
+        if admitted.data:
+            return 'accepted'
+    elif row['status'] != 'scanned':
+        return 'duplicate'
+    elif (_scan_time(row) or scan['at']) <= scan['at']:
+        return 'duplicate'
+    # Already scanned (possibly since the read): the earlier scan takes over the record
+    earlier = supabase_service.table('tickets') \
+        .update({'scanned_at': at, 'scanned_by': staff_name}) \
+        .eq('ticket_code', code) \
+        .eq('event_id', event_id) \
+        .eq('status', 'scanned') \
+        .gt('scanned_at', at) \
+        .execute()
+    return 'accepted' if earlier.data else 'duplicate'
+
+@app.route('/scan/batch', methods=['POST'])
+def scan_batch():
+    """
+    Body: {"event_id": ..., "scans": [{"ticket_code", "scanned_at" (ISO 8601), "staff_name"}, ...]}
+    Returns one result per distinct ticket code: accepted, duplicate (with the winning scan) or invalid.
+    """
+    if not is_gate_request():
+        return {"error": "Gate key required"}, 403
+    data = request.get_json(silent=True)
+    data = data if isinstance(data, dict) else {}
+    event_id = data.get('event_id')
+    scans = data.get('scans') or []
+    if (not event_id or not isinstance(event_id, (str, int)) or not isinstance(scans, list)
+            or not all(isinstance(scan, dict) for scan in scans)):
+        return {"error": "event_id and a list of scan objects are required"}, 400
+    if len(scans) > SCAN_BATCH_LIMIT:
+        return {"error": f"At most {SCAN_BATCH_LIMIT} scans per batch"}, 413
+
+    now = datetime.now(timezone.utc)
+    results = {}
+    earliest = {}
+    for scan in scans:
+        code, scan = _normalize_batch_scan(scan, now)
+        if not code:
+            continue
+        if scan is None:
+            results[code] = {'result': 'invalid'}
+            continue
+        if code not in earliest or scan['at'] < earliest[code]['at']:
+            earliest[code] = scan
+
+    columns = 'ticket_code, event_id, status, scanned_at, scanned_by'
+    rows = []
+    if earliest:
+        rows = supabase_service.table('tickets') \
+            .select(columns) \
+            .eq('event_id', event_id) \
+            .in_('ticket_code', list(earliest)) \
+            .execute().data or []
+    by_code = {row['ticket_code']: row for row in rows}
+
+    pending = [code for code in earliest if code in by_code]
+    results.update({code: {'result': 'invalid'} for code in earliest if code not in by_code})
+    outcomes = {}
+    if pending:
+        with ThreadPoolExecutor(max_workers=SCAN_BATCH_WORKERS, thread_name_prefix="scan-batch") as pool:
+            futures = {code: pool.submit(apply_batch_scan, event_id, code, earliest[code], by_code[code]) for code in pending}
+            outcomes = {code: future.result() for code, future in futures.items()}
+
+    accepted = [code for code in pending if outcomes[code] == 'accepted']
+    if accepted:
+        invalidate_gate_manifest(event_id)
+    # Report every ticket's winning scan as it now stands
+    if pending:
+        by_code = {row['ticket_code']: row for row in supabase_service.table('tickets')
+                   .select(columns)
+                   .eq('event_id', event_id)
+                   .in_('ticket_code', pending)
+                   .execute().data or []}
+    for code in pending:
+        row = by_code.get(code, {})
+        if row.get('status') == 'scanned':
+            remember_scan(code, row['event_id'], row.get('scanned_at'), row.get('scanned_by'))
+        results[code] = {'result': outcomes[code], 'scanned_at': row.get('scanned_at'), 'scanned_by': row.get('scanned_by')}
+
+    log.info("scan_batch event_id=%s scans=%d accepted=%d", event_id, len(scans), len(accepted))
+    return {"results": results}
 
 # -------------------------------
 # QR Code Generator Endpoint (for testing)
@@ -1696,14 +3275,7 @@ def generate_invite_qr(org_code):
     invite_text = f"attend {org_code}"
     wa_link = f"https://wa.me/14155238886?text={invite_text.replace(' ', '%20')}"
 
-    qr = qrcode.QRCode(box_size=10, border=4)
-    qr.add_data(wa_link)
-    qr.make(fit=True)
-    img = qr.make_image(fill='black', back_color='white')
-
-    buffer = BytesIO()
-    img.save(buffer, format="PNG")
-    buffer.seek(0)
+    buffer = BytesIO(render_qr(wa_link, box_size=10, border=4))
 
     # Upload to Supabase Storage (optional)
     # For now, just return image
@@ -1742,9 +3314,7 @@ def payment_redirect():
 def test_flutterwave():
     test_result = generate_payment_link_flw(100, "+2348012345678", "test@example.com", "TEST-REF")
     
-    # Print to console
-    print("\n>>> FLUTTERWAVE RESPONSE:")
-    print(json.dumps(test_result, indent=2))
+    log.info("test_flutterwave response=%s", json.dumps(test_result))
     
     # Return formatted JSON to browser
     return test_result
@@ -1855,21 +3425,101 @@ def admin_dashboard():
             secret=request.args.get('secret')  # optional: for dev
         )
 
-    except Exception as e:
-        print("❌ Admin dashboard error:", str(e))
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        log.exception("admin_dashboard_failed")
         return "Internal server error", 500
 
-def get_organizer_by_code(org_code):
+@app.route('/admin/intents')
+def intent_stats_endpoint():
+    """Per-intent message counts and handler latency histograms."""
+    if not is_admin_request():
+        return {"error": "Unauthorized"}, 403
+    return intent_stats()
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint: outbound/stage timings, route latency and intent latency."""
+    lines = []
+    for family in (STAGE_SECONDS, REQUEST_SECONDS):
+        lines += render_prometheus_histograms(family.name, family.help_text, family.labelnames, family.items())
+    lines += render_prometheus_histograms('ticketflow_intent_seconds', 'Webhook intent handler latency.',
+                                          ['intent'], [((it.name,), it.latency) for it in INTENTS])
+    for family in (STAGE_ERRORS, REQUESTS_TOTAL):
+        lines += render_prometheus_counter(family)
+    lines += ['# HELP ticketflow_gateway_up 1 unless the gateway circuit breaker is open.', '# TYPE ticketflow_gateway_up gauge']
+    lines += [f'ticketflow_gateway_up{{gateway="{name}"}} {int(breaker.state != CircuitBreaker.OPEN)}'
+              for name, breaker in GATEWAY_BREAKERS.items()]
+    return '\n'.join(lines) + '\n', 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/admin/outbox')
+def outbox_status():
+    """Outbox counts by status plus the most recent dead letters."""
+    if not is_admin_request():
+        return {"error": "Unauthorized"}, 403
+    return {"counts": outbox.counts(), "dead": outbox.dead_letters(int(request.args.get('limit', 100)))}
+
+@app.route('/admin/payment-events')
+def payment_events_status():
+    """Queued gateway callbacks by status plus the ones that exhausted their retries."""
+    if not is_admin_request():
+        return {"error": "Unauthorized"}, 403
+    return {"counts": payment_events.counts(), "dead": payment_events.dead_letters(int(request.args.get('limit', 100)))}
+
+@app.route('/admin/outbox/<int:message_id>/retry', methods=['POST'])
+def retry_outbox_message(message_id):
+    if not is_admin_request():
+        return {"error": "Unauthorized"}, 403
+    if not outbox.requeue(message_id):
+        return {"error": "No dead message with that id"}, 404
+    start_outbox_dispatcher()
+    _outbox_wakeup.set()
+    return {"requeued": message_id}
+
+@app.route('/admin/catalog/invalidate', methods=['POST'])
+def invalidate_catalog_endpoint():
+    """Called by the organizer dashboard after it writes events or ticket types."""
+    if not is_admin_request():
+        return {"error": "Unauthorized"}, 403
+    organizer_id = request.args.get('organizer_id') or None
+    invalidate_event_catalog(organizer_id)
+    return {"invalidated": organizer_id or "all"}
+
+# Organizer rows almost never change, so lookups by code/id are served from a TTL + LRU cache.
+# Anything that writes an organizer (onboarding, setup) must call invalidate_organizer().
+ORGANIZER_CACHE_TTL = int(os.getenv("ORGANIZER_CACHE_TTL", "300"))
+_organizers_by_code = LoadingCache(maxsize=2048, ttl=ORGANIZER_CACHE_TTL)
+_organizers_by_id = LoadingCache(maxsize=2048, ttl=ORGANIZER_CACHE_TTL)
+
+def _fetch_organizer(column, value):
     try:
-        org = supabase.table('organizers').select('*').eq('code', org_code).single().execute()
+        org = supabase.table('organizers').select('*').eq(column, value).single().execute()
         return org.data
     except Exception as e:
         # If no row found (PGRST116) or any other error, return None
-        print(f"⚠️ Organizer not found for code: {org_code} | Error: {e}")
+        log.info("organizer_not_found %s=%s error=%s", column, value, e)
         return None
 
+def get_organizer_by_code(org_code):
+    org = _organizers_by_code.get(org_code, lambda: _fetch_organizer('code', org_code))
+    if org:
+        _organizers_by_id.set(org['id'], org)
+    return org
+
+def get_organizer_by_id(org_id):
+    org = _organizers_by_id.get(org_id, lambda: _fetch_organizer('id', org_id))
+    if org:
+        _organizers_by_code.set(org['code'], org)
+    return org
+
+def invalidate_organizer(org_id=None, code=None):
+    if org_id is not None:
+        cached = _organizers_by_id.peek(org_id)
+        _organizers_by_id.invalidate(org_id)
+        if cached:
+            _organizers_by_code.invalidate(cached['code'])
+    if code is not None:
+        _organizers_by_code.invalidate(code)
+
 @app.route('/organizer/<org_code>')
 def organizer_dashboard(org_code):
     org = get_organizer_by_code(org_code)
@@ -1877,9 +3527,7 @@ def organizer_dashboard(org_code):
         return "❌ Invalid organizer code", 404
 
     # Reuse the API logic
-    api_data = organizer_api(org_code)
-    if isinstance(api_data, tuple) and api_data[1] == 404:
-        return api_data[0], 404
+    api_data = build_organizer_report(org)
 
     # Render template
     return render_template('organizer.html',
@@ -1895,7 +3543,10 @@ def organizer_api(org_code):
     org = get_organizer_by_code(org_code)
     if not org:
         return {"error": "Invalid organizer code"}, 404
+    return build_organizer_report(org)
 
+def build_organizer_report(org):
+    """Events, enriched tickets and revenue for one organizer (shared by the dashboard and the JSON API)."""
     # Get events
     events = supabase.table('events') \
         .select('id, name, date, location, status') \
@@ -1979,7 +3630,7 @@ def verify_flw_payment(tx_ref):
             return "successful"
         return "failed"
     except Exception as e:
-        print(f"❌ FLW verify error for {tx_ref}: {e}")
+        log.error("payment_verify_failed gateway=flutterwave ref=%s error=%s", tx_ref, e)
         return "failed"
 
 def verify_paystack_payment(reference):
@@ -1993,91 +3644,185 @@ def verify_paystack_payment(reference):
             return "successful"
         return "failed"
     except Exception as e:
-        print(f"❌ Paystack verify error for {reference}: {e}")
+        log.error("payment_verify_failed gateway=paystack ref=%s error=%s", reference, e)
         return "failed"
 
+# ====== PAYMENT RECONCILIATION ======
+# Pending transactions are verified on a bounded thread pool, with a separate concurrency cap per
+# gateway so a burst never exceeds what one gateway tolerates. Verified payments are moved to
+# paid with one conditional update per batch, and tickets are issued for the rows that update
+# actually claimed. One run at a time; each run logs and returns its throughput.
+# Each pending transaction carries its own schedule (reconcile_attempts, last_checked_at,
+# next_check_at): a run selects only rows that are due, and every unpaid check pushes the next
+# one out exponentially, from RECONCILE_BACKOFF_BASE up to RECONCILE_BACKOFF_MAX seconds.
+RECONCILE_WORKERS = int(os.getenv("RECONCILE_WORKERS", "16"))
+RECONCILE_BATCH_SIZE = int(os.getenv("RECONCILE_BATCH_SIZE", "100"))
+RECONCILE_GATEWAY_LIMITS = {
+    'flutterwave': int(os.getenv("RECONCILE_LIMIT_FLUTTERWAVE", "8")),
+    'paystack': int(os.getenv("RECONCILE_LIMIT_PAYSTACK", "8")),
+}
+RECONCILE_BACKOFF_BASE = int(os.getenv("RECONCILE_BACKOFF_BASE", "300"))
+RECONCILE_BACKOFF_MAX = int(os.getenv("RECONCILE_BACKOFF_MAX", "21600"))
+RECONCILE_MAX_PER_RUN = int(os.getenv("RECONCILE_MAX_PER_RUN", "2000"))
+
+_reconcile_gateway_slots = {gateway: threading.BoundedSemaphore(limit) for gateway, limit in RECONCILE_GATEWAY_LIMITS.items()}
+_reconcile_lock = threading.Lock()
+
+def _verify_pending_transaction(tx):
+    gateway = 'flutterwave' if tx['payment_gateway'] == 'flutterwave' else 'paystack'
+    with _reconcile_gateway_slots[gateway]:
+        if gateway == 'flutterwave':
+            return gateway, verify_flw_payment(tx['payment_ref'])
+        return gateway, verify_paystack_payment(tx['payment_ref'])
+
+def settle_successful_payments(payment_refs, pool):
+    """Mark verified payments paid in batches; issue tickets for the rows this call claimed."""
+    claimed = []
+    for i in range(0, len(payment_refs), RECONCILE_BATCH_SIZE):
+        batch = payment_refs[i:i + RECONCILE_BATCH_SIZE]
+        result = supabase_service.table('transactions') \
+            .update({'status': 'paid', 'updated_at': 'now()', 'tickets_claimed_at': datetime.now(timezone.utc).isoformat()}) \
+            .in_('payment_ref', batch) \
+            .neq('status', 'paid') \
+            .execute()
+        claimed.extend(result.data or [])
+    return issue_claimed_payments(claimed, pool)
+
+def recover_unissued_payments(since_iso, pool):
+    """Re-issue paid transactions whose issuer died before confirming (stale tickets_claimed_at)."""
+    cutoff = (datetime.now(timezone.utc) - timedelta(seconds=ISSUE_CLAIM_TIMEOUT)).isoformat()
+    stale = supabase_service.table('transactions') \
+        .select('payment_ref') \
+        .eq('status', 'paid') \
+        .is_('tickets_issued_at', 'null') \
+        .or_(f"tickets_claimed_at.is.null,tickets_claimed_at.lt.{cutoff}") \
+        .gte('created_at', since_iso) \
+        .limit(RECONCILE_BATCH_SIZE) \
+        .execute().data or []
+    claimed = [row for row in (claim_stale_issuance(tx['payment_ref']) for tx in stale) if row]
+    for row in claimed:
+        log.warning("ticket_issuance_reclaimed ref=%s", row['payment_ref'])
+    return issue_claimed_payments(claimed, pool)
+
+def issue_claimed_payments(claimed, pool):
+    issued = 0
+    for future in [pool.submit(issue_paid_tickets, row['payment_ref'], row['whatsapp_id']) for row in claimed]:
+        try:
+            future.result()
+            issued += 1
+        except Exception:
+            log.exception("reconcile_issue_failed")
+    return issued
+
+def schedule_next_checks(unpaid, now):
+    """Record an unpaid check: one update per distinct attempt count, each with its own backoff."""
+    by_attempts = {}
+    for tx in unpaid:
+        by_attempts.setdefault(tx.get('reconcile_attempts') or 0, []).append(tx['payment_ref'])
+    for attempts, refs in by_attempts.items():
+        delay = min(RECONCILE_BACKOFF_MAX, RECONCILE_BACKOFF_BASE * (2 ** attempts))
+        for i in range(0, len(refs), RECONCILE_BATCH_SIZE):
+            supabase_service.table('transactions') \
+                .update({
+                    'reconcile_attempts': attempts + 1,
+                    'last_checked_at': now.isoformat(),
+                    'next_check_at': (now + timedelta(seconds=delay)).isoformat()
+                }) \
+                .in_('payment_ref', refs[i:i + RECONCILE_BATCH_SIZE]) \
+                .eq('status', 'pending') \
+                .execute()
+
+def run_reconciliation():
+    """Verify the pending transactions (last 24 hours) that are due for a check; settle the paid ones."""
+    if not _reconcile_lock.acquire(blocking=False):
+        return None
+    try:
+        started = time.perf_counter()
+        now = datetime.now(pytz.UTC)
+        time_24h_ago_iso = (now - timedelta(hours=24)).isoformat()
+        pending_tx = supabase_service.table('transactions') \
+            .select('payment_ref, payment_gateway, reconcile_attempts') \
+            .eq('status', 'pending') \
+            .gte('created_at', time_24h_ago_iso) \
+            .or_(f"next_check_at.is.null,next_check_at.lte.{now.isoformat()}") \
+            .order('next_check_at', nullsfirst=True) \
+            .limit(RECONCILE_MAX_PER_RUN) \
+            .execute()
+        pending = pending_tx.data or []
+
+        successful = []
+        unpaid = []
+        by_gateway = {}
+        with ThreadPoolExecutor(max_workers=RECONCILE_WORKERS, thread_name_prefix="reconcile") as pool:
+            for tx, (gateway, verified) in zip(pending, pool.map(_verify_pending_transaction, pending)):
+                by_gateway[gateway] = by_gateway.get(gateway, 0) + 1
+                if verified == 'successful':
+                    successful.append(tx['payment_ref'])
+                else:
+                    unpaid.append(tx)
+            reconciled = settle_successful_payments(successful, pool) if successful else 0
+            reconciled += recover_unissued_payments(time_24h_ago_iso, pool)
+        schedule_next_checks(unpaid, now)
+
+        elapsed = time.perf_counter() - started
+        report = {
+            "checked": len(pending),
+            "verified_paid": len(successful),
+            "reconciled": reconciled,
+            "by_gateway": by_gateway,
+            "elapsed_s": round(elapsed, 2),
+            "checked_per_s": round(len(pending) / elapsed, 1) if elapsed else 0.0
+        }
+        log.info("reconciliation_done checked=%d verified_paid=%d reconciled=%d elapsed_s=%.2f checked_per_s=%.1f",
+                 report['checked'], report['verified_paid'], reconciled, elapsed, report['checked_per_s'])
+        return report
+    finally:
+        _reconcile_lock.release()
+
 @app.route('/admin/reconcile-pending')
 def reconcile_pending():
     if not is_admin_request():
         return {"error": "Unauthorized"}, 403
-
-    # Calculate 24 hours ago in UTC
-    utc = pytz.UTC
-    time_24h_ago = datetime.now(utc) - timedelta(hours=24)
-    time_24h_ago_iso = time_24h_ago.isoformat()
-
-    pending_tx = supabase_service.table('transactions') \
-        .select('*') \
-        .eq('status', 'pending') \
-        .gte('created_at', time_24h_ago_iso) \
-        .execute()
-
-    reconciled = 0
-    for tx in pending_tx.data or []:
-        if tx['payment_gateway'] == 'flutterwave':
-            verified = verify_flw_payment(tx['payment_ref'])
-        else:
-            verified = verify_paystack_payment(tx['payment_ref'])
-        
-        if verified == 'successful':
-            supabase_service.table('transactions').update({'status': 'paid'}).eq('payment_ref', tx['payment_ref']).execute()
-            send_ticket(tx['whatsapp_id'])
-            reconciled += 1
-
-    return {"reconciled": reconciled, "checked": len(pending_tx.data or [])}
+    report = run_reconciliation()
+    if report is None:
+        return {"error": "Reconciliation already running"}, 409
+    return report
 
 
 def start_reconciliation_scheduler():
     """Run reconciliation and cart cleanup every 10 minutes in background"""
     def run():
-        utc = pytz.UTC
         while True:
             try:
                 # ====== 1. Reconcile pending payments ======
-                print("🕒 Running automatic payment reconciliation...")
-                time_24h_ago = datetime.now(utc) - timedelta(hours=24)
-                time_24h_ago_iso = time_24h_ago.isoformat()
-
-                pending_tx = supabase_service.table('transactions') \
-                    .select('*') \
-                    .eq('status', 'pending') \
-                    .gte('created_at', time_24h_ago_iso) \
-                    .execute()
-
-                reconciled = 0
-                for tx in pending_tx.data or []:
-                    if tx['payment_gateway'] == 'flutterwave':
-                        verified = verify_flw_payment(tx['payment_ref'])
-                    else:
-                        verified = verify_paystack_payment(tx['payment_ref'])
-                    
-                    if verified == 'successful':
-                        supabase_service.table('transactions').update({'status': 'paid'}).eq('payment_ref', tx['payment_ref']).execute()
-                        send_ticket(tx['whatsapp_id'])
-                        reconciled += 1
-
-                print(f"✅ Auto-reconciliation done. Checked: {len(pending_tx.data or [])}, Reconciled: {reconciled}")
+                run_reconciliation()
 
                 # ====== 2. Clean up expired carts (including locked ones) ======
-                print("🧹 Cleaning up expired user carts...")
                 deleted = supabase_service.table('user_carts') \
                     .delete() \
                     .lt('expires_at', 'now()') \
                     .execute()
                 deleted_count = len(deleted.data) if deleted.data else 0
-                print(f"✅ Expired carts cleaned up: {deleted_count}")
+                log.info("expired_carts_deleted count=%d", deleted_count)
 
-            except Exception as e:
-                print(f"❌ Background scheduler error: {e}")
-                import traceback
-                traceback.print_exc()
+            except Exception:
+                log.exception("scheduler_failed")
             
             time.sleep(600)  # every 10 minutes
 
     thread = threading.Thread(target=run, daemon=True)
     thread.start()
-    print("🔁 Auto-reconciliation + cart cleanup scheduler started (every 10 mins)")
+    log.info("scheduler_started interval=600s")
+
+# Queued payment events and outbox messages must go out even if no new callback or message ever
+# reaches this process again, so their workers start at import under any WSGI server. QR pool
+# children re-import this file when it is run as a script (as __mp_main__, under their own
+# process name); they must not start workers.
+if multiprocessing.current_process().name == 'MainProcess':
+    start_payment_workers()
+    start_outbox_dispatcher()
 
 if __name__ == "__main__":
     start_reconciliation_scheduler()
+    start_gateway_monitor()
     app.run(debug=True)
\ No newline at end of file
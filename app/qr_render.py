@@ -0,0 +1,16 @@
+# app/qr_render.py
+# QR PNG encoding for the process pool in main.py. It lives apart from main so that pool workers,
+# started with forkserver/spawn, import only this module and not the whole app.
+import qrcode
+from io import BytesIO
+
+
+def render_qr_png(data, box_size=5, border=2):
+    """Encode `data` as a QR PNG and return the bytes. Runs inside pool workers, so no app state."""
+    qr = qrcode.QRCode(box_size=box_size, border=border)
+    qr.add_data(data)
+    qr.make(fit=True)
+    img = qr.make_image(fill='black', back_color='white')
+    buf = BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
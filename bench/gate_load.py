@@ -0,0 +1,281 @@
+"""
+Gate load benchmark: N concurrent scanners against /verify/<code> and /scan/<code>.
+
+The Flask app runs in-process on a local port, and its Supabase clients are pointed at a small
+fake PostgREST server (also local) that answers the gate queries from memory after an
+artificial delay, so results reflect the app plus a realistic database round trip.
+
+Every scanner verifies and then scans codes from a shared list; --duplicate-rate of the scans
+re-use a code another scanner may be admitting at the same moment. The run fails (exit 1) if any
+ticket is admitted more than once.
+
+    python bench/gate_load.py --scanners 50 --tickets 2000 --latency-ms 40
+    python bench/gate_load.py --signed      # self-verifying codes, DB-free /verify
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+EVENT_ID = 1
+TICKET_TYPE_ID = 1
+
+
+# ====== FAKE POSTGREST ======
+class FakePostgrest:
+    """In-memory tables plus the handful of PostgREST filters the gate routes use."""
+    def __init__(self, latency):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.tables = {
+            'events': [{'id': EVENT_ID, 'name': 'Bench Night', 'date': '2099-01-01', 'location': 'Main Hall'}],
+            'ticket_types': [{'id': TICKET_TYPE_ID, 'event_id': EVENT_ID, 'name': 'Regular'}],
+            'tickets': [],
+        }
+        self.requests = 0
+
+    @staticmethod
+    def _filters(params):
+        filters = []
+        for key, value in params:
+            if key in ('select', 'limit', 'order', 'on_conflict', 'columns'):
+                continue
+            op, _, operand = value.partition('.')
+            if op == 'eq':
+                filters.append(lambda row, k=key, v=operand: str(row.get(k)) == v)
+            elif op == 'in':
+                values = {v.strip('"') for v in operand.strip('()').split(',')}
+                filters.append(lambda row, k=key, vs=values: str(row.get(k)) in vs)
+        return filters
+
+    def _embed(self, table, row, select):
+        out = dict(row)
+        if table == 'tickets' and 'event:events' in select:
+            out['event'] = dict(self.tables['events'][0])
+            out['ticket_type'] = {'name': self.tables['ticket_types'][0]['name']}
+            out['buyer'] = {'name': 'Bench Guest'}
+        if table == 'ticket_types' and 'event:events' in select:
+            out['event'] = dict(self.tables['events'][0])
+        return out
+
+    def handle(self, method, path, query, body):
+        time.sleep(self.latency)
+        table = path.rstrip('/').rsplit('/', 1)[-1]
+        params = parse_qsl(query, keep_blank_values=True)
+        select = dict(params).get('select', '*')
+        limit = int(dict(params).get('limit', 0)) or None
+        filters = self._filters(params)
+        with self.lock:
+            self.requests += 1
+            rows = [row for row in self.tables.get(table, []) if all(f(row) for f in filters)]
+            if method == 'GET':
+                return [self._embed(table, row, select) for row in rows[:limit]]
+            if method == 'PATCH':
+                for row in rows:
+                    row.update(body)
+                return [dict(row) for row in rows]
+            if method == 'POST':
+                items = body if isinstance(body, list) else [body]
+                self.tables.setdefault(table, []).extend(dict(item) for item in items)
+                return items
+        return []
+
+def start_fake_postgrest(backend):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _respond(self):
+            url = urlsplit(self.path)
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length) or b'null') if length else None
+            rows = backend.handle(self.command, unquote(url.path), url.query, body)
+            if 'vnd.pgrst.object' in self.headers.get('Accept', ''):
+                if len(rows) != 1:
+                    self._send(406, {'message': 'JSON object requested, multiple (or no) rows returned',
+                                     'code': 'PGRST116', 'details': None, 'hint': None})
+                    return
+                rows = rows[0]
+            self._send(200, rows)
+
+        def _send(self, status, payload):
+            data = json.dumps(payload, default=str).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('Content-Range', '0-0/*')
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_PATCH = do_POST = _respond
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fake-postgrest', daemon=True).start()
+    return server
+
+
+# ====== APP UNDER TEST ======
+def load_app(postgrest_url, signed):
+    # main.py validates its config at import, so give it placeholders and rebind the clients after
+    os.environ.update({
+        'SUPABASE_URL': 'https://bench.invalid', 'SUPABASE_KEY': 'bench-anon', 'SUPABASE_SERVICE_ROLE_KEY': 'bench-service',
+        'TWILIO_ACCOUNT_SID': 'ACbench', 'TWILIO_AUTH_TOKEN': 'bench', 'TWILIO_WHATSAPP_NUMBER': 'whatsapp:+10000000000',
+        'LOG_LEVEL': os.getenv('LOG_LEVEL', 'WARNING'),
+        'OUTBOX_DB_PATH': os.path.join(tempfile.mkdtemp(prefix='gate-bench-'), 'outbox.db'),
+    })
+    if signed:
+        os.environ['TICKET_SIGNING_KEY'] = 'bench-signing-key'
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'app'))
+    import main
+    from supabase import create_client
+    main.supabase = create_client(postgrest_url, 'bench-anon')
+    main.supabase_service = create_client(postgrest_url, 'bench-service')
+    return main
+
+def start_app(main):
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, main.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='bench-app', daemon=True).start()
+    return server
+
+
+# ====== LOAD ======
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def run_scanner(base_url, codes, duplicate_rate, stop_at, results, rng):
+    import requests
+    session = requests.Session()
+    timings = defaultdict(list)
+    outcomes = []
+    errors = 0
+    while time.perf_counter() < stop_at:
+        with results['lock']:
+            if results['next'] >= len(codes):
+                break
+            if results['next'] and rng.random() < duplicate_rate:
+                code = codes[rng.randrange(results['next'])]
+            else:
+                code = codes[results['next']]
+                results['next'] += 1
+        try:
+            start = time.perf_counter()
+            verify = session.get(f"{base_url}/verify/{code}")
+            timings['verify'].append(time.perf_counter() - start)
+            start = time.perf_counter()
+            scan = session.post(f"{base_url}/scan/{code}", data={'staff_name': threading.current_thread().name})
+            timings['scan'].append(time.perf_counter() - start)
+            if verify.status_code != 200:
+                errors += 1
+            outcomes.append((code, scan.status_code))
+        except Exception:
+            errors += 1
+    with results['lock']:
+        for name, values in timings.items():
+            results['timings'][name].extend(values)
+        results['outcomes'].extend(outcomes)
+        results['errors'] += errors
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scanners', type=int, default=20, help='concurrent simulated gate devices')
+    parser.add_argument('--tickets', type=int, default=1000, help='tickets issued for the event')
+    parser.add_argument('--duration', type=float, default=15.0, help='seconds to run (stops early when all tickets are used)')
+    parser.add_argument('--latency-ms', type=float, default=30.0, help='artificial fake PostgREST latency per request')
+    parser.add_argument('--duplicate-rate', type=float, default=0.1, help='share of scans that re-present an earlier code')
+    parser.add_argument('--signed', action='store_true', help='issue HMAC-signed codes (DB-free /verify)')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    backend = FakePostgrest(args.latency_ms / 1000)
+    postgrest = start_fake_postgrest(backend)
+    main = load_app(f"http://127.0.0.1:{postgrest.server_port}", args.signed)
+    app_server = start_app(main)
+    base_url = f"http://127.0.0.1:{app_server.server_port}"
+
+    codes = [main.mint_ticket_code(EVENT_ID, TICKET_TYPE_ID) for _ in range(args.tickets)]
+    backend.tables['tickets'] = [{'id': i, 'ticket_code': code, 'event_id': EVENT_ID, 'ticket_type_id': TICKET_TYPE_ID,
+                                  'whatsapp_id': f'whatsapp:+2340000{i:05d}', 'quantity': 1, 'status': 'issued',
+                                  'scanned_at': None, 'scanned_by': None}
+                                 for i, code in enumerate(codes)]
+
+    results = {'lock': threading.Lock(), 'next': 0, 'timings': defaultdict(list), 'outcomes': [], 'errors': 0}
+    started = time.perf_counter()
+    stop_at = started + args.duration
+    threads = [threading.Thread(target=run_scanner, name=f'scanner-{i}',
+                                args=(base_url, codes, args.duplicate_rate, stop_at, results, random.Random(args.seed + i)))
+               for i in range(args.scanners)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    admitted = defaultdict(int)
+    rejected = 0
+    for code, status in results['outcomes']:
+        if status == 200:
+            admitted[code] += 1
+        elif status == 409:
+            rejected += 1
+    double_admissions = sum(1 for count in admitted.values() if count > 1)
+    db_scanned = sum(1 for row in backend.tables['tickets'] if row['status'] == 'scanned')
+
+    report = {
+        'scanners': args.scanners, 'latency_ms': args.latency_ms, 'signed': args.signed,
+        'elapsed_s': round(elapsed, 2), 'scans': len(results['outcomes']), 'errors': results['errors'],
+        'scans_per_s': round(len(results['outcomes']) / elapsed, 1),
+        'db_requests': backend.requests,
+        'endpoints': {},
+        'correctness': {
+            'admitted': len(admitted), 'rejected_duplicates': rejected,
+            'double_admissions': double_admissions, 'db_scanned': db_scanned,
+            'ok': double_admissions == 0 and db_scanned == len(admitted),
+        },
+    }
+    for name, values in sorted(results['timings'].items()):
+        values.sort()
+        report['endpoints'][name] = {
+            'requests': len(values),
+            'per_s': round(len(values) / elapsed, 1),
+            'p50_ms': round(percentile(values, 50) * 1000, 1),
+            'p95_ms': round(percentile(values, 95) * 1000, 1),
+            'p99_ms': round(percentile(values, 99) * 1000, 1),
+        }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{args.scanners} scanners, {args.latency_ms:g} ms DB latency, signed codes: {args.signed}")
+        print(f"{report['scans']} scans in {report['elapsed_s']}s ({report['scans_per_s']}/s), "
+              f"{report['db_requests']} DB requests, {report['errors']} errors")
+        for name, stats in report['endpoints'].items():
+            print(f"  {name:<7} {stats['per_s']:>8}/s  p50 {stats['p50_ms']:>7} ms  "
+                  f"p95 {stats['p95_ms']:>7} ms  p99 {stats['p99_ms']:>7} ms")
+        c = report['correctness']
+        print(f"  admitted {c['admitted']}, duplicate scans rejected {c['rejected_duplicates']}, "
+              f"double admissions {c['double_admissions']} → {'OK' if c['ok'] else 'FAILED'}")
+    app_server.shutdown()
+    postgrest.shutdown()
+    return 0 if report['correctness']['ok'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
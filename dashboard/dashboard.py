@@ -3,6 +3,7 @@ import streamlit as st
 import os
 from supabase import create_client
 import uuid
+import requests
 from datetime import datetime
 
 # Load env
@@ -12,6 +13,20 @@ load_dotenv()
 # Init Supabase
 supabase = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
 
+def notify_catalog_changed(organizer_id):
+    """Tell the WhatsApp bot to drop its cached `events` catalog (best effort — it also expires on its own)."""
+    bot_url = os.getenv("BOT_BASE_URL")
+    if not bot_url:
+        return
+    try:
+        requests.post(
+            f"{bot_url.rstrip('/')}/admin/catalog/invalidate",
+            params={"secret": os.getenv("ADMIN_SECRET"), "organizer_id": organizer_id},
+            timeout=3
+        )
+    except Exception:
+        pass
+
 # -------------------------------
 # Page Config
 # -------------------------------
@@ -100,6 +115,7 @@ if st.session_state.user and st.session_state.org:
                 result = supabase.table("events").insert(event_data).execute()
                 
                 if result.data:
+                    notify_catalog_changed(org['id'])
                     st.success(f"🎉 Event Created! ID: {result.data[0]['id']}")
                     st.session_state.current_event_id = result.data[0]['id']
                     st.session_state.show_ticket_types = True
@@ -145,6 +161,7 @@ if st.session_state.user and st.session_state.org:
                 for t in ticket_forms:
                     t["event_id"] = st.session_state.current_event_id
                     supabase.table("ticket_types").insert(t).execute()
+                notify_catalog_changed(org['id'])
                 
                 st.success("✅ Ticket types saved!")
                 